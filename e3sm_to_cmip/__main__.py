@@ -7,11 +7,13 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import os
 import sys
+import json
 import logging
 import tempfile
 import shutil
 import threading
 import signal
+import multiprocessing
 from pathos.multiprocessing import ProcessPool as Pool
 
 os.environ['CDAT_ANONYMOUS_LOG'] = 'false'
@@ -24,8 +26,12 @@ from e3sm_to_cmip.util import add_metadata
 from e3sm_to_cmip.util import copy_user_metadata
 from e3sm_to_cmip.util import print_debug
 from e3sm_to_cmip.util import precheck
-from e3sm_to_cmip.lib import run_parallel
-from e3sm_to_cmip.lib import run_serial
+from e3sm_to_cmip.util import setup_scratch
+from e3sm_to_cmip.util import cleanup_scratch
+from e3sm_to_cmip.util import load_output_policy
+from e3sm_to_cmip.plan import get_plan
+from e3sm_to_cmip.plan import calibrate_cost_model
+from e3sm_to_cmip.plan import format_plan
 
 import numpy as np
 np.warnings.filterwarnings('ignore')
@@ -59,7 +65,20 @@ def main():
     map_path = _args['map'] if _args.get('map') else None
     cmor_log_dir = _args['logdir'] if _args.get('logdir') else None
     timeout = int(_args['timeout']) if _args.get('timeout') else None
+    time_window = _args.get('time_window')
     should_precheck = _args.get('precheck')
+    dask_workers = _args.get('dask_workers')
+    batch_remap = _args.get('batch_remap')
+    incremental = _args.get('incremental')
+
+    # with the MPI backend rank 0 prepares the run, then every rank runs
+    # handlers
+    comm = None
+    rank = 0
+    if _args.get('mpi'):
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        rank = comm.Get_rank()
 
     timer = None
     if timeout:
@@ -73,7 +92,12 @@ def main():
             os.path.abspath(cmor_handlers.__file__))
     
     if should_precheck:
-        new_var_list = precheck(input_path, output_path, var_list, mode)
+        new_var_list = None
+        if rank == 0:
+            new_var_list = precheck(input_path, output_path, var_list, mode,
+                                    handlers_path=handlers_path)
+        if comm is not None:
+            new_var_list = comm.bcast(new_var_list, root=0)
         if not new_var_list:
             print("All variables previously computed")
             if timer: timer.cancel()
@@ -82,33 +106,87 @@ def main():
             print("Setting up conversion for {}".format(" ".join(new_var_list)))
             var_list = new_var_list
     
+    # report the work of the run and its predicted cost, without setting up
+    # the output, the scratch space, dask or CMOR
+    if _args.get('plan') is not None:
+        if timer: timer.cancel()
+        if rank != 0:
+            return 0
+        cost_model = None
+        if _args.get('plan_cost'):
+            with open(_args['plan_cost'], 'r') as infile:
+                cost_model = json.load(infile)
+            cost_model = cost_model.get('cost_model', cost_model)
+        if _args.get('plan_calibrate'):
+            plan_file, status_file = _args['plan_calibrate']
+            with open(plan_file, 'r') as infile:
+                previous_plan = json.load(infile)
+            with open(status_file, 'r') as infile:
+                status = json.load(infile)
+            cost_model = calibrate_cost_model(
+                previous_plan, status, cost_model)
+        handlers = load_handlers(
+            handlers_path, var_list, debug, info_only=True)
+        plan = get_plan(
+            handlers, input_path, map_path, mode,
+            nproc=nproc,
+            cost_model=cost_model,
+            incremental=incremental,
+            output_path=output_path)
+        print(format_plan(plan))
+        if _args['plan']:
+            with open(_args['plan'], 'w') as outfile:
+                json.dump(plan, outfile, indent=2)
+            print_message('Wrote the plan to {}'.format(_args['plan']), 'ok')
+        return 0
+
+    # the conversion needs CMOR and cdms2, imported only now so --plan works
+    # where they arent installed
+    from e3sm_to_cmip.lib import run_mpi
+    from e3sm_to_cmip.mpas import start_dask_backend
+
     # add additional optional metadata to the output files
     if only_metadata:
-        print_message('Updating file metadata and exiting', 'ok')
-        add_metadata(
-            file_path=output_path,
-            var_list=var_list)
+        if rank == 0:
+            print_message('Updating file metadata and exiting', 'ok')
+            add_metadata(
+                file_path=output_path,
+                var_list=var_list)
         return 0
 
     new_metadata_path = os.path.join(
         output_path,
         'user_metadata.json')
 
-    # create the output dir if it doesnt exist
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
+    if rank == 0:
+        # create the output dir if it doesnt exist
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
 
-    # setup temp storage directory
-    temp_path = os.environ.get('TMPDIR')
-    if temp_path is None:
-     
-        temp_path = '{}/tmp'.format(output_path)
-        if not os.path.exists(temp_path):
-            os.makedirs(temp_path)
+        # copy the users metadata json file with the updated output directory
+        copy_user_metadata(
+            user_metadata, output_path)
 
+    # the other ranks wait for the output dir and metadata
+    if comm is not None:
+        comm.Barrier()
+
+    # setup temp storage directory, preferring node-local scratch space. Each
+    # MPI rank has its own, on its own node
+    temp_path = setup_scratch(
+        output_path,
+        scratch_path=_args.get('scratch_dir'),
+        min_free=_args.get('scratch_min_free'))
     tempfile.tempdir = temp_path
 
-    logging_path = os.path.join(output_path, 'converter.log')
+    # the compression policy of the output, loaded before the workers start
+    load_output_policy(_args.get('output_policy'))
+
+    if rank == 0:
+        logging_path = os.path.join(output_path, 'converter.log')
+    else:
+        logging_path = os.path.join(
+            output_path, 'converter_rank{}.log'.format(rank))
     print_message("Writing log output to: {}".format(logging_path), 'debug')
 
     # setup logging
@@ -119,10 +197,6 @@ def main():
         filemode='w',
         level=logging.INFO)
 
-    # copy the users metadata json file with the updated output directory
-    copy_user_metadata(
-        user_metadata, output_path)
-
     # load variable handlers
     handlers = load_handlers(
         handlers_path,
@@ -130,9 +204,111 @@ def main():
         debug)
     if len(handlers) == 0:
         print_message('No handlers loaded')
+        cleanup_scratch(temp_path)
         sys.exit(1)
 
-    # run in the user-selected mode
+    # start the dask backend shared by all the MPAS handlers
+    dask_backend = None
+    dask_cluster = None
+    if mode not in ['atm', 'lnd', 'fx']:
+        dask_backend_name = _args.get('dask_backend')
+        if comm is not None and dask_backend_name == 'distributed':
+            print_message(
+                'The distributed dask backend is not used with MPI, using threads')
+            dask_backend_name = 'threads'
+        if not dask_workers and dask_backend_name == 'threads':
+            # dont oversubscribe the cores when handlers run in parallel
+            dask_workers = multiprocessing.cpu_count()
+            if comm is not None:
+                local_ranks = comm.Split_type(MPI.COMM_TYPE_SHARED).Get_size()
+                dask_workers = max(1, dask_workers // local_ranks)
+            elif not serial:
+                dask_workers = max(1, dask_workers // nproc)
+        dask_backend, dask_cluster = start_dask_backend(
+            backend=dask_backend_name,
+            numWorkers=dask_workers,
+            memoryLimit=_args.get('dask_memory_limit'),
+            chunkSize=_args.get('dask_chunk_size'),
+            zarrStore=_args.get('zarr_store'),
+            resultCache=_args.get('result_cache'),
+            resultCacheSize=_args.get('result_cache_size'))
+
+    try:
+        if comm is not None:
+            if rank == 0:
+                print_message('Running CMOR handlers on {} MPI ranks'.format(
+                    comm.Get_size()), 'ok')
+            status = run_mpi(
+                comm=comm,
+                handlers=handlers,
+                input_path=input_path,
+                tables_path=tables_path,
+                metadata_path=new_metadata_path,
+                map_path=map_path,
+                mode=mode,
+                logdir=cmor_log_dir,
+                time_window=time_window,
+                dask_backend=dask_backend,
+                incremental=incremental,
+                output_path=output_path)
+        else:
+            status = run_handlers(
+                handlers, serial, nproc, input_path, tables_path,
+                new_metadata_path, map_path, mode, cmor_log_dir, time_window,
+                dask_backend, batch_remap, incremental, output_path,
+                _args.get('status_file'), _args.get('handler_timeout'),
+                _args.get('handler_soft_timeout'), _args.get('retries'))
+    finally:
+        if dask_cluster is not None:
+            dask_cluster.close()
+        scratch_bytes = cleanup_scratch(temp_path)
+        msg = 'Scratch space {} used for {:.1f} MB of temporary files'.format(
+            temp_path, scratch_bytes / 1024.0 ** 2)
+        logging.info(msg)
+        if comm is None:
+            print_message(msg, 'ok')
+        else:
+            scratch_bytes = comm.reduce(scratch_bytes, root=0)
+            if rank == 0:
+                print_message(
+                    'Scratch space used for {:.1f} MB of temporary files on all ranks'.format(
+                        scratch_bytes / 1024.0 ** 2), 'ok')
+
+    # only rank 0 reports and adds the metadata
+    if rank != 0:
+        if timeout:
+            timer.cancel()
+        return status
+
+    if status != 0:
+        print_message("Error running handlers: {}".format(" ".join([x['name'] for x in handlers])))
+        return 1
+
+    # add additional optional metadata to the output files
+    if no_metadata:
+        print_message('Not adding additional metadata', 'ok')
+    else:
+        add_metadata(
+            file_path=output_path,
+            var_list=var_list)
+
+    if timeout:
+        timer.cancel()
+    return 0
+# ------------------------------------------------------------------
+
+
+def run_handlers(handlers, serial, nproc, input_path, tables_path,
+                 new_metadata_path, map_path, mode, cmor_log_dir, time_window,
+                 dask_backend, batch_remap, incremental, output_path,
+                 status_file=None, handler_timeout=None,
+                 handler_soft_timeout=None, retries=None):
+    """
+    Run the handlers in the user-selected mode, returning 0 on success
+    """
+    from e3sm_to_cmip.lib import run_parallel
+    from e3sm_to_cmip.lib import run_serial
+
     if serial:
         print_message('Running CMOR handlers in serial', 'ok')
         try:
@@ -143,7 +319,14 @@ def main():
                 metadata_path=new_metadata_path,
                 map_path=map_path,
                 mode=mode,
-                logdir=cmor_log_dir)
+                logdir=cmor_log_dir,
+                time_window=time_window,
+                dask_backend=dask_backend,
+                batch_remap=batch_remap,
+                incremental=incremental,
+                output_path=output_path,
+                status_file=status_file,
+                retries=retries)
         except KeyboardInterrupt as error:
             print_message(' -- keyboard interrupt -- ', 'error')
             return 1
@@ -162,28 +345,23 @@ def main():
                 metadata_path=new_metadata_path,
                 map_path=map_path,
                 mode=mode,
-                logdir=cmor_log_dir)
+                logdir=cmor_log_dir,
+                time_window=time_window,
+                dask_backend=dask_backend,
+                batch_remap=batch_remap,
+                incremental=incremental,
+                output_path=output_path,
+                status_file=status_file,
+                handler_timeout=handler_timeout,
+                handler_soft_timeout=handler_soft_timeout,
+                retries=retries)
         except KeyboardInterrupt as error:
             print_message(' -- keyboard interrupt -- ', 'error')
             return 1
         except Exception as error:
             print_debug(error)
             return 1
-    if status != 0:
-        print_message("Error running handlers: {}".format(" ".join([x['name'] for x in handlers])))
-        return 1
-
-    # add additional optional metadata to the output files
-    if no_metadata:
-        print_message('Not adding additional metadata', 'ok')
-    else:
-        add_metadata(
-            file_path=output_path,
-            var_list=var_list)
-
-    if timeout:
-        timer.cancel()
-    return 0
+    return status
 # ------------------------------------------------------------------
 
 
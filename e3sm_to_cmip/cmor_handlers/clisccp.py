@@ -3,6 +3,7 @@ FISCCP1_COSP to clisccp converter
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 from e3sm_to_cmip.util import setup_cmor
+from e3sm_to_cmip.util import apply_output_policy
 from e3sm_to_cmip.util import print_message
 from e3sm_to_cmip.lib import my_dynamic_message
 import progressbar
@@ -10,7 +11,6 @@ import progressbar
 import cmor
 import cdms2
 import logging
-import os
 logger = logging.getLogger()
 
 
@@ -66,22 +66,9 @@ def handle(infiles, tables, user_input_path, **kwargs):
         infiles)
     logger.debug(msg)
 
-    # setup cmor    
-    logdir = kwargs.get('logdir')
-    if logdir:
-        logfile = logfile = os.path.join(logdir, VAR_NAME + '.log')
-    else:
-        logfile = os.path.join(os.getcwd(), 'logs')
-        if not os.path.exists(logfile):
-            os.makedirs(logfile)
-        logfile = os.path.join(logfile, VAR_NAME + '.log')
-
-    cmor.setup(
-        inpath=tables,
-        netcdf_file_action=cmor.CMOR_REPLACE,
-        logfile=logfile)
-    cmor.dataset_json(user_input_path)
-    cmor.load_table(TABLE)
+    # setup cmor
+    setup_cmor(VAR_NAME, tables, TABLE, user_input_path,
+               logdir=kwargs.get('logdir'))
 
     msg = '{}: CMOR setup complete'.format(VAR_NAME)
     logger.info(msg)
@@ -153,6 +140,7 @@ def handle(infiles, tables, user_input_path, **kwargs):
             axis_ids.append(axis_id)
 
         varid = cmor.variable(VAR_NAME, VAR_UNITS, axis_ids)
+        apply_output_policy(varid, VAR_NAME, TABLE)
 
        # write out the data
         msg = "{}: time {:1.1f} - {:1.1f}".format(
@@ -188,10 +176,10 @@ def handle(infiles, tables, user_input_path, **kwargs):
             if serial:
                 pbar.finish()
 
+        cmor.close(varid)
+
     msg = '{}: write complete, closing'.format(VAR_NAME)
     logger.info(msg)
-
-    cmor.close()
     msg = '{}: file close complete'.format(VAR_NAME)
     logger.info(msg)
 
@@ -64,15 +64,14 @@ def handle(infiles, tables, user_input_path, **kwargs):
             dsIn.timeMonthly_avg_frazilLayerThicknessTendency
 
         ds = mpas.add_time(ds, dsIn)
-        ds.compute()
 
-    ds = mpas.add_mask(ds, cellMask3D)
-    ds = mpas.add_depth(ds, dsMesh)
-    ds.compute()
+        ds = mpas.add_mask(ds, cellMask3D)
+        ds = mpas.add_depth(ds, dsMesh)
 
-    ds = mpas.remap(ds, mappingFileName)
+        ds = mpas.remap(ds, mappingFileName)
 
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean')
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
@@ -1,47 +0,0 @@
-"""
-Q to hus converter
-"""
-from __future__ import absolute_import, division, print_function, unicode_literals
-
-import cmor
-from e3sm_to_cmip.lib import handle_variables
-
-# list of raw variable names needed
-RAW_VARIABLES = [str('Q')]
-VAR_NAME = str('hus')
-VAR_UNITS = str('1')
-TABLE = str('CMIP6_Amon.json')
-LEVELS = {
-    'name': str('plev19'),
-    'units': str('Pa'),
-    'e3sm_axis_name': 'plev'
-}
-
-
-def write_data(varid, data, timeval, timebnds, index, **kwargs):
-    """
-    hus = Q
-    """
-    cmor.write(
-        varid,
-        data['Q'][index, :],
-        time_vals=timeval,
-        time_bnds=timebnds)
-# ------------------------------------------------------------------
-
-
-def handle(infiles, tables, user_input_path, **kwargs):
-
-    return handle_variables(
-        metadata_path=user_input_path,
-        tables=tables,
-        table=TABLE,
-        infiles=infiles,
-        raw_variables=RAW_VARIABLES,
-        write_data=write_data,
-        outvar_name=VAR_NAME,
-        outvar_units=VAR_UNITS,
-        serial=kwargs.get('serial'),
-        levels=LEVELS,
-        logdir=kwargs.get('logdir'))
-# ------------------------------------------------------------------
@@ -61,18 +61,17 @@ def handle(infiles, tables, user_input_path, **kwargs):
         ds[VAR_NAME] = config_density0 * \
             dsIn.timeMonthly_avg_layerThickness.where(cellMask3D, 0.)
         ds = mpas.add_time(ds, dsIn)
-        ds.compute()
 
-    ds = mpas.add_depth(ds, dsMesh)
-    ds.compute()
+        ds = mpas.add_depth(ds, dsMesh)
 
-    ds = mpas.remap(ds, mappingFileName)
+        ds = mpas.remap(ds, mappingFileName)
 
     # set masked values (where there are no MPAS grid cells) to zero
     ds[VAR_NAME] = ds[VAR_NAME].where(
         ds[VAR_NAME] != netCDF4.default_fillvals['f4'], 0.)
 
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean')
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
@@ -18,6 +18,9 @@ VAR_NAME = 'masso'
 VAR_UNITS = 'kg'
 TABLE = 'CMIP6_Omon.json'
 
+# the global ocean integrals the handler needs, see mpas.get_ocean_integrals
+INTEGRALS = ['volume']
+
 
 def handle(infiles, tables, user_input_path, **kwargs):
     """
@@ -49,22 +52,16 @@ def handle(infiles, tables, user_input_path, **kwargs):
     namelist = mpas.convert_namelist_to_dict(namelistFileName)
     config_density0 = float(namelist['config_density0'])
 
-    dsMesh = xarray.open_dataset(meshFileName, mask_and_scale=False)
-    _, cellMask3D = mpas.get_cell_masks(dsMesh)
-
-    variableList = ['timeMonthly_avg_layerThickness', 'xtime_startMonthly',
-                    'xtime_endMonthly']
+    integrals = mpas.get_ocean_integrals(
+        timeSeriesFiles, meshFileName, fields=INTEGRALS,
+        runFields=kwargs.get('ocean_integrals'))
 
     ds = xarray.Dataset()
-    with mpas.open_mfdataset(timeSeriesFiles, variableList) as dsIn:
-        ds[VAR_NAME] = (config_density0 *
-                        dsIn.timeMonthly_avg_layerThickness.where(
-                            cellMask3D, 0.) *
-                        dsMesh.areaCell).sum(dim=['nVertLevels', 'nCells'])
-        ds = mpas.add_time(ds, dsIn)
-        ds.compute()
-
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean')
+    ds[VAR_NAME] = config_density0 * integrals.volume
+    ds['time_bnds'] = integrals.time_bnds
+
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
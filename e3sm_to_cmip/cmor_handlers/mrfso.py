@@ -4,11 +4,9 @@ SOILICE to mrfso converter
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import cmor
-import cdms2
-import logging
 import numpy as np
 
-from e3sm_to_cmip.lib import handle_variables
+from e3sm_to_cmip.lib import handle_variables, vertical_sum
 
 # list of raw variable names needed
 RAW_VARIABLES = [str('SOILICE')]
@@ -16,33 +14,29 @@ VAR_NAME = str('mrfso')
 VAR_UNITS = str('kg m-2')
 TABLE = str('CMIP6_Lmon.json')
 
+# number of time steps reduced and written at once
+BLOCK_SIZE = 12
+
+# the handler passes append_to through to handle_variables
+APPEND = True
+
 
 def write_data(varid, data, timeval, timebnds, index, **kwargs):
     """
     mrfso = verticalSum(SOILICE, capped_at=5000)
     """
-    # we only care about data with a value greater then 0
-    mask = np.greater(data['SOILICE'][index, :], 0.0)
-
-    # sum the data over the levgrnd axis
-    outdata = np.sum(
-        data['SOILICE'][index, :],
-        axis=0)
-    
-    # replace all values greater then 5k with 5k
-    capped = np.where(
-        np.greater(outdata, 5000.0),
-        5000.0,
-        outdata)
-    outdata = np.where(
-        mask,
-        capped,
-        outdata)
+    outdata = vertical_sum(
+        data,
+        RAW_VARIABLES,
+        index,
+        out=kwargs['out'],
+        cap=5000.0)
     cmor.write(
         varid,
         outdata,
         time_vals=timeval,
-        time_bnds=timebnds)
+        time_bnds=timebnds,
+        file_suffix=kwargs.get('file_suffix', ''))
 
 
 def handle(infiles, tables, user_input_path, **kwargs):
@@ -56,5 +50,10 @@ def handle(infiles, tables, user_input_path, **kwargs):
         outvar_name=VAR_NAME,
         outvar_units=VAR_UNITS,
         serial=kwargs.get('serial'),
-        logdir=kwargs.get('logdir'))
+        logdir=kwargs.get('logdir'),
+        time_window=kwargs.get('time_window'),
+        append_to=kwargs.get('append_to'),
+        dtype=np.float32,
+        block_size=BLOCK_SIZE,
+        reduce_axis=1)
 # ------------------------------------------------------------------
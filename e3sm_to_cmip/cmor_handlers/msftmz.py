@@ -60,13 +60,24 @@ def handle(infiles, tables, user_input_path, **kwargs):
                     'timeMonthly_avg_layerThickness',
                     'xtime_startMonthly', 'xtime_endMonthly']
 
-    with mpas.open_mfdataset(timeSeriesFiles, variableList) as dsIn:
-        showProgress = 'serial' in kwargs and kwargs['serial']
-        ds = mpas.compute_moc_streamfunction(dsIn, dsMesh, dsMasks,
-                                             showProgress=showProgress)
+    def compute():
+        with mpas.open_mfdataset(timeSeriesFiles, variableList) as dsIn:
+            showProgress = 'serial' in kwargs and kwargs['serial']
+            ds = mpas.compute_moc_streamfunction(dsIn, dsMesh, dsMasks,
+                                                 showProgress=showProgress)
+            return ds.load()
+
+    # the streamfunction only depends on the input files, so a run with new
+    # tables or metadata can reuse it
+    ds = mpas.get_cached_result(
+        ['msftmz', mpas.get_files_key(
+            [__file__, meshFileName, regionMaskFileName] +
+            sorted(timeSeriesFiles))],
+        compute)
     ds = ds.rename({'moc': VAR_NAME})
 
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean')
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean',
+                    logdir=kwargs.get('logdir'))
 
     region = ['global_ocean',
               'atlantic_arctic_ocean']
@@ -72,14 +72,14 @@ def handle(infiles, tables, user_input_path, **kwargs):
                 dim='nVertLevels')
 
         ds = mpas.add_time(ds, dsIn)
-        ds.compute()
 
-    ds = mpas.remap(ds, mappingFileName)
+        ds = mpas.remap(ds, mappingFileName)
 
     with xarray.open_mfdataset(pslFileNames, concat_dim='time') as dsIn:
         ds[VAR_NAME] = ds[VAR_NAME] + dsIn.PSL.values
 
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean')
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
@@ -8,7 +8,7 @@ import cdms2
 import logging
 import os
 import progressbar
-from e3sm_to_cmip.util import print_message
+from e3sm_to_cmip.util import print_message, setup_cmor, apply_output_policy
 from cdutil.vertical import reconstructPressureFromHybrid
 
 # list of raw variable names needed
@@ -85,15 +85,7 @@ def handle(infiles, tables, user_input_path, **kwargs):
         logpath = os.path.join(outpath, 'cmor_logs')
     os.makedirs(logpath, exist_ok=True)
 
-    logfile = os.path.join(logpath, VAR_NAME + '.log')
-
-    cmor.setup(
-        inpath=tables,
-        netcdf_file_action=cmor.CMOR_REPLACE,
-        logfile=logfile)
-
-    cmor.dataset_json(str(user_input_path))
-    cmor.load_table(str(TABLE))
+    setup_cmor(VAR_NAME, tables, TABLE, user_input_path, logdir=logpath)
 
     msg = '{}: CMOR setup complete'.format(VAR_NAME)
     logging.info(msg)
@@ -215,6 +207,7 @@ def handle(infiles, tables, user_input_path, **kwargs):
         data['ips'] = ips
 
         varid = cmor.variable(VAR_NAME, VAR_UNITS, axis_ids[:4])
+        apply_output_policy(varid, VAR_NAME, TABLE)
 
         # write out the data
         msg = "{}: time {:1.1f} - {:1.1f}".format(
@@ -250,11 +243,11 @@ def handle(infiles, tables, user_input_path, **kwargs):
         if serial:
             pbar.finish()
 
+        cmor.close(varid)
+
     msg = '{}: write complete, closing'.format(VAR_NAME)
     logger.debug(msg)
 
-    cmor.close()
-
     msg = '{}: file close complete'.format(VAR_NAME)
     logger.debug(msg)
 
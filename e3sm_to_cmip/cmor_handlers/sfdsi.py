@@ -52,11 +52,11 @@ def handle(infiles, tables, user_input_path, **kwargs):
         ds[VAR_NAME] = dsIn.timeMonthly_avg_seaIceSalinityFlux
 
         ds = mpas.add_time(ds, dsIn)
-        ds.compute()
 
-    ds = mpas.remap(ds, mappingFileName)
+        ds = mpas.remap(ds, mappingFileName)
 
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean')
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
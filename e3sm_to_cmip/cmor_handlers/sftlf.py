@@ -8,7 +8,7 @@ import os
 import logging
 import cdms2
 import progressbar
-from e3sm_to_cmip.util import print_message
+from e3sm_to_cmip.util import print_message, setup_cmor, apply_output_policy
 from e3sm_to_cmip.lib import handle_variables
 
 # list of raw variable names needed
@@ -58,15 +58,7 @@ def handle(infiles, tables, user_input_path, **kwargs):
         logpath = os.path.join(outpath, 'cmor_logs')
     os.makedirs(logpath, exist_ok=True)
 
-    logfile = os.path.join(logpath, VAR_NAME + '.log')
-
-    cmor.setup(
-        inpath=tables,
-        netcdf_file_action=cmor.CMOR_REPLACE,
-        logfile=logfile)
-
-    cmor.dataset_json(str(user_input_path))
-    cmor.load_table(str(TABLE))
+    setup_cmor(VAR_NAME, tables, TABLE, user_input_path, logdir=logpath)
 
     msg = '{}: CMOR setup complete'.format(VAR_NAME)
     logging.info(msg)
@@ -121,6 +113,7 @@ def handle(infiles, tables, user_input_path, **kwargs):
         axis_ids.append(axis_id)
 
     varid = cmor.variable(VAR_NAME, VAR_UNITS, axis_ids)
+    apply_output_policy(varid, VAR_NAME, TABLE)
 
     if serial:
         myMessage = progressbar.DynamicMessage('running')
@@ -148,7 +141,7 @@ def handle(infiles, tables, user_input_path, **kwargs):
     msg = '{}: write complete, closing'.format(VAR_NAME)
     logger.debug(msg)
 
-    cmor.close()
+    cmor.close(varid)
 
     msg = '{}: file close complete'.format(VAR_NAME)
     logger.debug(msg)
@@ -59,15 +59,14 @@ def handle(infiles, tables, user_input_path, **kwargs):
         ds[VAR_NAME] = dsIn.timeMonthly_avg_snowVolumeCell
         ds['siconc'] = dsIn.timeMonthly_avg_iceAreaCell
         ds = mpas.add_time(ds, dsIn)
-        ds.compute()
 
-    ds = mpas.add_si_mask(ds, cellMask2D, ds.siconc)
-    ds['cellMask'] = ds.siconc * ds.cellMask
-    ds.compute()
+        ds = mpas.add_si_mask(ds, cellMask2D, ds.siconc)
+        ds['cellMask'] = ds.siconc * ds.cellMask
 
-    ds = mpas.remap(ds, mappingFileName)
+        ds = mpas.remap(ds, mappingFileName)
 
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='seaice')
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='seaice',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
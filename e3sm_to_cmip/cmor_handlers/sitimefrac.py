@@ -56,14 +56,13 @@ def handle(infiles, tables, user_input_path, **kwargs):
     with mpas.open_mfdataset(timeSeriesFiles, variableList) as dsIn:
         ds[VAR_NAME] = dsIn.timeMonthly_avg_icePresent
         ds = mpas.add_time(ds, dsIn)
-        ds.compute()
 
-    ds = mpas.add_mask(ds, cellMask2D)
-    ds.compute()
+        ds = mpas.add_mask(ds, cellMask2D)
 
-    ds = mpas.remap(ds, mappingFileName)
+        ds = mpas.remap(ds, mappingFileName)
 
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='seaice')
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='seaice',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
@@ -55,14 +55,13 @@ def handle(infiles, tables, user_input_path, **kwargs):
     with mpas.open_mfdataset(timeSeriesFiles, variableList) as dsIn:
         ds[VAR_NAME] = dsIn.timeMonthly_avg_activeTracers_salinity
         ds = mpas.add_time(ds, dsIn)
-        ds.compute()
-    ds = mpas.add_mask(ds, cellMask3D)
-    ds = mpas.add_depth(ds, dsMesh)
-    ds.compute()
+        ds = mpas.add_mask(ds, cellMask3D)
+        ds = mpas.add_depth(ds, dsMesh)
 
-    ds = mpas.remap(ds, mappingFileName)
+        ds = mpas.remap(ds, mappingFileName)
 
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean')
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
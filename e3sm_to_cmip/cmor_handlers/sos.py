@@ -56,13 +56,12 @@ def handle(infiles, tables, user_input_path, **kwargs):
         thetao = dsIn.timeMonthly_avg_activeTracers_salinity
         ds[VAR_NAME] = thetao.isel(nVertLevels=0).squeeze(drop=True)
         ds = mpas.add_time(ds, dsIn)
-        ds.compute()
-    ds = mpas.add_mask(ds, cellMask2D)
-    ds.compute()
+        ds = mpas.add_mask(ds, cellMask2D)
 
-    ds = mpas.remap(ds, mappingFileName)
+        ds = mpas.remap(ds, mappingFileName)
 
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean')
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
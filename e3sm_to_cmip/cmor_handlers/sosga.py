@@ -17,6 +17,9 @@ VAR_NAME = 'sosga'
 VAR_UNITS = '0.001'
 TABLE = 'CMIP6_Omon.json'
 
+# the global ocean integrals the handler needs, see mpas.get_ocean_integrals
+INTEGRALS = ['surfaceSalinityArea', 'area']
+
 
 def handle(infiles, tables, user_input_path, **kwargs):
     """
@@ -44,24 +47,16 @@ def handle(infiles, tables, user_input_path, **kwargs):
     meshFileName = infiles['MPAS_mesh']
     timeSeriesFiles = infiles['MPASO']
 
-    dsMesh = xarray.open_dataset(meshFileName, mask_and_scale=False)
-    cellMask2D, _ = mpas.get_cell_masks(dsMesh)
-
-    variableList = ['timeMonthly_avg_activeTracers_salinity',
-                    'xtime_startMonthly', 'xtime_endMonthly']
+    integrals = mpas.get_ocean_integrals(
+        timeSeriesFiles, meshFileName, fields=INTEGRALS,
+        runFields=kwargs.get('ocean_integrals'))
 
     ds = xarray.Dataset()
-    with mpas.open_mfdataset(timeSeriesFiles, variableList) as dsIn:
-        thetao = dsIn.timeMonthly_avg_activeTracers_salinity
-        tos = thetao.isel(nVertLevels=0).squeeze(drop=True).where(cellMask2D)
-        areaCell = dsMesh.areaCell.where(cellMask2D)
-        ds[VAR_NAME] = ((tos*areaCell).sum(dim='nCells') /
-                        areaCell.sum(dim='nCells'))
-        ds = mpas.add_time(ds, dsIn)
-        ds.compute()
-    ds.compute()
-
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean')
+    ds[VAR_NAME] = integrals.surfaceSalinityArea / integrals.area
+    ds['time_bnds'] = integrals.time_bnds
+
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
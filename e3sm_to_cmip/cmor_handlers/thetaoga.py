@@ -18,6 +18,9 @@ VAR_NAME = 'thetaoga'
 VAR_UNITS = 'degC'
 TABLE = 'CMIP6_Omon.json'
 
+# the global ocean integrals the handler needs, see mpas.get_ocean_integrals
+INTEGRALS = ['temperatureVolume', 'volume']
+
 
 def handle(infiles, tables, user_input_path, **kwargs):
     """
@@ -46,26 +49,16 @@ def handle(infiles, tables, user_input_path, **kwargs):
     meshFileName = infiles['MPAS_mesh']
     timeSeriesFiles = infiles['MPASO']
 
-    dsMesh = xarray.open_dataset(meshFileName, mask_and_scale=False)
-    _, cellMask3D = mpas.get_cell_masks(dsMesh)
-
-    variableList = ['timeMonthly_avg_layerThickness',
-                    'timeMonthly_avg_activeTracers_temperature',
-                    'xtime_startMonthly', 'xtime_endMonthly']
+    integrals = mpas.get_ocean_integrals(
+        timeSeriesFiles, meshFileName, fields=INTEGRALS,
+        runFields=kwargs.get('ocean_integrals'))
 
     ds = xarray.Dataset()
-    with mpas.open_mfdataset(timeSeriesFiles, variableList) as dsIn:
-        layerThickness = dsIn.timeMonthly_avg_layerThickness.where(cellMask3D)
-        thetao = dsIn.timeMonthly_avg_activeTracers_temperature.where(
-            cellMask3D)
-        vol = layerThickness*dsMesh.areaCell
-        volo = (vol).sum(dim=['nVertLevels', 'nCells'])
-        ds[VAR_NAME] = (vol*thetao).sum(dim=['nVertLevels', 'nCells'])/volo
-
-        ds = mpas.add_time(ds, dsIn)
-        ds.compute()
-
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean')
+    ds[VAR_NAME] = integrals.temperatureVolume / integrals.volume
+    ds['time_bnds'] = integrals.time_bnds
+
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
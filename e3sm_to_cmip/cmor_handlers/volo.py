@@ -18,6 +18,9 @@ VAR_NAME = 'volo'
 VAR_UNITS = 'm3'
 TABLE = 'CMIP6_Omon.json'
 
+# the global ocean integrals the handler needs, see mpas.get_ocean_integrals
+INTEGRALS = ['volume']
+
 
 def handle(infiles, tables, user_input_path, **kwargs):
     """
@@ -45,24 +48,16 @@ def handle(infiles, tables, user_input_path, **kwargs):
     meshFileName = infiles['MPAS_mesh']
     timeSeriesFiles = infiles['MPASO']
 
-    dsMesh = xarray.open_dataset(meshFileName, mask_and_scale=False)
-    _, cellMask3D = mpas.get_cell_masks(dsMesh)
-
-    variableList = ['timeMonthly_avg_layerThickness', 'xtime_startMonthly',
-                    'xtime_endMonthly']
+    integrals = mpas.get_ocean_integrals(
+        timeSeriesFiles, meshFileName, fields=INTEGRALS,
+        runFields=kwargs.get('ocean_integrals'))
 
     ds = xarray.Dataset()
-    with mpas.open_mfdataset(timeSeriesFiles, variableList) as dsIn:
-        ds[VAR_NAME] = (dsIn.timeMonthly_avg_layerThickness.where(
-                            cellMask3D, 0.) *
-                        dsMesh.areaCell).sum(dim=['nVertLevels', 'nCells'])
-
-        ds = mpas.add_time(ds, dsIn)
-        ds.compute()
-
-    ds.compute()
+    ds[VAR_NAME] = integrals.volume
+    ds['time_bnds'] = integrals.time_bnds
 
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean')
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
@@ -61,7 +61,6 @@ def handle(infiles, tables, user_input_path, **kwargs):
         thicknessSum = layerThickness.sum(dim='nVertLevels')
         mask = cellMask3D.isel(nVertLevels=0)
         zSurface = (-dsMesh.bottomDepth + thicknessSum).where(mask)
-        zSurface.compute()
         # print('done zSurface')
         slices = [zSurface]
         maskSlices = [mask]
@@ -70,7 +69,6 @@ def handle(infiles, tables, user_input_path, **kwargs):
             mask = cellMask3D.isel(nVertLevels=zIndex)
             zLayerBot = (zLayerBot -
                          layerThickness.isel(nVertLevels=zIndex)).where(mask)
-            zLayerBot.compute()
             # print('done zLayerBot {}/{}'.format(zIndex+1, nVertLevels))
             slices.append(zLayerBot)
             maskSlices.append(mask)
@@ -79,13 +77,13 @@ def handle(infiles, tables, user_input_path, **kwargs):
         ds = mpas.add_mask(ds, mask)
         ds = ds.transpose('Time', 'olevhalf', 'nCells')
         ds = mpas.add_time(ds, dsIn)
-        ds.compute()
 
-    ds = mpas.remap(ds, mappingFileName)
+        ds = mpas.remap(ds, mappingFileName)
     depth_coord_half = numpy.zeros(nVertLevels+1)
     depth_coord_half[1:] = dsMesh.refBottomDepth.values
 
-    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean')
+    mpas.setup_cmor(VAR_NAME, tables, user_input_path, component='ocean',
+                    logdir=kwargs.get('logdir'))
 
     # create axes
     axes = [{'table_entry': 'time',
@@ -1,18 +1,44 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
-from e3sm_to_cmip.lib import handle_variables
+from e3sm_to_cmip.lib import handle_variables, fill_masked
+from e3sm_to_cmip.formula import compile_formula
 import cmor
+import numpy as np
+
+# number of time steps computed and passed to cmor.write at once
+BLOCK_SIZE = 12
 
 
 def default_handler(infiles, tables, user_input_path, **kwargs):
+    """
+    Handler for the variables described in default_handler_info.yaml. The
+    optional formula over the raw variables is compiled once and evaluated
+    over whole blocks of time steps, without a formula the first raw
+    variable is written as is.
+    """
     RAW_VARIABLES = kwargs['raw_variables']
+    formula = kwargs.get('formula') or RAW_VARIABLES[0]
+    kernel = compile_formula(formula, RAW_VARIABLES)
 
     def write_data(varid, data, timeval, timebnds, index, **kwargs):
+        out = kwargs['out']
+        outdata = kernel(data, index, out)
+        if outdata is out:
+            fill_masked(outdata, data, index)
         cmor.write(
             varid,
-            data[ RAW_VARIABLES[0] ][index, :],
+            outdata,
             time_vals=timeval,
-            time_bnds=timebnds)
-            
+            time_bnds=timebnds,
+            file_suffix=kwargs.get('file_suffix', ''))
+        # hybrid level variables also need the surface pressure
+        if 'ips' in data:
+            cmor.write(
+                data['ips'],
+                data['ps'][index, :],
+                time_vals=timeval,
+                time_bnds=timebnds,
+                store_with=varid)
+
     return handle_variables(
         metadata_path=user_input_path,
         tables=tables,
@@ -24,5 +50,10 @@ def default_handler(infiles, tables, user_input_path, **kwargs):
         outvar_units=kwargs['units'],
         serial=kwargs.get('serial'),
         positive=kwargs.get('positive'),
-        logdir=kwargs.get('logdir'))
-# ------------------------------------------------------------------
\ No newline at end of file
+        levels=kwargs.get('levels'),
+        logdir=kwargs.get('logdir'),
+        time_window=kwargs.get('time_window'),
+        append_to=kwargs.get('append_to'),
+        dtype=np.float32,
+        block_size=BLOCK_SIZE)
+# ------------------------------------------------------------------
@@ -0,0 +1,134 @@
+"""
+Compile the formula expressions of the declarative handlers in
+default_handler_info.yaml into vectorized numpy kernels
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import ast
+import numpy as np
+
+_BINARY_OPS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power
+}
+
+_UNARY_OPS = {
+    ast.USub: np.negative,
+    ast.UAdd: np.positive
+}
+
+_FUNCTIONS = {
+    'abs': np.absolute,
+    'sqrt': np.sqrt,
+    'exp': np.exp,
+    'log': np.log,
+    'minimum': np.minimum,
+    'maximum': np.maximum
+}
+
+# older versions of python parse numbers as ast.Num instead of ast.Constant
+_CONSTANTS = tuple(getattr(ast, name) for name in ['Constant', 'Num']
+                   if hasattr(ast, name))
+
+
+def compile_formula(formula, variables):
+    """
+    Parse a formula over raw E3SM variables, for example "(PRECC + PRECL) * 1000.0",
+    into a kernel that evaluates it over a block of time steps
+
+    Params:
+    -------
+        formula (str): the arithmetic expression to compile
+        variables (list(str)): the raw variable names the formula may use
+    Returns:
+    --------
+        kernel(data, index, out): a function that evaluates the formula
+        on data[var][index] for every variable, writing into the out array
+        where possible. The result is either out, or if the formula is just
+        a variable name, the input array itself
+    """
+    try:
+        tree = ast.parse(formula.strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError("Unable to parse formula: {}".format(formula))
+    root = _compile_node(tree.body, formula, variables)
+
+    def kernel(data, index, out):
+        result = root(data, index, out)
+        if result is out or isinstance(tree.body, ast.Name):
+            return result
+        np.copyto(out, result, casting='unsafe')
+        return out
+
+    return kernel
+# ------------------------------------------------------------------
+
+
+def _is_compound(node):
+    return not isinstance(node, (ast.Name,) + _CONSTANTS)
+# ------------------------------------------------------------------
+
+
+def _compile_node(node, formula, variables):
+    """
+    Recursively turn an expression node into a function(data, index, out).
+    Compound nodes write their result into out if one is given, the first
+    compound operand of an operation reuses the buffer of its parent so only
+    expressions with two compound operands allocate a temporary
+    """
+    if isinstance(node, ast.Name):
+        if node.id not in variables:
+            raise ValueError("Unknown variable {} in formula: {}".format(
+                node.id, formula))
+        name = node.id
+        return lambda data, index, out: data[name][index]
+
+    if isinstance(node, _CONSTANTS):
+        value = node.value if hasattr(node, 'value') else node.n
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("Unsupported constant {} in formula: {}".format(
+                value, formula))
+        value = float(value)
+        return lambda data, index, out: value
+
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+        ufunc = _UNARY_OPS[type(node.op)]
+        operand = _compile_node(node.operand, formula, variables)
+
+        def unary(data, index, out):
+            return ufunc(operand(data, index, out), out=out)
+        return unary
+
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+        return _compile_call(
+            _BINARY_OPS[type(node.op)], [node.left, node.right],
+            formula, variables)
+
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+            and node.func.id in _FUNCTIONS and not node.keywords:
+        return _compile_call(
+            _FUNCTIONS[node.func.id], node.args, formula, variables)
+
+    raise ValueError("Unsupported expression in formula: {}".format(formula))
+# ------------------------------------------------------------------
+
+
+def _compile_call(ufunc, args, formula, variables):
+    operands = [_compile_node(arg, formula, variables) for arg in args]
+    compound = [_is_compound(arg) for arg in args]
+
+    def call(data, index, out):
+        values = list()
+        buffer_used = False
+        for operand, is_compound in zip(operands, compound):
+            if is_compound and not buffer_used:
+                values.append(operand(data, index, out))
+                buffer_used = True
+            else:
+                values.append(operand(data, index, None))
+        return ufunc(*values, out=out)
+    return call
+# ------------------------------------------------------------------
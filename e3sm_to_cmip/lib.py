@@ -1,15 +1,32 @@
 from e3sm_to_cmip.util import terminate
 from e3sm_to_cmip.util import print_debug
 from e3sm_to_cmip.util import print_message
-from e3sm_to_cmip.util import find_mpas_files
-from e3sm_to_cmip.util import find_atm_files
+from e3sm_to_cmip.util import get_levgrnd_bnds
+from e3sm_to_cmip.util import setup_cmor
+from e3sm_to_cmip.util import apply_output_policy
+from e3sm_to_cmip.util import index_cmip_output
+from e3sm_to_cmip.util import set_progress_queue
+from e3sm_to_cmip.util import publish_progress
+from e3sm_to_cmip.plan import get_input_paths
+from e3sm_to_cmip.plan import get_incremental_inputs
+from e3sm_to_cmip import mpas
 import progressbar
 import os
+import errno
+import json
+import multiprocessing
+import signal
+from queue import Queue
+import time
 import cmor
 import cdms2
 import logging
+import numpy as np
 logger = logging.getLogger()
 
+# the missing value used for masked points in the typed (float32) output path
+FILL_VALUE = 1e20
+
 
 def run_parallel(pool, handlers, input_path, tables_path, metadata_path,
                  map_path=None, mode='atm', nproc=6, **kwargs):
@@ -23,25 +40,643 @@ def run_parallel(pool, handlers, input_path, tables_path, metadata_path,
         tables_path (str): path to the tables directory
         metadata_path (str): path to the cmor input metadata
         mode (str): what type of files to work with
+        dask_backend (dict): the dask backend from mpas.start_dask_backend
+            shared by the MPAS handlers
+        batch_remap (int): number of MPAS handlers run together in a worker,
+            so their datasets are remapped with a single ncremap
+        incremental (str): new-files or append, to only convert the years
+            after the existing output in output_path
+        status_file (str): path of a json file kept up to date with the
+            progress of the run
+        handler_soft_timeout (float): seconds after which a running handler
+            is reported as a straggler
+        handler_timeout (float): seconds after which a running handler is
+            stopped and counted as failed
+        retries (int): times a handler that failed from a lack of memory or
+            an I/O error is run again with smaller chunks, time windows and
+            fewer dask threads, the last time alone
     Returns:
     --------
         returns 1 if an error occurs, else 0
     """
 
+    calls = get_handler_calls(
+        handlers, input_path, tables_path, metadata_path, map_path, mode,
+        logdir=kwargs.get('logdir'),
+        time_window=kwargs.get('time_window'),
+        incremental=kwargs.get('incremental'),
+        output_path=kwargs.get('output_path'))
+
+    # with batch_remap, groups of MPAS handlers run together in one worker so
+    # their datasets can be remapped at once
+    batch_remap = get_batch_size(mode, kwargs.get('batch_remap'))
+
+    # the workers publish their progress on a queue served by a manager, so
+    # it can be passed to them like any other argument
+    manager = multiprocessing.Manager()
+    queue = manager.Queue()
+    monitor = ProgressMonitor(
+        queue, len(calls), status_file=kwargs.get('status_file'))
+
+    def submit(indices, attempt=0):
+        """
+        Run the calls at the given indices in the pool, with less resources
+        for a retry
+        """
+        dask_backend = kwargs.get('dask_backend')
+        batch = [calls[idx] for idx in indices]
+        if attempt:
+            for idx in indices:
+                monitor.errors.pop(calls[idx][2]['name'], None)
+            dask_backend = downgrade_dask_backend(dask_backend, attempt)
+            batch = [(method, args, downgrade_handler_kwargs(_kwargs, attempt))
+                     for method, args, _kwargs in batch]
+        if len(batch) == 1:
+            method, args, _kwargs = batch[0]
+            res = pool.apipe(
+                run_handler,
+                method,
+                dask_backend,
+                queue,
+                *args,
+                **_kwargs)
+        else:
+            res = pool.apipe(
+                run_remap_batch,
+                batch,
+                dask_backend,
+                queue)
+        return indices, attempt, res
+
     pool_res = list()
-    for idx, handler in enumerate(handlers):
-        handler_method = handler['method']
-        handler_variables = handler['raw_variables']
-        # find the input files this handler needs
-        if mode in ['atm', 'lnd']:
-
-            input_paths = {var: [os.path.join(input_path, x) for x in
-                                 find_atm_files(var, input_path)]
-                           for var in handler_variables}
+    for start in range(0, len(calls), batch_remap):
+        pool_res.append(submit(list(range(start, min(start + batch_remap, len(calls))))))
+
+    # handle the results as they complete, not in the order they were
+    # submitted, and keep up with the progress events in between
+    pbar = progressbar.ProgressBar(maxval=len(calls))
+    pbar.start()
+    num_success = 0
+    num_done = 0
+    num_handlers = len(calls)
+
+    # a handler over its hard budget has its worker killed, the pool starts
+    # a new worker in its place and the other handlers carry on
+    soft_timeout = kwargs.get('handler_soft_timeout')
+    hard_timeout = kwargs.get('handler_timeout')
+    stopped = dict()
+
+    # handlers that failed from a lack of memory or an I/O error are run
+    # again with less resources, the last retry alone once all the other
+    # handlers are done
+    retries = kwargs.get('retries') or 0
+    exclusive = list()
+
+    try:
+        while pool_res or exclusive:
+            if not pool_res:
+                idx, attempt = exclusive.pop(0)
+                msg = 'Retrying {} alone'.format(calls[idx][2]['name'])
+                print_message(msg, 'ok')
+                logger.info(msg)
+                pool_res.append(submit([idx], attempt))
+
+            monitor.poll(timeout=0.5)
+            for name, pid in monitor.check_budgets(soft_timeout, hard_timeout):
+                stopped[name] = 'timeout'
+                msg = '{} exceeded its time budget of {} seconds, stopping it'.format(
+                    name, hard_timeout)
+                print_message(msg, 'error')
+                logger.error(msg)
+                if pid is not None:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+            for name in monitor.check_workers():
+                stopped[name] = 'killed'
+                msg = 'The worker running {} was killed'.format(name)
+                print_message(msg, 'error')
+                logger.error(msg)
+
+            pending = list()
+            for indices, attempt, res in pool_res:
+                names = [calls[idx][2]['name'] for idx in indices]
+                if any(name in stopped for name in names):
+                    # the whole batch ran in the stopped worker, the other
+                    # handlers of the batch were killed with it and can be
+                    # retried
+                    for name in names:
+                        if name not in stopped:
+                            stopped[name] = 'killed'
+                        monitor.forget(name)
+                    out = [None] * len(indices)
+                elif not res.ready():
+                    pending.append((indices, attempt, res))
+                    continue
+                else:
+                    out = res.get()
+                    if len(indices) == 1:
+                        out = [out]
+                    # the done events, with the errors of the handlers, are
+                    # on the queue before the result
+                    monitor.poll()
+                for idx, name in zip(indices, out):
+                    handler = calls[idx][2]['name']
+                    error = stopped.pop(handler, None) or monitor.errors.get(handler)
+                    if not name and error in RETRY_ERRORS and attempt < retries:
+                        msg = '{} failed with a {} error, retrying with less resources'.format(
+                            handler, error)
+                        print_message(msg, 'error')
+                        logger.warning(msg)
+                        if attempt + 1 == retries:
+                            exclusive.append((idx, attempt + 1))
+                        else:
+                            pending.append(submit([idx], attempt + 1))
+                        continue
+
+                    num_done += 1
+                    monitor.handler_done(handler, bool(name))
+                    if name:
+                        num_success += 1
+                        msg = 'Finished {handler}, {done}/{total} jobs complete, {progress}'.format(
+                            handler=name,
+                            done=num_done,
+                            total=num_handlers,
+                            progress=monitor.summary())
+                    else:
+                        msg = 'Error running handler {}'.format(handler)
+                        print_message(msg, 'error')
+
+                    logger.info(msg)
+                    pbar.update(num_done)
+            pool_res = pending
+    except Exception as e:
+        print_debug(e)
+        terminate(pool)
+        monitor.finish('failed')
+        return 1
+    finally:
+        manager.shutdown()
+
+    pbar.finish()
+    terminate(pool)
+    monitor.finish()
+    print_message("{} of {} handlers complete".format(
+        num_success, num_handlers), 'ok')
+    return 0
+# ------------------------------------------------------------------
+
+
+def get_batch_size(mode, batch_remap=None):
+    """
+    The number of handlers run together so their datasets are remapped with
+    a single ncremap, only the MPAS handlers remap so the others run alone
+
+    Params:
+    -------
+        mode (str): what type of files to work with
+        batch_remap (int): the --batch-remap of the run
+    Returns:
+    --------
+        the number of handlers in each batch
+    """
+    if mode in ['atm', 'lnd', 'fx'] or not batch_remap:
+        return 1
+    return batch_remap
+# ------------------------------------------------------------------
+
+
+# the kinds of failure that may succeed when retried with less resources,
+# killed is a worker that died without reporting, i.e. from the OOM killer
+RETRY_ERRORS = ['memory', 'io', 'killed']
+
+# time steps per window when a retried handler had no time window
+RETRY_TIME_WINDOW = 12
+
+
+def get_error_kind(error):
+    """
+    Classify an exception raised by a handler as memory, io or error
+
+    Only I/O errors from the system are io, a missing file, or an IOError
+    raised by the code for a missing input, fails the same way every time
+    """
+    if isinstance(error, MemoryError):
+        return 'memory'
+    if isinstance(error, FileNotFoundError):
+        return 'error'
+    if isinstance(error, (IOError, OSError)):
+        if error.errno is None or error.errno == errno.ENOENT:
+            return 'error'
+        return 'io'
+    return 'error'
+# ------------------------------------------------------------------
+
+
+def downgrade_dask_backend(dask_backend, attempt):
+    """
+    Return a copy of the dask backend config with the chunk size and, for
+    the threaded backend, the number of threads halved for each attempt
+    """
+    if dask_backend is None:
+        return None
+    factor = 2 ** attempt
+    dask_backend = dict(dask_backend)
+    dask_backend['chunkBytes'] = max(
+        1024 ** 2, dask_backend['chunkBytes'] // factor)
+    if dask_backend['backend'] == 'threads':
+        num_workers = dask_backend.get('numWorkers') or multiprocessing.cpu_count()
+        dask_backend['numWorkers'] = max(1, num_workers // factor)
+    return dask_backend
+# ------------------------------------------------------------------
+
+
+def downgrade_handler_kwargs(handler_kwargs, attempt):
+    """
+    Return a copy of the keyword arguments of a handler with its time window
+    halved for each attempt, so handle_variables reads fewer time steps at once
+    """
+    handler_kwargs = dict(handler_kwargs)
+    time_window = handler_kwargs.get('time_window') or RETRY_TIME_WINDOW * 2
+    handler_kwargs['time_window'] = max(1, time_window // 2 ** attempt)
+    return handler_kwargs
+# ------------------------------------------------------------------
+
+
+class ProgressMonitor(object):
+    """
+    Collects the progress events the handlers publish with
+    util.publish_progress, and keeps the aggregate throughput, the ETA and
+    a machine readable status file up to date
+
+    Params:
+    -------
+        queue: the queue the workers publish their events on
+        num_handlers (int): the number of handlers in the run
+        status_file (str): path of the json status file, or None
+        interval (float): least number of seconds between status file writes
+    """
+
+    def __init__(self, queue, num_handlers, status_file=None, interval=5.0):
+        self.queue = queue
+        self.num_handlers = num_handlers
+        self.status_file = status_file
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_write = 0.0
+        self.running = dict()
+        self.pids = dict()
+        self.stragglers = set()
+        self.timed_out = list()
+        self.errors = dict()
+        self.timings = dict()
+        self.num_done = 0
+        self.num_failed = 0
+        self.num_files = 0
+        self.timesteps = 0
+        self.bytes = 0
+        self.write_status()
+
+    def poll(self, timeout=0):
+        """
+        Handle the events on the queue, waiting up to timeout seconds for
+        the first one
+        """
+        while True:
+            try:
+                if timeout:
+                    event = self.queue.get(timeout=timeout)
+                    timeout = 0
+                else:
+                    event = self.queue.get_nowait()
+            except Exception:
+                break
+            self.handle_event(event)
+        if time.time() - self.last_write >= self.interval:
+            self.write_status()
+
+    def handle_event(self, event):
+        name = event.get('handler')
+        kind = event.get('event')
+        if kind == 'start':
+            self.running[name] = event['time']
+            self.pids[name] = event.get('pid')
+        elif kind == 'chunk':
+            self.timesteps += event.get('timesteps', 0)
+            self.bytes += event.get('bytes', 0)
+        elif kind == 'file':
+            self.num_files += 1
+        elif kind == 'done':
+            self.running.pop(name, None)
+            self.pids.pop(name, None)
+            self.timings[name] = event.get('elapsed')
+            if event.get('error'):
+                self.errors[name] = event['error']
+
+    def handler_done(self, name, success):
+        """
+        Count a handler as done once its result is back in the parent
+        """
+        self.poll()
+        self.running.pop(name, None)
+        self.pids.pop(name, None)
+        self.num_done += 1
+        if not success:
+            self.num_failed += 1
+
+    def forget(self, name):
+        """
+        Stop tracking a handler whose worker was stopped, so it isn't found
+        dead again by check_workers
+        """
+        self.running.pop(name, None)
+        self.pids.pop(name, None)
+
+    def check_budgets(self, soft_timeout=None, hard_timeout=None):
+        """
+        Warn once about each handler running longer than soft_timeout
+        seconds, and find those running longer than hard_timeout
+
+        Returns:
+        --------
+            a list of (name, pid) of the handlers over their hard budget
+        """
+        now = time.time()
+        expired = list()
+        for name, started in self.running.items():
+            elapsed = now - started
+            if soft_timeout and elapsed > soft_timeout and name not in self.stragglers:
+                self.stragglers.add(name)
+                msg = '{} has been running for {:.0f} seconds'.format(name, elapsed)
+                print_message(msg, 'error')
+                logger.warning(msg)
+            if hard_timeout and elapsed > hard_timeout:
+                expired.append((name, self.pids.get(name)))
+        for name, _ in expired:
+            self.running.pop(name, None)
+            self.pids.pop(name, None)
+            self.timed_out.append(name)
+        return expired
+
+    def check_workers(self):
+        """
+        Find the handlers whose worker died without reporting they were done,
+        i.e. killed by the OOM killer
+
+        Returns:
+        --------
+            a list of the names of the handlers
+        """
+        dead = list()
+        for name, pid in self.pids.items():
+            if pid is None:
+                continue
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                dead.append(name)
+            except OSError:
+                pass
+        for name in dead:
+            self.running.pop(name, None)
+            self.pids.pop(name, None)
+            self.errors[name] = 'killed'
+        return dead
+
+    def get_status(self, state='running'):
+        elapsed = time.time() - self.start_time
+        eta = None
+        if self.num_done and self.num_done < self.num_handlers:
+            eta = elapsed / self.num_done * (self.num_handlers - self.num_done)
+        elif self.num_done == self.num_handlers:
+            eta = 0.0
+        return {
+            'state': state,
+            'handlers': {
+                'total': self.num_handlers,
+                'done': self.num_done,
+                'failed': self.num_failed,
+                'running': sorted(self.running.keys()),
+                'stragglers': sorted(self.stragglers),
+                'timed_out': self.timed_out,
+                'errors': self.errors
+            },
+            'files': self.num_files,
+            'timesteps': self.timesteps,
+            'bytes': self.bytes,
+            'elapsed': elapsed,
+            'timesteps_per_second': self.timesteps / elapsed if elapsed else 0.0,
+            'mb_per_second': self.bytes / 1024.0 ** 2 / elapsed if elapsed else 0.0,
+            'eta': eta,
+            'timings': self.timings,
+            'updated': time.time()
+        }
+
+    def summary(self):
+        """
+        A one line summary of the throughput and the ETA
+        """
+        status = self.get_status()
+        msg = '{:.1f} timesteps/s, {:.1f} MB/s'.format(
+            status['timesteps_per_second'], status['mb_per_second'])
+        if status['eta'] is not None:
+            minutes, seconds = divmod(int(status['eta']), 60)
+            hours, minutes = divmod(minutes, 60)
+            msg += ', ETA {:d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+        return msg
+
+    def write_status(self, state='running'):
+        """
+        Replace the status file in one step, so a monitor never reads a
+        partly written one
+        """
+        self.last_write = time.time()
+        if not self.status_file:
+            return
+        temp_path = '{}.{}.tmp'.format(self.status_file, os.getpid())
+        with open(temp_path, 'w') as outfile:
+            json.dump(self.get_status(state), outfile, indent=2)
+        os.replace(temp_path, self.status_file)
+
+    def finish(self, state='finished'):
+        self.poll()
+        self.write_status(state)
+# ------------------------------------------------------------------
+
+
+# message tags of the MPI backend
+_MPI_WORK = 1
+_MPI_RESULT = 2
+_MPI_STOP = 3
+
+
+def run_mpi(comm, handlers, input_path, tables_path, metadata_path,
+            map_path=None, mode='atm', **kwargs):
+    """
+    Run the handlers across the ranks of an MPI communicator. Rank 0 finds
+    the inputs and hands out work units to the other ranks as they become
+    free, a unit is one atm or lnd input file of a handler, or a whole MPAS
+    or fx handler. Every rank must call this with the same handlers
+
+    Params:
+    -------
+        comm (mpi4py.MPI.Comm): the communicator of the run
+        handlers: a dict(str: (function_pointer, list(str) ) )
+        input_path (str): path to the input files directory
+        tables_path (str): path to the tables directory
+        metadata_path (str): path to the cmor input metadata
+        mode (str): what type of files to work with
+        dask_backend (dict): the dask backend from mpas.start_dask_backend
+            used by the MPAS handlers on each rank
+        incremental (str): new-files or append, to only convert the years
+            after the existing output in output_path
+    Returns:
+    --------
+        returns 1 if an error occurs, else 0
+    """
+    from mpi4py import MPI
+
+    if kwargs.get('dask_backend') is not None:
+        mpas.set_dask_backend(kwargs['dask_backend'])
+
+    if comm.Get_rank() != 0:
+        # the methods can't be sent between ranks, each rank has its own
+        methods = {handler['name']: handler['method'] for handler in handlers}
+        status = MPI.Status()
+        while True:
+            unit = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+            if status.Get_tag() == _MPI_STOP:
+                return 0
+            unit_id, args, _kwargs = unit
+            try:
+                name = methods[_kwargs['name']](*args, **_kwargs)
+            except Exception as error:
+                print_debug(error)
+                name = None
+            comm.send((unit_id, name), dest=0, tag=_MPI_RESULT)
+
+    calls = get_handler_calls(
+        handlers, input_path, tables_path, metadata_path, map_path, mode,
+        logdir=kwargs.get('logdir'),
+        time_window=kwargs.get('time_window'),
+        incremental=kwargs.get('incremental'),
+        output_path=kwargs.get('output_path'))
+
+    # split the atm and lnd handlers into one unit per input file, except when
+    # appending, since the units of a handler would append to the same file
+    units = list()
+    for call_index, (_, args, _kwargs) in enumerate(calls):
+        input_paths = args[0]
+        num_files = min(len(paths) for paths in input_paths.values())
+        if mode not in ['atm', 'lnd'] or _kwargs.get('append_to') \
+                or num_files <= 1:
+            units.append((call_index, args, _kwargs))
+            continue
+        for file_index in range(num_files):
+            segment = {var: [sorted(paths)[file_index]]
+                       for var, paths in input_paths.items()}
+            units.append((call_index, (segment,) + args[1:], _kwargs))
+
+    results = [True] * len(calls)
+    num_workers = comm.Get_size() - 1
+    if num_workers == 0:
+        # a single rank runs everything itself
+        for call_index, args, _kwargs in units:
+            try:
+                name = calls[call_index][0](*args, **_kwargs)
+            except Exception as error:
+                print_debug(error)
+                name = None
+            results[call_index] = results[call_index] and bool(name)
+    else:
+        msg = 'Running {} work units for {} handlers on {} ranks'.format(
+            len(units), len(calls), num_workers)
+        print_message(msg, 'ok')
+        logger.info(msg)
+
+        pbar = progressbar.ProgressBar(maxval=len(units))
+        pbar.start()
+        status = MPI.Status()
+        next_unit = 0
+        num_done = 0
+        # start a unit on every rank, then hand out the rest as they finish
+        for rank in range(1, num_workers + 1):
+            if next_unit < len(units):
+                comm.send((next_unit,) + units[next_unit][1:],
+                          dest=rank, tag=_MPI_WORK)
+                next_unit += 1
+            else:
+                comm.send(None, dest=rank, tag=_MPI_STOP)
+        while num_done < next_unit:
+            unit_id, name = comm.recv(source=MPI.ANY_SOURCE,
+                                      tag=_MPI_RESULT, status=status)
+            num_done += 1
+            call_index = units[unit_id][0]
+            results[call_index] = results[call_index] and bool(name)
+            pbar.update(num_done)
+
+            rank = status.Get_source()
+            if next_unit < len(units):
+                comm.send((next_unit,) + units[next_unit][1:],
+                          dest=rank, tag=_MPI_WORK)
+                next_unit += 1
+            else:
+                comm.send(None, dest=rank, tag=_MPI_STOP)
+        pbar.finish()
+
+    num_success = 0
+    for (_, _, _kwargs), success in zip(calls, results):
+        if success:
+            num_success += 1
+            msg = 'Finished {}'.format(_kwargs['name'])
         else:
-            input_paths = {var: find_mpas_files(var, input_path,
-                                                map_path)
-                           for var in handler_variables}
+            msg = 'Error running handler {}'.format(_kwargs['name'])
+            print_message(msg, 'error')
+        logger.info(msg)
+
+    print_message("{} of {} handlers complete".format(
+        num_success, len(calls)), 'ok')
+    return 0
+# ------------------------------------------------------------------
+
+
+def get_handler_calls(handlers, input_path, tables_path, metadata_path,
+                      map_path=None, mode='atm', serial=False, logdir=None,
+                      time_window=None, incremental=None, output_path=None):
+    """
+    Find the inputs of every handler and setup its arguments
+
+    Handlers with no new input years in incremental mode are reported as up
+    to date and left out
+
+    Returns:
+    --------
+        a list of (handler_method, args, kwargs) to call each handler with
+    """
+    # the output tree is walked once for all the handlers
+    index = None
+    if incremental:
+        index = index_cmip_output(output_path)
+
+    # the global ocean integrals of all the scalar handlers, computed in one
+    # pass by the first of them
+    ocean_integrals = sorted(set(
+        x for handler in handlers for x in handler.get('integrals') or []))
+
+    calls = list()
+    for handler in handlers:
+        input_paths = get_input_paths(handler, input_path, map_path, mode)
+
+        append_to = None
+        if incremental:
+            input_paths, append_to = get_incremental_inputs(
+                handler, input_paths, output_path, incremental, index)
+            if input_paths is None:
+                msg = '{} is up to date'.format(handler['name'])
+                print_message(msg, 'ok')
+                logger.info(msg)
+                continue
 
         # setup the input args for the handler
         _kwargs = {
@@ -50,47 +685,81 @@ def run_parallel(pool, handlers, input_path, tables_path, metadata_path,
             'units': handler.get('units'),
             'positive': handler.get('positive'),
             'name': handler.get('name'),
-            'logdir': kwargs.get('logdir')
+            'formula': handler.get('formula'),
+            'levels': handler.get('levels'),
+            'logdir': logdir,
+            'time_window': time_window,
+            'append_to': append_to,
+            'ocean_integrals': ocean_integrals
         }
+        if serial:
+            _kwargs['serial'] = True
 
-        pool_res.append(
-            pool.apipe(
-                handler_method,
-                input_paths,
-                tables_path,
-                metadata_path,
-                **_kwargs))
+        calls.append((handler['method'],
+                      (input_paths, tables_path, metadata_path),
+                      _kwargs))
+    return calls
+# ------------------------------------------------------------------
 
-    # wait for each result to complete
-    pbar = progressbar.ProgressBar(maxval=len(pool_res))
-    pbar.start()
-    num_success = 0
-    num_handlers = len(handlers)
 
-    for idx, res in enumerate(pool_res):
-        try:
-            out = res.get(9999999)
-            if out:
-                num_success += 1
-                msg = 'Finished {handler}, {done}/{total} jobs complete'.format(
-                    handler=out,
-                    done=idx + 1,
-                    total=num_handlers)
-            else:
-                msg = 'Error running handler {}'.format(handlers[idx]['name'])
-                print_message(msg, 'error')
+def run_handler(handler_method, dask_backend, progress_queue, *args, **kwargs):
+    """
+    Run a single handler in a worker, first pointing the worker at the dask
+    backend of the run if one is given, and publish its start and end on the
+    progress queue
+    """
+    if dask_backend is not None:
+        mpas.set_dask_backend(dask_backend)
+    set_progress_queue(progress_queue, kwargs.get('name'))
+    start = time.time()
+    publish_progress('start')
+    name = None
+    error = None
+    try:
+        name = handler_method(*args, **kwargs)
+    except Exception as e:
+        # classified so the scheduler knows if a retry could succeed
+        error = get_error_kind(e)
+        logger.exception('Error running handler {}'.format(kwargs.get('name')))
+    finally:
+        publish_progress('done', success=bool(name), error=error,
+                         elapsed=time.time() - start)
+        set_progress_queue(None)
+    return name
+# ------------------------------------------------------------------
 
-            logger.info(msg)
-            pbar.update(idx)
-        except Exception as e:
-            print_debug(e)
-            return 1
 
-    pbar.finish()
-    terminate(pool)
-    print_message("{} of {} handlers complete".format(
-        num_success, num_handlers), 'ok')
-    return 0
+def run_remap_batch(calls, dask_backend, progress_queue=None):
+    """
+    Run a batch of MPAS handlers in a worker with mpas.run_with_batched_remap,
+    first pointing the worker at the dask backend of the run if one is given.
+    The batch runs as one, so each of its handlers is timed as the whole
+    batch. The error of each handler is classified on its own, so one that
+    failed from a lack of memory can be retried alone
+    """
+    if dask_backend is not None:
+        mpas.set_dask_backend(dask_backend)
+    set_progress_queue(progress_queue)
+    start = time.time()
+    for _, _, kwargs in calls:
+        publish_progress('start', handler=kwargs.get('name'))
+    names = [None] * len(calls)
+    errors = list()
+    kinds = [None] * len(calls)
+    try:
+        names = mpas.run_with_batched_remap(calls, errors)
+        kinds = [get_error_kind(e) if e is not None else None
+                 for e in errors]
+    except Exception as e:
+        kinds = [get_error_kind(e)] * len(calls)
+        logger.exception('Error running a batch of handlers')
+    finally:
+        for (_, _, kwargs), name, kind in zip(calls, names, kinds):
+            publish_progress('done', handler=kwargs.get('name'),
+                             success=bool(name), error=kind,
+                             elapsed=time.time() - start)
+        set_progress_queue(None)
+    return names
 # ------------------------------------------------------------------
 
 
@@ -107,7 +776,9 @@ def my_dynamic_message(self, progress, data):
 
 
 def run_serial(handlers, input_path, tables_path, metadata_path, map_path=None,
-               mode='atm', logdir=None):
+               mode='atm', logdir=None, time_window=None, dask_backend=None,
+               batch_remap=None, incremental=None, output_path=None,
+               status_file=None, retries=None):
     """
     Run each of the handlers one at a time on the main process
 
@@ -118,77 +789,136 @@ def run_serial(handlers, input_path, tables_path, metadata_path, map_path=None,
         tables_path (str): path to the tables directory
         metadata_path (str): path to the cmor input metadata
         mode (str): what type of files to work with
+        dask_backend (dict): the dask backend from mpas.start_dask_backend
+            used by the MPAS handlers
+        batch_remap (int): number of MPAS handlers run together so their
+            datasets are remapped with a single ncremap
+        incremental (str): new-files or append, to only convert the years
+            after the existing output in output_path
+        output_path (str): the root of the CMIP output tree
+        status_file (str): path of a json file kept up to date with the
+            progress of the run
+        retries (int): times a handler that failed from a lack of memory or
+            an I/O error is run again with smaller chunks, time windows and
+            fewer dask threads
     Returns:
     --------
         returns 1 if an error occurs, else 0
     """
+    monitor = None
     try:
+        if dask_backend is not None:
+            mpas.set_dask_backend(dask_backend)
 
-        num_handlers = len(handlers)
         num_success = 0
 
         if mode != 'atm':
             pbar = progressbar.ProgressBar(maxval=len(handlers))
             pbar.start()
 
-        for idx, handler in enumerate(handlers):
-
-            handler_method = handler['method']
-            handler_variables = handler['raw_variables']
-
-            # find the input files this handler needs
-            if mode in ['atm', 'lnd']:
-
-                input_paths = {var: [os.path.join(input_path, x) for x in
-                                     find_atm_files(var, input_path)]
-                               for var in handler_variables}
-            elif mode == 'fx':
-                input_paths = {var: [x for x in os.listdir(input_path) if x[-3:] == '.nc']
-                               for var in handler_variables}
+        calls = get_handler_calls(
+            handlers, input_path, tables_path, metadata_path, map_path, mode,
+            serial=True,
+            logdir=logdir,
+            time_window=time_window,
+            incremental=incremental,
+            output_path=output_path)
+
+        num_handlers = len(calls)
+
+        # the handlers publish their progress on an in-process queue
+        queue = Queue()
+        monitor = ProgressMonitor(queue, num_handlers, status_file=status_file)
+
+        # with batch_remap, groups of MPAS handlers run together so their
+        # datasets can be remapped at once
+        batch_remap = get_batch_size(mode, batch_remap)
+
+        for start in range(0, len(calls), batch_remap):
+            batch = calls[start: start + batch_remap]
+            if len(batch) == 1:
+                method, args, _kwargs = batch[0]
+                names = [run_handler(method, None, queue, *args, **_kwargs)]
             else:
-                input_paths = {var: find_mpas_files(var, input_path,
-                                                    map_path)
-                               for var in handler_variables}
-
-            name = handler_method(
-                input_paths,
-                tables_path,
-                metadata_path,
-                raw_variables=handler.get('raw_variables'),
-                units=handler.get('units'),
-                name=handler.get('name'),
-                table=handler.get('table'),
-                positive=handler.get('positive'),
-                serial=True,
-                logdir=logdir)
-
-            if name is not None:
-                num_success += 1
-                msg = 'Finished {handler}, {done}/{total} jobs complete'.format(
-                    handler=name,
-                    done=num_success,
-                    total=num_handlers)
-            else:
-                msg = 'Error running handler {}'.format(handler['name'])
-                print_message(msg, 'error')
-            logger.info(msg)
+                names = run_remap_batch(batch, None, queue)
+
+            for idx, name in enumerate(names, start):
+                # handlers that failed from a lack of memory or an I/O error
+                # are run again with less resources
+                method, args, _kwargs = calls[idx]
+                for attempt in range(1, (retries or 0) + 1):
+                    monitor.poll()
+                    error = monitor.errors.pop(_kwargs['name'], None)
+                    if name or error not in RETRY_ERRORS:
+                        break
+                    msg = '{} failed with a {} error, retrying with less resources'.format(
+                        _kwargs['name'], error)
+                    print_message(msg, 'error')
+                    logger.warning(msg)
+                    name = run_handler(
+                        method, downgrade_dask_backend(dask_backend, attempt),
+                        queue, *args,
+                        **downgrade_handler_kwargs(_kwargs, attempt))
+                if dask_backend is not None:
+                    mpas.set_dask_backend(dask_backend)
+
+                monitor.handler_done(calls[idx][2]['name'], bool(name))
+                if name is not None:
+                    num_success += 1
+                    msg = 'Finished {handler}, {done}/{total} jobs complete, {progress}'.format(
+                        handler=name,
+                        done=num_success,
+                        total=num_handlers,
+                        progress=monitor.summary())
+                else:
+                    msg = 'Error running handler {}'.format(calls[idx][2]['name'])
+                    print_message(msg, 'error')
+                logger.info(msg)
 
-            if mode != 'atm':
-                pbar.update(idx)
+                if mode != 'atm':
+                    pbar.update(idx)
         if mode != 'atm':
             pbar.finish()
 
     except Exception as error:
         print_debug(error)
+        if monitor is not None:
+            monitor.finish('failed')
         return 1
     else:
+        monitor.finish()
         print_message("{} of {} handlers complete".format(
             num_success, num_handlers), 'ok')
         return 0
 # ------------------------------------------------------------------
 
 
-def handle_variables(infiles, raw_variables, write_data, outvar_name, outvar_units, table, tables, metadata_path, serial=None, positive=None, levels=None, axis=None, logdir=None):
+def handle_variables(infiles, raw_variables, write_data, outvar_name, outvar_units, table, tables, metadata_path, serial=None, positive=None, levels=None, axis=None, logdir=None, dtype=None, block_size=None, reduce_axis=None, time_window=None, append_to=None):
+    """
+    Load the input files for each of the raw variables, setup the CMOR axes
+    and variable, and call write_data once for every time step
+
+    If dtype is given the raw variables are converted once per file into
+    contiguous arrays of that type, with masked points set to FILL_VALUE,
+    and a preallocated output buffer is passed to write_data as the "out"
+    keyword argument
+
+    If block_size is given write_data is called once per block of that many
+    time steps instead, with index as a slice over the time axis and timeval
+    and timebnds holding the values for the whole block
+
+    Handlers that reduce their inputs over an axis, like a vertical sum, set
+    reduce_axis to the index of that axis in the input arrays so that the
+    output buffer is allocated without it
+
+    If time_window is given each input file is read and written in windows
+    of that many time steps, so memory use doesn't depend on the length of
+    the input files
+
+    If append_to is the path of an existing output file, CMOR appends the new
+    time steps to it, which write_data does by passing its file_suffix
+    keyword argument on to cmor.write
+    """
 
     from e3sm_to_cmip.util import print_message
     logger = logging.getLogger()
@@ -216,15 +946,8 @@ def handle_variables(infiles, raw_variables, write_data, outvar_name, outvar_uni
         logpath = os.path.join(outpath, 'cmor_logs')
     os.makedirs(logpath, exist_ok=True)
 
-    logfile = os.path.join(logpath, outvar_name + '.log')
-
-    cmor.setup(
-        inpath=tables,
-        netcdf_file_action=cmor.CMOR_REPLACE,
-        logfile=logfile)
-
-    cmor.dataset_json(str(metadata_path))
-    cmor.load_table(str(table))
+    setup_cmor(outvar_name, tables, table, metadata_path, logdir=logpath,
+               append=append_to is not None)
 
     msg = '{}: CMOR setup complete'.format(outvar_name)
     logging.info(msg)
@@ -238,90 +961,249 @@ def handle_variables(infiles, raw_variables, write_data, outvar_name, outvar_uni
     for var_name in raw_variables:
         infiles[var_name].sort()
 
-    for index in range(num_files_per_variable):
-
-        # reload the dimensions for each time slice
-        get_dims = True
+    # reusable output buffer for the typed path
+    outbuf = None
 
-        # load data for each variable
-        for var_name in raw_variables:
+    for file_index in range(num_files_per_variable):
 
-            # extract data from the input file
-            msg = '{name}: loading {variable}'.format(
-                name=outvar_name,
-                variable=var_name)
+        # split the file into windows of time steps that are read and
+        # written one at a time, or read the whole file at once
+        if time_window:
+            num_file_times = get_num_times(infiles[raw_variables[0]][file_index])
+            windows = [slice(start, min(start + time_window, num_file_times))
+                       for start in range(0, num_file_times, time_window)]
+        else:
+            windows = [None]
+
+        for window_index, time_slice in enumerate(windows):
+
+            # reload the dimensions for each time slice
+            get_dims = True
+
+            # load data for each variable
+            for var_name in raw_variables:
+
+                # extract data from the input file
+                msg = '{name}: loading {variable}'.format(
+                    name=outvar_name,
+                    variable=var_name)
+                logger.info(msg)
+
+                new_data = get_dimension_data(
+                    filename=infiles[var_name][file_index],
+                    variable=var_name,
+                    levels=levels,
+                    get_dims=get_dims,
+                    time_slice=time_slice)
+                data.update(new_data)
+                get_dims = False
+
+            if dtype is not None:
+                data['mask'] = cast_raw_variables(data, raw_variables, dtype)
+                shape = data[raw_variables[0]].shape
+                if reduce_axis is not None:
+                    shape = shape[:reduce_axis] + shape[reduce_axis + 1:]
+                shape = shape[1:]
+                if block_size:
+                    shape = (block_size,) + shape
+                if outbuf is None or outbuf.shape != shape:
+                    outbuf = np.empty(shape, dtype=dtype)
+
+            # the axes and variable are created once per file, the data for
+            # each window is appended along the time axis
+            if window_index == 0:
+                msg = '{name}: loading axes'.format(name=outvar_name)
+                logger.info(msg)
+
+                # create the cmor variable and axis
+                axis_ids, ips = load_axis(data=data, levels=levels)
+
+                if ips:
+                    data['ips'] = ips
+
+                varkwargs = dict()
+                if positive:
+                    varkwargs['positive'] = positive
+                if dtype is not None:
+                    varkwargs['missing_value'] = FILL_VALUE
+                varid = cmor.variable(outvar_name, outvar_units,
+                                      axis_ids, **varkwargs)
+                apply_output_policy(varid, outvar_name, table)
+
+            # write out the data
+            msg = "{}: time {:1.1f} - {:1.1f}".format(
+                outvar_name,
+                data['time_bnds'][0][0],
+                data['time_bnds'][-1][-1])
             logger.info(msg)
 
-            new_data = get_dimension_data(
-                filename=infiles[var_name][index],
-                variable=var_name,
-                levels=levels,
-                get_dims=get_dims)
-            data.update(new_data)
-            get_dims = False
+            if serial:
+                myMessage = progressbar.DynamicMessage('running')
+                myMessage.__call__ = my_dynamic_message
+                widgets = [
+                    progressbar.DynamicMessage('running'), ' [',
+                    progressbar.Timer(), '] ',
+                    progressbar.Bar(),
+                    ' (', progressbar.ETA(), ') '
+                ]
+                progressbar.DynamicMessage.__call__ = my_dynamic_message
+                pbar = progressbar.ProgressBar(
+                    maxval=len(data['time']), widgets=widgets)
+                pbar.start()
+
+            num_times = len(data['time'])
+            for start in range(0, num_times, block_size or 1):
+                if serial:
+                    pbar.update(start, running=msg)
+                if block_size:
+                    index = slice(start, min(start + block_size, num_times))
+                    timeval = data['time'][index]
+                    timebnds = data['time_bnds'][index, :]
+                    out = outbuf[:index.stop - index.start] if outbuf is not None else None
+                else:
+                    index = start
+                    timeval = data['time'][index]
+                    timebnds = [data['time_bnds'][index, :]]
+                    out = outbuf
+                write_data(
+                    varid=varid,
+                    data=data,
+                    timeval=timeval,
+                    timebnds=timebnds,
+                    index=index,
+                    raw_variables=raw_variables,
+                    out=out,
+                    file_suffix=append_to or '')
+            if serial:
+                pbar.finish()
+            publish_progress(
+                'chunk',
+                timesteps=num_times,
+                bytes=sum(data[var_name].nbytes for var_name in raw_variables))
+
+        if append_to is not None:
+            # CMOR renames the file for its new date range on close
+            append_to = cmor.close(varid, file_name=True)
+        else:
+            cmor.close(varid)
+        publish_progress('file', file=infiles[raw_variables[0]][file_index])
+
+    msg = '{}: write complete, closing'.format(outvar_name)
+    logger.debug(msg)
 
-        msg = '{name}: loading axes'.format(name=outvar_name)
-        logger.info(msg)
+    msg = '{}: file close complete'.format(outvar_name)
+    logger.debug(msg)
 
-        # create the cmor variable and axis
-        axis_ids, ips = load_axis(data=data, levels=levels)
+    return outvar_name
+# ------------------------------------------------------------------
 
-        if ips:
-            data['ips'] = ips
 
-        if positive:
-            varid = cmor.variable(outvar_name, outvar_units,
-                                  axis_ids, positive=positive)
-        else:
-            varid = cmor.variable(outvar_name, outvar_units, axis_ids)
+def cast_raw_variables(data, raw_variables, dtype=np.float32):
+    """
+    Replace each of the raw variables in the data dict with a contiguous
+    numpy array of the given dtype. Masked points are set to FILL_VALUE so
+    the arrays can be handed to CMOR without any further conversion.
 
-        # write out the data
-        msg = "{}: time {:1.1f} - {:1.1f}".format(
-            outvar_name,
-            data['time_bnds'][0][0],
-            data['time_bnds'][-1][-1])
-        logger.info(msg)
+    Params:
+    -------
+        data (dict): the loaded data, as returned by get_dimension_data
+        raw_variables (list(str)): the names of the variables to convert
+        dtype (numpy.dtype): the type to convert to
+    Returns:
+    --------
+        the union of the input masks, or None if no points are masked
+    """
+    mask = None
+    for var_name in raw_variables:
+        values = np.ascontiguousarray(np.ma.getdata(data[var_name]), dtype=dtype)
+        var_mask = np.ma.getmask(data[var_name])
+        if var_mask is not np.ma.nomask and var_mask.any():
+            values[var_mask] = FILL_VALUE
+            if mask is None:
+                mask = var_mask
+            else:
+                mask = np.logical_or(mask, var_mask)
+        data[var_name] = values
+    return mask
+# ------------------------------------------------------------------
 
-        if serial:
-            myMessage = progressbar.DynamicMessage('running')
-            myMessage.__call__ = my_dynamic_message
-            widgets = [
-                progressbar.DynamicMessage('running'), ' [',
-                progressbar.Timer(), '] ',
-                progressbar.Bar(),
-                ' (', progressbar.ETA(), ') '
-            ]
-            progressbar.DynamicMessage.__call__ = my_dynamic_message
-            pbar = progressbar.ProgressBar(
-                maxval=len(data['time']), widgets=widgets)
-            pbar.start()
 
-        for index, val in enumerate(data['time']):
-            if serial:
-                pbar.update(index, running=msg)
-            write_data(
-                varid=varid,
-                data=data,
-                timeval=val,
-                timebnds=[data['time_bnds'][index, :]],
-                index=index,
-                raw_variables=raw_variables)
-        if serial:
-            pbar.finish()
+def fill_masked(out, data, index):
+    """
+    Reset the masked points of a computed output array to FILL_VALUE, using
+    the mask created by cast_raw_variables
 
-    msg = '{}: write complete, closing'.format(outvar_name)
-    logger.debug(msg)
+    Params:
+    -------
+        out (numpy.ndarray): the computed data for one time step or block
+        data (dict): the loaded data, including the "mask" entry
+        index (int or slice): the time index of the output data
+    Returns:
+    --------
+        the output array
+    """
+    mask = data.get('mask')
+    if mask is not None:
+        np.copyto(out, FILL_VALUE, where=mask[index])
+    return out
+# ------------------------------------------------------------------
 
-    cmor.close()
 
-    msg = '{}: file close complete'.format(outvar_name)
-    logger.debug(msg)
+def vertical_sum(data, raw_variables, index, out, cap=None):
+    """
+    Sum the raw variables over their vertical axis (the axis after time) for
+    a block of time steps, accumulating one level at a time into out so no
+    full size temporaries are created. Masked points don't contribute to the
+    sum, and columns that are masked at every level are set to FILL_VALUE
 
-    return outvar_name
+    Params:
+    -------
+        data (dict): the loaded data, as returned by cast_raw_variables
+        raw_variables (list(str)): the names of the variables to sum
+        index (slice): the time steps to sum
+        out (numpy.ndarray): the output array, shaped (time, lat, lon)
+        cap (float): optional upper limit for the summed values
+    Returns:
+    --------
+        the output array
+    """
+    mask = data.get('mask')
+    if mask is not None:
+        mask = mask[index]
+
+    out[...] = 0.0
+    for var_name in raw_variables:
+        values = data[var_name][index]
+        for level in range(values.shape[1]):
+            if mask is None:
+                np.add(out, values[:, level], out=out)
+            else:
+                np.add(out, values[:, level], out=out,
+                       where=np.logical_not(mask[:, level]))
+
+    if cap is not None:
+        np.minimum(out, cap, out=out)
+    if mask is not None:
+        np.copyto(out, FILL_VALUE, where=mask.all(axis=1))
+    return out
+# ------------------------------------------------------------------
+
+
+def get_num_times(filename):
+    """
+    Returns the number of time steps in a file without reading its data
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError("File not found: {}".format(filename))
+    f = cdms2.open(filename)
+    try:
+        return len(f.getAxis('time'))
+    finally:
+        f.close()
 # ------------------------------------------------------------------
 
 
-def get_dimension_data(filename, variable, levels=None, get_dims=False):
+def get_dimension_data(filename, variable, levels=None, get_dims=False, time_slice=None):
     """
     Returns a list of data, along with the dimension and dimension bounds
     for a given lis of variables, with the option for vertical levels.
@@ -332,6 +1214,8 @@ def get_dimension_data(filename, variable, levels=None, get_dims=False):
         variable: (str): then name of the variable to load
         levels (bool): return verticle information
         get_dims (bool): is dimension data should be loaded too
+        time_slice (slice): optional range of time indices to load, the
+            whole file is loaded if not given
     Returns:
 
         {
@@ -352,12 +1236,17 @@ def get_dimension_data(filename, variable, levels=None, get_dims=False):
     data = dict()
 
     if not os.path.exists(filename):
-        raise IOError("File not found: {}".format(filename))
+        raise FileNotFoundError("File not found: {}".format(filename))
 
     f = cdms2.open(filename)
 
+    def read(name):
+        if time_slice is None:
+            return f(name)
+        return f(name, time=time_slice)
+
     # load the data for each variable
-    variable_data = f(variable)
+    variable_data = read(variable)
 
     # load
     data.update({
@@ -377,7 +1266,7 @@ def get_dimension_data(filename, variable, levels=None, get_dims=False):
             'lon_bnds': f('lon_bnds'),
             'time': variable_data.getTime(),
             'time2': variable_data.getTime(),
-            'time_bnds': f(time_bounds_name)
+            'time_bnds': read(time_bounds_name)
         })
 
         try:
@@ -395,7 +1284,7 @@ def get_dimension_data(filename, variable, levels=None, get_dims=False):
                 data.update({
                     'lev': f.getAxis('lev')[:]/1000,
                     'ilev': f.getAxis('ilev')[:]/1000,
-                    'ps': f('PS'),
+                    'ps': read('PS'),
                     'p0': f('P0'),
                     'hyam': f('hyam'),
                     'hyai': f('hyai'),
@@ -415,8 +1304,12 @@ def get_dimension_data(filename, variable, levels=None, get_dims=False):
                         data[bnds] = f.getAxis(bnds)[:]
                     elif bnds in f.variables.keys():
                         data[bnds] = f(bnds)[:]
+                    elif bnds == 'levgrnd_bnds':
+                        # the land model doesnt write out its level bounds
+                        data[bnds] = get_levgrnd_bnds()
                     else:
                         raise IOError("Unable to find e3sm_axis_bnds")
+    f.close()
     return data
 # ------------------------------------------------------------------
 
@@ -5,6 +5,7 @@ Utilities related to converting MPAS-Ocean and MPAS-Seaice files to CMOR
 from __future__ import absolute_import, division, print_function
 
 import re
+import glob
 import numpy as np
 import netCDF4
 from datetime import datetime
@@ -13,22 +14,311 @@ import xarray
 import os
 import cmor
 import subprocess
-import tempfile
 import logging
 import argparse
+import fcntl
+import hashlib
+import importlib.util
+import tempfile
+import threading
+from collections import OrderedDict
 from dask.diagnostics import ProgressBar
+from dask.utils import parse_bytes
 import dask
 import multiprocessing
-from multiprocessing.pool import ThreadPool
+
+from e3sm_to_cmip import util
+
+
+# the hash of the code of this module, part of every result cache key
+_codeKey = {'key': None}
+
+# the batch request of a handler running under run_with_batched_remap, set
+# per handler thread
+_remap_batch = threading.local()
 
 
 def remap(ds, mappingFileName, threshold=0.05):
-    '''Use ncreamp to remap the xarray Dataset to a new target grid'''
+    '''
+    Use ncreamp to remap the xarray Dataset to a new target grid
+
+    The Dataset may still be lazy, in which case the selection, masking and
+    depth steps before the remap are evaluated once, chunk by chunk, as the
+    temporary file is written. The remapped result is loaded once and
+    normalized by the remapped cellMask in place
+
+    In a handler run by run_with_batched_remap the call is deferred until the
+    datasets of all the handlers in the batch can be remapped together
+
+    The result is taken from the result cache when the same Dataset was
+    remapped with the same mapping file before
+    '''
+    keyParts = ['remap', dask.base.tokenize(ds),
+                get_files_key([mappingFileName]), str(threshold)]
+
+    def compute():
+        request = getattr(_remap_batch, 'request', None)
+        if request is not None and request['state'] == 'running':
+            return _defer_remap(request, ds, mappingFileName, threshold)
+        return _normalize_remapped(_ncremap(ds, mappingFileName), threshold)
+
+    return get_cached_result(keyParts, compute)
+
+
+def get_cached_result(keyParts, compute):
+    '''
+    Return the Dataset computed by compute() from the result cache, computing
+    and adding it if it isn't there yet. Without a result cache compute() is
+    just called.
+
+    The key is made from keyParts, which must identify the inputs of the
+    computation (i.e. with get_files_key or dask.base.tokenize), and from the
+    code of this module. The results are deflated netCDF files named by the
+    key, evicted least recently used first once the cache is over its size.
+    A file lock makes handlers in other processes that need the same result
+    wait for it instead of repeating the work
+    '''
+    cacheDir = _resultCache['path']
+    if cacheDir is None:
+        return compute()
+
+    key = hashlib.sha1(_get_code_key().encode('utf-8'))
+    for part in keyParts:
+        key.update(str(part).encode('utf-8'))
+    cacheFileName = os.path.join(cacheDir, '{}.nc'.format(key.hexdigest()))
+
+    with open(cacheFileName + '.lock', 'w') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(cacheFileName):
+                logging.info('Using cached result {}'.format(cacheFileName))
+                # mark it as recently used
+                os.utime(cacheFileName, None)
+                with xarray.open_dataset(cacheFileName,
+                                         decode_times=False) as ds:
+                    ds.load()
+                return ds
+
+            ds = compute()
+            # write then rename, so a partial file is never used
+            write_netcdf(ds, cacheFileName + '.tmp', compress=True)
+            os.rename(cacheFileName + '.tmp', cacheFileName)
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    _evict_results(cacheDir, _resultCache['maxBytes'])
+    return ds
+
+
+def _get_code_key():
+    '''A key that changes when the code of this module changes'''
+    if _codeKey['key'] is None:
+        with open(__file__.replace('.pyc', '.py'), 'rb') as sourceFile:
+            _codeKey['key'] = hashlib.sha1(sourceFile.read()).hexdigest()
+    return _codeKey['key']
+
+
+def _evict_results(cacheDir, maxBytes):
+    '''Remove the least recently used results until the cache fits'''
+    if maxBytes is None:
+        return
+    results = list()
+    for fileName in glob.glob(os.path.join(cacheDir, '*.nc')):
+        try:
+            stat = os.stat(fileName)
+        except OSError:
+            continue
+        results.append((stat.st_mtime, stat.st_size, fileName))
+    totalBytes = sum([size for _, size, _ in results])
+    for _, size, fileName in sorted(results):
+        if totalBytes <= maxBytes:
+            break
+        try:
+            os.remove(fileName)
+        except OSError:
+            continue
+        logging.info('Evicted cached result {}'.format(fileName))
+        totalBytes -= size
+
+
+def remap_datasets(datasets, mappingFileName, threshold=0.05):
+    '''
+    Remap several xarray Datasets with the same dimensions and time axis in a
+    single ncremap call, returning the remapped Datasets in the same order
+    '''
+    if len(datasets) == 1:
+        # not through remap, the handler that deferred it already holds the
+        # result cache lock for this dataset
+        remapped = _ncremap(datasets[0], mappingFileName)
+        return [_normalize_remapped(remapped, threshold)]
+
+    # give the variables of each dataset unique names, the time bounds are
+    # the same for all of them
+    merged = xarray.Dataset()
+    renames = list()
+    for index, ds in enumerate(datasets):
+        names = dict()
+        for varName in ds.data_vars:
+            if varName == 'time_bnds':
+                if index == 0:
+                    merged[varName] = ds[varName]
+                continue
+            newName = '{}_{}'.format(varName, index)
+            merged[newName] = ds[varName]
+            names[newName] = varName
+        renames.append(names)
+
+    remapped = _ncremap(merged, mappingFileName)
+
+    renamed = set()
+    for names in renames:
+        renamed.update(names.keys())
+    shared = [varName for varName in remapped.data_vars
+              if varName not in renamed]
+
+    result = list()
+    for names in renames:
+        ds = remapped[list(names.keys())].rename(names)
+        for varName in shared:
+            ds[varName] = remapped[varName].copy()
+        result.append(_normalize_remapped(ds, threshold))
+    return result
+
+
+def run_with_batched_remap(calls, errors=None):
+    '''
+    Run handlers in threads, one at a time, deferring their calls to remap.
+    The deferred datasets that share a mapping file, dimensions and time axis
+    are remapped with a single ncremap, then each handler is resumed in turn
+    to write its output. Only one handler runs at any time, so the handlers
+    still use CMOR one after the other.
+
+    Params:
+    -------
+        calls (list): (handler_method, args, kwargs) for each handler
+        errors (list): if given, filled with the exception each handler
+            raised, or None, so the caller can retry the handlers on their own
+    Returns:
+    --------
+        the list of the values returned by the handlers, None for a handler
+        that raised an exception
+    '''
+    condition = threading.Condition()
+    requests = list()
+    threads = list()
+    for method, args, kwargs in calls:
+        request = {'state': 'running',
+                   'condition': condition,
+                   'result': None,
+                   'remapped': None,
+                   'error': None,
+                   'exception': None}
+        requests.append(request)
+        thread = threading.Thread(target=_run_batched_handler,
+                                  args=(request, method, args, kwargs))
+        threads.append(thread)
+        thread.start()
+        # run the handler until it finishes or waits for its remap
+        with condition:
+            while request['state'] == 'running':
+                condition.wait()
+
+    waiting = [request for request in requests
+               if request['state'] == 'waiting']
+
+    groups = OrderedDict()
+    for request in waiting:
+        ds = request['ds']
+        if 'time' in ds.coords:
+            times = ds.time.values.tobytes()
+        else:
+            times = None
+        key = (request['mappingFileName'], request['threshold'],
+               tuple(sorted(ds.dims.items())), times)
+        groups.setdefault(key, list()).append(request)
+
+    for group in groups.values():
+        msg = 'Remapping {} datasets with {}'.format(
+            len(group), group[0]['mappingFileName'])
+        logging.info(msg)
+        try:
+            remapped = remap_datasets(
+                [request['ds'] for request in group],
+                group[0]['mappingFileName'],
+                group[0]['threshold'])
+        except Exception as error:
+            for request in group:
+                request['error'] = error
+        else:
+            for request, ds in zip(group, remapped):
+                request['remapped'] = ds
+        for request in group:
+            request['ds'] = None
+
+    # resume the handlers one at a time
+    for request in waiting:
+        with condition:
+            request['state'] = 'released'
+            condition.notify_all()
+            while request['state'] != 'done':
+                condition.wait()
+
+    for thread in threads:
+        thread.join()
+    if errors is not None:
+        errors.extend(request['exception'] for request in requests)
+    return [request['result'] for request in requests]
+
+
+def _run_batched_handler(request, method, args, kwargs):
+    condition = request['condition']
+    _remap_batch.request = request
+    try:
+        request['result'] = method(*args, **kwargs)
+    except Exception as error:
+        request['exception'] = error
+        logging.exception('Error running handler {}'.format(method))
+    finally:
+        _remap_batch.request = None
+        with condition:
+            request['state'] = 'done'
+            condition.notify_all()
+
+
+def _defer_remap(request, ds, mappingFileName, threshold):
+    condition = request['condition']
+    with condition:
+        request['ds'] = ds
+        request['mappingFileName'] = mappingFileName
+        request['threshold'] = threshold
+        request['state'] = 'waiting'
+        condition.notify_all()
+        while request['state'] != 'released':
+            condition.wait()
+    if request['error'] is not None:
+        raise request['error']
+    ds = request['remapped']
+    request['remapped'] = None
+    return ds
+
+
+def _ncremap(ds, mappingFileName):
+    '''Write the Dataset to a temp file, remap it and load the result'''
 
     # write the dataset to a temp file
-    inFileName = _get_temp_path()
-    outFileName = _get_temp_path()
+    inFileName = util.get_scratch_file()
+    outFileName = util.get_scratch_file()
+    try:
+        ds = _run_ncremap(ds, mappingFileName, inFileName, outFileName)
+    finally:
+        # remove the temporary files, even if ncremap failed
+        util.release_scratch_file(inFileName)
+        util.release_scratch_file(outFileName)
+
+    return ds
 
+
+def _run_ncremap(ds, mappingFileName, inFileName, outFileName):
     if 'depth' in ds.dims:
         ds = ds.transpose('time', 'depth', 'nCells', 'nbnd')
 
@@ -60,24 +350,43 @@ def remap(ds, mappingFileName, threshold=0.05):
         ds = ds.transpose('time', 'depth', 'lat', 'lon', 'nbnd')
 
     ds.load()
+    ds.close()
+
+    return ds
+
 
+def _normalize_remapped(ds, threshold):
+    '''Mask and normalize the remapped variables by the remapped cellMask'''
     if 'cellMask' in ds:
         mask = ds['cellMask'] > threshold
+        # the norm is NaN outside the mask, so a single multiply both masks
+        # and normalizes
         norm = 1./ds['cellMask'].where(mask)
         ds = ds.drop('cellMask')
         for varName in ds.data_vars:
             var = ds[varName]
             # make sure all of the mask dimensions are in the variable
             if all([dim in var.dims for dim in mask.dims]):
-                ds[varName] = ds[varName].where(mask)*norm
-
-    # remove the temporary files
-    os.remove(inFileName)
-    os.remove(outFileName)
+                if np.issubdtype(var.dtype, np.floating):
+                    values = var.values
+                    np.multiply(values, _broadcast_to_dims(norm, var.dims),
+                                out=values)
+                else:
+                    ds[varName] = var.where(mask)*norm
 
     return ds
 
 
+def _broadcast_to_dims(da, dims):
+    '''
+    Get the values of a DataArray reshaped so they broadcast against an array
+    with the given dimensions
+    '''
+    da = da.transpose(*[dim for dim in dims if dim in da.dims])
+    shape = [da.sizes[dim] if dim in da.dims else 1 for dim in dims]
+    return da.values.reshape(shape)
+
+
 def avg_to_mid_level(ds):
     dsNew = xarray.Dataset()
     for varName in ds.data_vars:
@@ -215,42 +524,361 @@ def get_sea_floor_values(ds, dsMesh):
 
     ds = ds.copy()
     cellMask2D = dsMesh.maxLevelCell > 0
-    nVertLevels = dsMesh.sizes['nVertLevels']
 
     # zero-based indexing in python
     maxLevelCell = dsMesh.maxLevelCell - 1
 
-    vertIndex = \
-        xarray.DataArray.from_dict({'dims': ('nVertLevels',),
-                                    'data': np.arange(nVertLevels)})
-
     for varName in ds.data_vars:
         if 'nVertLevels' not in ds[varName].dims or \
                 'nCells' not in ds[varName].dims:
             continue
 
-        # mask only the values with the right vertical index
-        ds[varName] = ds[varName].where(maxLevelCell == vertIndex)
+        ds[varName] = get_level_values(ds[varName],
+                                       maxLevelCell).where(cellMask2D)
 
-        # Each vertical layer has at most one non-NaN value so the "sum"
-        # over the vertical is used to collapse the array in the vertical
-        # dimension
-        ds[varName] = ds[varName].sum(dim='nVertLevels').where(cellMask2D)
+    return ds
+
+
+def get_level_values(da, levelIndex, dim='nVertLevels'):
+    '''
+    Gather the value at the given vertical level of each column, for example
+    the sea floor with levelIndex = maxLevelCell - 1. levelIndex is a
+    zero-based DataArray over the horizontal dimension, indices out of range
+    are clipped and should be masked by the caller. Only one value per column
+    is read from each chunk, no masked 3D array is built
+    '''
+
+    def _gather(values, indices):
+        # the vertical dimension was moved last by apply_ufunc
+        indices = np.clip(indices, 0, values.shape[-1] - 1)
+        indices = np.broadcast_to(indices, values.shape[:-1])
+        return np.take_along_axis(values, indices[..., np.newaxis],
+                                  axis=-1)[..., 0]
+
+    return xarray.apply_ufunc(_gather, da, levelIndex,
+                              input_core_dims=[[dim], []],
+                              dask='parallelized',
+                              output_dtypes=[da.dtype])
+
+
+# the global ocean integrals of get_ocean_integrals, with the MPASO tracers
+# each one needs besides the layer thickness
+OCEAN_INTEGRALS = {
+    'volume': [],
+    'temperatureVolume': ['temperature'],
+    'salinityVolume': ['salinity'],
+    'area': None,
+    'surfaceTemperatureArea': ['temperature'],
+    'surfaceSalinityArea': ['salinity']
+}
+
+
+def get_ocean_integrals(timeSeriesFiles, meshFileName, fields=None,
+                        runFields=None):
+    '''
+    Compute the global ocean integrals used by the scalar handlers (soga,
+    thetaoga, volo, masso, sosga and tosga) in a single pass over the MPASO
+    files. The result holds, per time step, the fields asked for among the
+    ocean volume, the volume integrals of temperature and salinity, the ocean
+    surface area and the area integrals of the sea surface temperature and
+    salinity, by default all of them.
+
+    runFields are the fields of all the scalar handlers of the run. The first
+    handler computes them all in one pass, reading only the MPASO variables
+    they need, and the others are served from its result, so a run of volo
+    alone reads just the layer thickness while a run of all six reads the 3D
+    fields once.
+
+    The integrals are cached in the temp directory of the run, a file lock
+    makes handlers in other processes wait for the one computing them
+    instead of repeating the work
+    '''
+    if fields is None:
+        fields = list(OCEAN_INTEGRALS.keys())
+    fields = sorted(set(fields))
+    computeFields = sorted(set(fields) | set(runFields or []))
+    timeSeriesFiles = sorted(timeSeriesFiles)
+    filesKey = get_files_key([meshFileName] + timeSeriesFiles)
+    cachePrefix = os.path.join(tempfile.gettempdir(),
+                               'ocean_integrals_{}'.format(filesKey))
+
+    with open(cachePrefix + '.lock', 'w') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            cacheFileName = _find_ocean_integrals(cachePrefix, fields)
+            if cacheFileName is None:
+                cacheFileName = '{}_{}.nc'.format(
+                    cachePrefix, hashlib.sha1(','.join(computeFields).encode(
+                        'utf-8')).hexdigest()[:12])
+                ds = _compute_ocean_integrals(timeSeriesFiles, meshFileName,
+                                              computeFields)
+                # write then rename, so a partial file is never used
+                write_netcdf(ds, cacheFileName + '.tmp')
+                os.rename(cacheFileName + '.tmp', cacheFileName)
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    with xarray.open_dataset(cacheFileName, decode_times=False) as ds:
+        ds = ds[fields + ['time_bnds']]
+        ds.load()
+    return ds
+
+
+def _find_ocean_integrals(cachePrefix, fields):
+    '''
+    The cached integrals of the same files that hold all of the fields, or
+    None
+    '''
+    for fileName in sorted(glob.glob(cachePrefix + '_*.nc')):
+        with xarray.open_dataset(fileName, decode_times=False) as ds:
+            if all(field in ds for field in fields):
+                return fileName
+    return None
+
+
+def get_files_key(fileNames):
+    '''
+    A key that changes if the list of files, or the size or modification time
+    of any of them changes
+    '''
+    key = hashlib.sha1()
+    for fileName in fileNames:
+        stat = os.stat(fileName)
+        key.update('{}:{}:{}'.format(os.path.abspath(fileName), stat.st_size,
+                                     stat.st_mtime).encode('utf-8'))
+    return key.hexdigest()
+
+
+def _compute_ocean_integrals(timeSeriesFiles, meshFileName, fields):
+    dsMesh = xarray.open_dataset(meshFileName, mask_and_scale=False)
+    cellMask2D, cellMask3D = get_cell_masks(dsMesh)
+
+    # read only the layer thickness and the tracers the fields need
+    tracers = set()
+    needVolume = False
+    for field in fields:
+        if OCEAN_INTEGRALS[field] is not None:
+            tracers.update(OCEAN_INTEGRALS[field])
+            needVolume = needVolume or not field.startswith('surface')
+    variableList = ['timeMonthly_avg_activeTracers_{}'.format(tracer)
+                    for tracer in sorted(tracers)]
+    if needVolume:
+        variableList.append('timeMonthly_avg_layerThickness')
+    variableList.extend(['xtime_startMonthly', 'xtime_endMonthly'])
+
+    ds = xarray.Dataset()
+    with open_mfdataset(timeSeriesFiles, variableList) as dsIn:
+        # one graph for all the integrals, so each chunk of the 3D fields
+        # is read once
+        if needVolume:
+            vol = dsIn.timeMonthly_avg_layerThickness.where(cellMask3D) * \
+                dsMesh.areaCell
+        areaCell = dsMesh.areaCell.where(cellMask2D)
+        for field in fields:
+            if field == 'volume':
+                ds[field] = vol.sum(dim=['nVertLevels', 'nCells'])
+            elif field == 'area':
+                ds[field] = areaCell.sum(dim='nCells')
+            else:
+                tracer = dsIn['timeMonthly_avg_activeTracers_{}'.format(
+                    OCEAN_INTEGRALS[field][0])]
+                if field.startswith('surface'):
+                    ds[field] = \
+                        (tracer.isel(nVertLevels=0).squeeze(drop=True) *
+                         areaCell).sum(dim='nCells')
+                else:
+                    ds[field] = \
+                        (vol*tracer).sum(dim=['nVertLevels', 'nCells'])
+
+        ds = add_time(ds, dsIn)
+        ds = ds.compute()
 
     return ds
 
 
-def open_mfdataset(fileNames, variableList=None,
-                   chunks={'nCells': 32768, 'Time': 6}, daskThreads=6):
-    '''Open a multi-file xarray Dataset, retaining only the listed variables'''
+# the dask scheduler used by every MPAS handler in this process, set once per
+# run with set_dask_backend
+_dask_backend = {
+    'config': None,
+    'client': None
+}
+
+# default target size of the dask chunks, in bytes
+DEFAULT_CHUNK_BYTES = 128 * 1024 ** 2
 
-    dask.config.set(schedular='threads',
-                    pool=ThreadPool(min(multiprocessing.cpu_count(),
-                                        daskThreads)))
+# the cache of intermediate results shared between runs, set with the dask
+# backend, see get_cached_result
+_resultCache = {
+    'path': None,
+    'maxBytes': None
+}
 
+# default size of the result cache, in bytes, before the least recently used
+# results are evicted
+DEFAULT_RESULT_CACHE_BYTES = 50 * 1024 ** 3
 
-    ds = xarray.open_mfdataset(fileNames, concat_dim='Time',
-                               mask_and_scale=False, chunks=chunks)
+# the horizontal dimensions of the MPAS meshes, split when a single time slice
+# doesn't fit in one chunk
+_MESH_DIMS = ['nCells', 'nEdges', 'nVertices']
+
+
+def start_dask_backend(backend='threads', numWorkers=None, memoryLimit=None,
+                       chunkSize=None, zarrStore=None, resultCache=None,
+                       resultCacheSize=None):
+    '''
+    Choose the dask backend for the run, from the main process. The returned
+    config is passed to set_dask_backend in each worker. For the distributed
+    backend a LocalCluster is started and returned so it can be closed at the
+    end of the run, otherwise the returned cluster is None. With zarrStore,
+    open_mfdataset stages the MPAS files in Zarr stores in that directory.
+    With resultCache, remapped fields and MOC streamfunctions are kept in that
+    directory for later runs, see get_cached_result
+    '''
+    if chunkSize is None:
+        chunkBytes = DEFAULT_CHUNK_BYTES
+    else:
+        chunkBytes = int(parse_bytes(chunkSize))
+
+    resultCacheBytes = None
+    if resultCache is not None:
+        resultCache = os.path.abspath(resultCache)
+        if not os.path.exists(resultCache):
+            os.makedirs(resultCache)
+        if resultCacheSize is None:
+            resultCacheBytes = DEFAULT_RESULT_CACHE_BYTES
+        else:
+            resultCacheBytes = int(parse_bytes(resultCacheSize))
+
+    if zarrStore is not None:
+        # fail early if the optional zarr package is missing
+        if importlib.util.find_spec('zarr') is None:
+            raise ImportError(
+                'Staging the MPAS files in a Zarr store needs the zarr package')
+        zarrStore = os.path.abspath(zarrStore)
+        if not os.path.exists(zarrStore):
+            os.makedirs(zarrStore)
+
+    config = {'backend': backend,
+              'numWorkers': numWorkers,
+              'chunkBytes': chunkBytes,
+              'zarrStore': zarrStore,
+              'resultCache': resultCache,
+              'resultCacheBytes': resultCacheBytes}
+    cluster = None
+    if backend == 'distributed':
+        from dask.distributed import LocalCluster
+        if memoryLimit is None:
+            memoryLimit = 'auto'
+        cluster = LocalCluster(n_workers=numWorkers, threads_per_worker=1,
+                               memory_limit=memoryLimit)
+        config['address'] = cluster.scheduler_address
+    elif backend not in ['threads', 'synchronous']:
+        raise ValueError('Unexpected dask backend {}'.format(backend))
+
+    return config, cluster
+
+
+def set_dask_backend(config=None):
+    '''
+    Point this process at the dask backend chosen for the run, doing nothing
+    if it already is. Without a config the threaded scheduler is used with
+    one thread per core
+    '''
+    if config is None:
+        config = {'backend': 'threads',
+                  'numWorkers': None,
+                  'chunkBytes': DEFAULT_CHUNK_BYTES}
+    _resultCache['path'] = config.get('resultCache')
+    _resultCache['maxBytes'] = config.get('resultCacheBytes')
+    if _dask_backend['config'] == config:
+        return
+
+    if _dask_backend['client'] is not None:
+        _dask_backend['client'].close()
+        _dask_backend['client'] = None
+
+    if config['backend'] == 'distributed':
+        from dask.distributed import Client
+        _dask_backend['client'] = Client(config['address'],
+                                         set_as_default=True)
+    elif config['backend'] == 'synchronous':
+        dask.config.set(scheduler='synchronous')
+    else:
+        numWorkers = config.get('numWorkers') or multiprocessing.cpu_count()
+        dask.config.set(scheduler='threads', num_workers=numWorkers)
+
+    _dask_backend['config'] = config
+
+
+def get_chunks(fileName, variableList=None, chunkBytes=None):
+    '''
+    Derive the dask chunks for an MPAS file from its mesh dimensions, so that a
+    chunk of the largest variable is close to chunkBytes. Whole time slices
+    are grouped into a chunk when they fit, otherwise each time slice is split
+    along the horizontal mesh dimension
+    '''
+    if chunkBytes is None:
+        chunkBytes = DEFAULT_CHUNK_BYTES
+
+    with netCDF4.Dataset(fileName) as ds:
+        dims = {name: len(dim) for name, dim in ds.dimensions.items()}
+        if variableList is None:
+            variableList = list(ds.variables.keys())
+
+        # the size of a single time slice of the largest variable
+        sliceBytes = 1
+        for varName in variableList:
+            if varName not in ds.variables:
+                continue
+            var = ds.variables[varName]
+            size = var.dtype.itemsize
+            for dim in var.dimensions:
+                if dim != 'Time':
+                    size *= dims[dim]
+            sliceBytes = max(sliceBytes, size)
+
+    chunks = dict()
+    if sliceBytes <= chunkBytes:
+        chunks['Time'] = max(1, min(dims.get('Time', 1),
+                                    chunkBytes // sliceBytes))
+        for dim in _MESH_DIMS:
+            if dim in dims:
+                chunks[dim] = dims[dim]
+    else:
+        chunks['Time'] = 1
+        numSplits = int(np.ceil(sliceBytes / float(chunkBytes)))
+        for dim in _MESH_DIMS:
+            if dim in dims:
+                chunks[dim] = int(np.ceil(dims[dim] / float(numSplits)))
+
+    return chunks
+
+
+def open_mfdataset(fileNames, variableList=None, chunks=None):
+    '''
+    Open a multi-file xarray Dataset, retaining only the listed variables.
+    Unless chunks are given they are derived from the mesh of the first file
+    '''
+
+    if _dask_backend['config'] is None:
+        set_dask_backend()
+
+    if isinstance(fileNames, str):
+        fileNames = sorted(glob.glob(fileNames))
+    else:
+        fileNames = sorted(fileNames)
+
+    config = _dask_backend['config']
+    if config.get('zarrStore') and variableList is not None:
+        ds = _open_zarr_staged(fileNames, variableList, config['zarrStore'],
+                               config['chunkBytes'])
+    else:
+        if chunks is None:
+            chunks = get_chunks(fileNames[0], variableList,
+                                config['chunkBytes'])
+
+        ds = xarray.open_mfdataset(fileNames, concat_dim='Time',
+                                   mask_and_scale=False, chunks=chunks)
 
     if variableList is not None:
         allvars = ds.data_vars.keys()
@@ -274,19 +902,93 @@ def open_mfdataset(fileNames, variableList=None,
     return ds
 
 
-def write_netcdf(ds, fileName, fillValues=netCDF4.default_fillvals):
-    '''Write an xarray Dataset with NetCDF4 fill values where needed'''
+def _open_zarr_staged(fileNames, variableList, zarrStore, chunkBytes):
+    '''
+    Open the listed variables of the MPAS files from a Zarr store, first
+    copying any of them that aren't in the store yet. The store is keyed by the
+    input files, so it's reused by all the handlers and by later runs over the
+    same files, and the variables are chunked along the mesh with the whole
+    time series in each chunk
+    '''
+    storePath = os.path.join(zarrStore, 'mpas_{}.zarr'.format(
+        get_files_key(fileNames)))
+
+    with open(storePath + '.lock', 'w') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(storePath):
+                with xarray.open_zarr(storePath, consolidated=True) as ds:
+                    staged = set(ds.variables)
+            else:
+                staged = set()
+
+            missing = [varName for varName in variableList
+                       if varName not in staged]
+            if missing:
+                msg = 'Staging {} in {}'.format(', '.join(missing), storePath)
+                logging.info(msg)
+                chunks = get_chunks(fileNames[0], missing, chunkBytes)
+                ds = xarray.open_mfdataset(fileNames, concat_dim='Time',
+                                           mask_and_scale=False,
+                                           chunks=chunks)
+                ds = ds[[varName for varName in missing if varName in ds]]
+                ds = ds.chunk(_get_time_series_chunks(ds, chunkBytes))
+                for varName in ds.variables:
+                    ds[varName].encoding = dict()
+                if staged:
+                    ds.to_zarr(storePath, mode='a', consolidated=True)
+                else:
+                    ds.to_zarr(storePath, mode='w', consolidated=True)
+                ds.close()
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    return xarray.open_zarr(storePath, consolidated=True,
+                            mask_and_scale=False)
+
+
+def _get_time_series_chunks(ds, chunkBytes):
+    '''
+    Chunks with the whole time series of each column, splitting the mesh
+    dimensions so a chunk of the largest variable is close to chunkBytes
+    '''
+    columnBytes = 1
+    for varName in ds.data_vars:
+        var = ds[varName]
+        size = var.dtype.itemsize
+        for dim in var.dims:
+            if dim not in _MESH_DIMS:
+                size *= ds.dims[dim]
+        columnBytes = max(columnBytes, size)
+
+    chunks = {dim: -1 for dim in ds.dims}
+    for dim in _MESH_DIMS:
+        if dim in ds.dims:
+            chunks[dim] = max(1, min(ds.dims[dim], chunkBytes // columnBytes))
+    return chunks
+
+
+def write_netcdf(ds, fileName, fillValues=netCDF4.default_fillvals,
+                 compress=False):
+    '''
+    Write an xarray Dataset with NetCDF4 fill values where needed, and
+    deflated numeric variables if compress is True
+    '''
     encodingDict = {}
     variableNames = list(ds.data_vars.keys()) + list(ds.coords.keys())
     for variableName in variableNames:
         isNumeric = np.issubdtype(ds[variableName].dtype, np.number)
         if isNumeric:
             dtype = ds[variableName].dtype
+            encodingDict[variableName] = {}
             for fillType in fillValues:
                 if dtype == np.dtype(fillType):
                     encodingDict[variableName] = \
                         {'_FillValue': fillValues[fillType]}
                     break
+            if compress and ds[variableName].ndim > 0:
+                encodingDict[variableName].update(
+                    {'zlib': True, 'complevel': 1, 'shuffle': True})
         else:
             encodingDict[variableName] = {'_FillValue': None}
 
@@ -320,17 +1022,14 @@ def convert_namelist_to_dict(fileName):
     return nml
 
 
-def setup_cmor(varname, tables, user_input_path, component='ocean'):
-    '''Set up CMOR for MPAS-Ocean or MPAS-Seaice'''
-    logfile = os.path.join(os.getcwd(), 'cmor_logs')
-    if not os.path.exists(logfile):
-        os.makedirs(logfile)
-    logfile = os.path.join(logfile, varname + '.log')
-    cmor.setup(
-        inpath=tables,
-        netcdf_file_action=cmor.CMOR_REPLACE,
-        logfile=logfile)
-    cmor.dataset_json(str(user_input_path))
+def setup_cmor(varname, tables, user_input_path, component='ocean',
+               logdir=None):
+    '''
+    Set up CMOR for MPAS-Ocean or MPAS-Seaice, logging to the --logdir of the
+    run or ./cmor_logs
+    '''
+    if not logdir:
+        logdir = os.path.join(os.getcwd(), 'cmor_logs')
     if component == 'ocean':
         table = 'CMIP6_Omon.json'
     elif component == 'seaice':
@@ -338,7 +1037,8 @@ def setup_cmor(varname, tables, user_input_path, component='ocean'):
     else:
         raise ValueError('Unexpected component {}'.format(component))
     try:
-        cmor.load_table(table)
+        util.setup_cmor(varname, tables, table, user_input_path,
+                        logdir=logdir)
     except Exception:
         raise ValueError('Unable to load table from {}'.format(varname))
 
@@ -362,6 +1062,7 @@ def write_cmor(axes, ds, varname, varunits, d2f=True, **kwargs):
     # create the cmor variable
     varid = cmor.variable(str(varname), str(varunits), axis_ids,
                           missing_value=fillValue, **kwargs)
+    util.apply_output_policy(varid, varname)
 
     # write out the data
     try:
@@ -736,13 +1437,3 @@ def _compute_dask(ds, showProgress, message):
             ds.compute()
     else:
         ds.compute()
-
-
-def _get_temp_path():
-    '''Returns the name of a temporary NetCDF file'''
-    tmpdir = tempfile.gettempdir()
-    tmpfile = tempfile.NamedTemporaryFile(dir=tmpdir, delete=False)
-    tmpname = tmpfile.name
-    tmpfile.close()
-
-    return tmpname
@@ -0,0 +1,363 @@
+"""
+Planning a run from the names and sizes of its input files. Nothing here
+imports CMOR, cdms2 or the handlers, so --plan works on a login node or
+wherever they arent installed
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import logging
+import multiprocessing
+
+from e3sm_to_cmip.util import find_mpas_files
+from e3sm_to_cmip.util import find_atm_files
+from e3sm_to_cmip.util import find_cmip_output
+from e3sm_to_cmip.util import index_cmip_output
+from e3sm_to_cmip.util import get_input_years
+from e3sm_to_cmip.util import get_input_dates
+from e3sm_to_cmip.util import get_cmip_dates
+from e3sm_to_cmip.util import print_message
+
+logger = logging.getLogger()
+
+
+def get_input_paths(handler, input_path, map_path=None, mode='atm'):
+    """
+    Find the input files a handler needs
+
+    Params:
+    -------
+        handler (dict): the handler, as returned by load_handlers
+        input_path (str): path to the input files directory
+        map_path (str): path to the MPAS map file
+        mode (str): what type of files to work with
+    Returns:
+    --------
+        a dict of the input files for each raw variable of the handler
+    """
+    handler_variables = handler['raw_variables']
+    if mode in ['atm', 'lnd']:
+        return {var: [os.path.join(input_path, x) for x in
+                      find_atm_files(var, input_path)]
+                for var in handler_variables}
+    elif mode == 'fx':
+        return {var: [x for x in os.listdir(input_path) if x[-3:] == '.nc']
+                for var in handler_variables}
+    else:
+        return {var: find_mpas_files(var, input_path, map_path)
+                for var in handler_variables}
+# ------------------------------------------------------------------
+
+
+def get_incremental_inputs(handler, input_paths, output_path, policy,
+                           index=None):
+    """
+    Restrict the input files of a handler to the months after the last month
+    of its existing CMIP output
+
+    Params:
+    -------
+        handler (dict): the handler, as returned by load_handlers
+        input_paths (dict): the input files of the handler for each raw variable
+        output_path (str): the root of the CMIP output tree
+        policy (str): new-files or append
+        index (dict): the output tree from util.index_cmip_output
+    Returns:
+    --------
+        the filtered input paths, or None if there are no new months, and the
+        output file to append to, or None to write new files
+    """
+    output = find_cmip_output(output_path, handler['name'], handler['table'],
+                              index=index)
+    if not output:
+        return input_paths, None
+    last_date = max(get_cmip_dates(os.path.basename(path))[1]
+                    for _, _, path in output)
+
+    new_paths = dict()
+    has_new_dates = False
+    for var, paths in input_paths.items():
+        # the mesh, namelist and map files are single paths
+        if not isinstance(paths, list):
+            new_paths[var] = paths
+            continue
+        new_paths[var] = list()
+        for path in paths:
+            dates = get_input_dates(os.path.basename(path))
+            if dates is None:
+                new_paths[var].append(path)
+            elif dates[0] > last_date:
+                new_paths[var].append(path)
+                has_new_dates = True
+    if not has_new_dates:
+        return None, None
+
+    append_to = None
+    if policy == 'append':
+        if handler.get('append'):
+            append_to = output[-1][2]
+        else:
+            msg = "{} can't append to its output, writing the new months to new files".format(
+                handler['name'])
+            print_message(msg, 'error')
+            logger.warning(msg)
+    return new_paths, append_to
+# ------------------------------------------------------------------
+
+
+# the default cost model of --plan for each mode: seconds to convert a GB of
+# input, peak memory as a multiple of the largest input file of each raw
+# variable, and seconds of fixed cost per handler for the setup and the
+# CMOR write. Replace with a model fit to a previous run with
+# calibrate_cost_model
+PLAN_COST = {
+    'atm': {'seconds_per_gb': 60.0, 'memory_factor': 4.0, 'overhead': 10.0},
+    'lnd': {'seconds_per_gb': 60.0, 'memory_factor': 4.0, 'overhead': 10.0},
+    'fx': {'seconds_per_gb': 30.0, 'memory_factor': 4.0, 'overhead': 5.0},
+    'mpaso': {'seconds_per_gb': 120.0, 'memory_factor': 2.0, 'overhead': 60.0},
+    'mpassi': {'seconds_per_gb': 120.0, 'memory_factor': 2.0, 'overhead': 60.0}
+}
+
+
+def get_cost(cost_model, name, mode):
+    """
+    The cost of a handler, from its own entry in the cost model, the entry
+    of its mode or the defaults, in that order
+    """
+    cost = dict(PLAN_COST.get(mode, PLAN_COST['atm']))
+    cost_model = cost_model or dict()
+    cost.update(cost_model.get(mode, dict()))
+    cost.update(cost_model.get(name, dict()))
+    return cost
+# ------------------------------------------------------------------
+
+
+def get_plan(handlers, input_path, map_path=None, mode='atm', nproc=6,
+             cost_model=None, incremental=None, output_path=None):
+    """
+    Resolve the input files of every handler without running any, and
+    predict the runtime and the memory of the run
+
+    Params:
+    -------
+        handlers (list): the handlers, as returned by load_handlers
+        input_path (str): path to the input files directory
+        map_path (str): path to the MPAS map file
+        mode (str): what type of files to work with
+        nproc (int): the number of handlers run at once
+        cost_model (dict): the cost of each mode or handler, see PLAN_COST
+        incremental (str): new-files or append, to only plan the years after
+            the existing output in output_path
+    Returns:
+    --------
+        a dict of the plan of each handler and the totals
+    """
+    index = None
+    if incremental and output_path:
+        index = index_cmip_output(output_path)
+
+    plan = list()
+    for handler in handlers:
+        entry = {
+            'name': handler['name'],
+            'table': handler['table'],
+            'missing': list(),
+            'files': dict(),
+            'years': None,
+            'input_bytes': 0,
+            'work_units': 0
+        }
+        try:
+            input_paths = get_input_paths(handler, input_path, map_path, mode)
+        except (IOError, OSError) as error:
+            entry['missing'].append(str(error))
+            input_paths = dict()
+        if index is not None and input_paths:
+            input_paths, _ = get_incremental_inputs(
+                handler, input_paths, output_path, incremental, index=index)
+            if input_paths is None:
+                entry['up_to_date'] = True
+                input_paths = dict()
+
+        # the fixed fields are listed by name, the mesh, namelist and map
+        # files are single paths
+        seen = set()
+        largest = 0
+        for var, paths in input_paths.items():
+            if not isinstance(paths, list):
+                paths = [paths] if paths else list()
+            if mode == 'fx':
+                paths = [os.path.join(input_path, x) for x in paths]
+            entry['files'][var] = len(paths)
+            if not paths:
+                entry['missing'].append(var)
+                continue
+            sizes = list()
+            for path in paths:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    entry['missing'].append(path)
+                    continue
+                sizes.append(size)
+                if path not in seen:
+                    seen.add(path)
+                    entry['input_bytes'] += size
+            if sizes:
+                largest += max(sizes)
+
+            years = [get_input_years(os.path.basename(x)) for x in paths]
+            years = [x for x in years if x]
+            if years and entry['years'] is None:
+                entry['years'] = [min(x[0] for x in years),
+                                  max(x[1] for x in years)]
+
+        # the atm and lnd handlers write one CMOR file for each input file
+        if mode in ['atm', 'lnd'] and handler['raw_variables']:
+            entry['work_units'] = entry['files'].get(
+                handler['raw_variables'][0], 0)
+        elif input_paths and not entry['missing']:
+            entry['work_units'] = 1
+
+        cost = get_cost(cost_model, handler['name'], mode)
+        if entry['work_units']:
+            entry['runtime'] = cost['overhead'] + \
+                cost['seconds_per_gb'] * entry['input_bytes'] / 1024.0 ** 3
+            entry['memory'] = int(cost['memory_factor'] * largest)
+        else:
+            entry['runtime'] = 0.0
+            entry['memory'] = 0
+        plan.append(entry)
+
+    # the run takes at least as long as its longest handler, and at least
+    # the total runtime spread over the processes
+    total_runtime = sum(x['runtime'] for x in plan)
+    longest = max([x['runtime'] for x in plan] or [0.0])
+    peak_memory = max([x['memory'] for x in plan] or [0])
+
+    try:
+        node_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        node_memory = None
+    num_work = len([x for x in plan if x['work_units']])
+    suggested = min(max(num_work, 1), multiprocessing.cpu_count())
+    if node_memory and peak_memory:
+        suggested = max(1, min(suggested, node_memory // peak_memory))
+
+    return {
+        'mode': mode,
+        'input_path': input_path,
+        'handlers': plan,
+        'totals': {
+            'handlers': len(plan),
+            'missing': sorted(x['name'] for x in plan if x['missing']),
+            'input_bytes': sum(x['input_bytes'] for x in plan),
+            'work_units': sum(x['work_units'] for x in plan),
+            'runtime': total_runtime,
+            'wallclock': max(longest, total_runtime / max(nproc, 1)),
+            'num_proc': nproc,
+            'peak_memory': peak_memory,
+            'memory': peak_memory * min(nproc, max(num_work, 1)),
+            'node_memory': node_memory,
+            'suggested_num_proc': int(suggested)
+        },
+        'cost_model': dict(cost_model or dict(),
+                           **{mode: get_cost(cost_model, None, mode)})
+    }
+# ------------------------------------------------------------------
+
+
+def calibrate_cost_model(plan, status, cost_model=None):
+    """
+    Fit the seconds per GB of the cost model to the handler timings of a
+    previous run of the same inputs
+
+    Params:
+    -------
+        plan (dict): the plan of the previous run, from get_plan
+        status (dict): the status file of the previous run
+        cost_model (dict): the cost model to update
+    Returns:
+    --------
+        the updated cost model, with an entry for the mode and for every
+        handler that finished
+    """
+    cost_model = dict(cost_model or dict())
+    mode = plan['mode']
+    timings = status.get('timings') or dict()
+
+    total_bytes = 0
+    total_seconds = 0.0
+    for entry in plan['handlers']:
+        elapsed = timings.get(entry['name'])
+        if not elapsed or not entry['input_bytes']:
+            continue
+        cost = get_cost(cost_model, entry['name'], mode)
+        gigabytes = entry['input_bytes'] / 1024.0 ** 3
+        seconds = max(elapsed - cost['overhead'], 0.0)
+        handler_cost = dict(cost_model.get(entry['name'], dict()))
+        handler_cost['seconds_per_gb'] = seconds / gigabytes
+        cost_model[entry['name']] = handler_cost
+        total_bytes += entry['input_bytes']
+        total_seconds += seconds
+
+    if total_bytes:
+        mode_cost = dict(cost_model.get(mode, dict()))
+        mode_cost['seconds_per_gb'] = total_seconds / (total_bytes / 1024.0 ** 3)
+        cost_model[mode] = mode_cost
+    return cost_model
+# ------------------------------------------------------------------
+
+
+def format_plan(plan):
+    """
+    The plan as a table of the handlers, largest input first, and the totals
+    """
+    def size(num_bytes):
+        for unit in ['B', 'KB', 'MB', 'GB']:
+            if num_bytes < 1024.0:
+                return '{:.1f}{}'.format(num_bytes, unit)
+            num_bytes /= 1024.0
+        return '{:.1f}TB'.format(num_bytes)
+
+    def duration(seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return '{:d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+    lines = ['{:<16} {:<18} {:>6} {:>11} {:>10} {:>10} {:>10}  {}'.format(
+        'handler', 'table', 'units', 'years', 'input', 'memory', 'runtime',
+        'missing')]
+    for entry in sorted(plan['handlers'], key=lambda x: -x['input_bytes']):
+        years = '-'.join(str(x) for x in entry['years']) \
+            if entry['years'] else ''
+        missing = ', '.join(entry['missing'])
+        if entry.get('up_to_date'):
+            missing = 'up to date'
+        lines.append('{:<16} {:<18} {:>6} {:>11} {:>10} {:>10} {:>10}  {}'.format(
+            entry['name'],
+            entry['table'],
+            entry['work_units'],
+            years,
+            size(entry['input_bytes']),
+            size(entry['memory']),
+            duration(entry['runtime']),
+            missing))
+
+    totals = plan['totals']
+    lines.append('')
+    lines.append('{} handlers, {} CMOR files from {} of input'.format(
+        totals['handlers'], totals['work_units'], size(totals['input_bytes'])))
+    lines.append('{} of runtime, {} on {} processes with {} of memory'.format(
+        duration(totals['runtime']), duration(totals['wallclock']),
+        totals['num_proc'], size(totals['memory'])))
+    msg = 'largest handler needs {}, suggested --num-proc is {}'.format(
+        size(totals['peak_memory']), totals['suggested_num_proc'])
+    if totals['node_memory']:
+        msg += ' for the {} of this node'.format(size(totals['node_memory']))
+    lines.append(msg)
+    if totals['missing']:
+        lines.append('missing inputs for: {}'.format(
+            ', '.join(totals['missing'])))
+    return '\n'.join(lines)
+# ------------------------------------------------------------------
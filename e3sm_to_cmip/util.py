@@ -2,17 +2,24 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import sys
 import traceback
-import cmor
 import os
 import re
 import argparse
 import imp
+import ast
+import shutil
+import tempfile
+import json
+import time
 import yaml
-import cdms2
 
 from progressbar import ProgressBar
 from e3sm_to_cmip.version import __version__
 
+# cmor and cdms2 are imported by the functions that use them, so the parts
+# of the module that only look at file names, like --plan, work where they
+# arent installed
+
 
 def print_debug(e):
     """
@@ -54,27 +61,188 @@ def print_message(message, status='error'):
 # ------------------------------------------------------------------
 
 
-def setup_cmor(var_name, table_path, table_name, user_input_path):
+# The CMOR session of this process. CMOR is setup, the user metadata parsed
+# and each table loaded only once per worker, and handlers that run later in
+# the same worker switch back to their already loaded table
+_cmor_session = {
+    'key': None,
+    'tables': dict(),
+    'table': None
+}
+
+# Compression of the CMOR output. Shuffle with a low deflate level gives most
+# of the size reduction of the higher levels for a fraction of the write time
+OUTPUT_POLICY = {
+    'shuffle': True,
+    'deflate_level': 1
+}
+
+# The output policy of this process, the defaults overridden per table and
+# per variable, see load_output_policy
+_output_policy = {
+    'default': dict(OUTPUT_POLICY)
+}
+
+
+def setup_cmor(var_name, table_path, table_name, user_input_path, logdir=None,
+               append=False):
     """
     Sets up cmor and logging for a single handler
+
+    Because the session is shared by every handler that runs in the process,
+    handlers must close their own variables with cmor.close(varid) instead of
+    calling cmor.close() with no arguments, which would end the session.
+
+    Params:
+    -------
+        var_name (str): the name of the variable being converted
+        table_path (str): path to the CMOR tables directory
+        table_name (str): the name of the table to use, i.e. CMIP6_Amon.json
+        user_input_path (str): path to the user metadata json file
+        logdir (str): directory for the CMOR log, default is ./logs. Each
+            process logs to cmor_<pid>.log there
+        append (bool): setup CMOR to append to existing output files
+    Returns:
+    --------
+        the CMOR table id
     """
+    import cmor
+
     var_name = str(var_name)
     table_path = str(table_path)
     table_name = str(table_name)
     user_input_path = str(user_input_path)
 
-    logfile = os.path.join(os.getcwd(), 'logs')
-    if not os.path.exists(logfile):
-        os.makedirs(logfile)
+    if append:
+        file_action = cmor.CMOR_APPEND
+    else:
+        file_action = cmor.CMOR_REPLACE
+
+    if not logdir:
+        logdir = os.path.join(os.getcwd(), 'logs')
+
+    # a handler with a different log directory gets a new session, so the
+    # log is where it asked for
+    key = (table_path, user_input_path, file_action, logdir)
+    if _cmor_session['key'] != key:
+        if not os.path.exists(logdir):
+            os.makedirs(logdir, exist_ok=True)
+
+        # the log is shared by all the handlers in this worker
+        logfile = os.path.join(logdir, 'cmor_{}.log'.format(os.getpid()))
+        cmor.setup(
+            inpath=table_path,
+            netcdf_file_action=file_action,
+            logfile=logfile)
+
+        cmor.dataset_json(user_input_path)
+        _cmor_session['key'] = key
+        _cmor_session['tables'] = dict()
+
+    table_id = _cmor_session['tables'].get(table_name)
+    if table_id is None:
+        table_id = cmor.load_table(table_name)
+        _cmor_session['tables'][table_name] = table_id
+    else:
+        cmor.set_table(table_id)
+    _cmor_session['table'] = table_name
+    return table_id
+# ------------------------------------------------------------------
+
+
+def load_output_policy(policy_path=None):
+    """
+    Load the compression policy for the CMOR output of this process
+
+    The policy file is a json object whose "default" entry overrides the
+    OUTPUT_POLICY defaults, and whose other entries are either table names
+    or variable names, i.e.
+
+        {"default": {"deflate_level": 2},
+         "CMIP6_Omon.json": {"shuffle": true, "deflate_level": 4},
+         "tas": {"deflate_level": 0}}
+
+    A deflate_level of 0 writes the variable uncompressed. The policy is set
+    before the workers start so every handler sees the same one.
+
+    Params:
+    -------
+        policy_path (str): path to the json policy file, or None for the defaults
+    Returns:
+    --------
+        the policy as a dict of table or variable names to settings
+    """
+    policy = dict()
+    if policy_path:
+        with open(policy_path, 'r') as infile:
+            policy = json.load(infile)
+    return set_output_policy(policy)
+# ------------------------------------------------------------------
+
+
+def set_output_policy(policy):
+    """
+    Check and set the compression policy for the CMOR output of this process,
+    see load_output_policy for its format
+
+    Params:
+    -------
+        policy (dict): table or variable names to settings
+    Returns:
+    --------
+        the policy, with the OUTPUT_POLICY defaults filled in
+    """
+    policy = dict(policy)
+    for name, settings in policy.items():
+        unknown = set(settings.keys()) - set(OUTPUT_POLICY.keys())
+        if unknown:
+            raise ValueError('Unknown output policy settings for {}: {}'.format(
+                name, ', '.join(sorted(unknown))))
+        level = settings.get('deflate_level')
+        if level is not None and not 0 <= int(level) <= 9:
+            raise ValueError('deflate_level for {} must be between 0 and 9'.format(
+                name))
+
+    default = dict(OUTPUT_POLICY)
+    default.update(policy.get('default', dict()))
+    policy['default'] = default
+
+    _output_policy.clear()
+    _output_policy.update(policy)
+    return _output_policy
+# ------------------------------------------------------------------
+
 
-    logfile = os.path.join(logfile, var_name + '.log')
-    cmor.setup(
-        inpath=table_path,
-        netcdf_file_action=cmor.CMOR_REPLACE,
-        logfile=logfile)
+def apply_output_policy(varid, var_name, table_name=None):
+    """
+    Set the compression for a CMOR variable from the output policy
+
+    The defaults are overridden by the settings for the table, then by the
+    settings for the variable. Call this after cmor.variable and before the
+    first cmor.write of the variable.
+
+    Params:
+    -------
+        varid (int): the CMOR variable id
+        var_name (str): the name of the CMIP variable
+        table_name (str): the table of the variable, default is the table
+            last loaded by setup_cmor
+    """
+    import cmor
+
+    if table_name is None:
+        table_name = _cmor_session['table']
 
-    cmor.dataset_json(user_input_path)
-    cmor.load_table(table_name)
+    settings = dict(_output_policy['default'])
+    settings.update(_output_policy.get(table_name, dict()))
+    settings.update(_output_policy.get(var_name, dict()))
+
+    level = int(settings['deflate_level'])
+    cmor.set_deflate(
+        varid,
+        int(bool(settings['shuffle'])),
+        int(level > 0),
+        level)
 # ------------------------------------------------------------------
 
 
@@ -146,10 +314,108 @@ def parse_argsuments():
         help="The component to analyze, atm, lnd, mpaso or mpassi")
     parser.add_argument(
         '--logdir',
-        help="Where to put the logging output from CMOR")
+        help="Where to put the logging output from CMOR. Each worker process writes a single cmor_<pid>.log, shared by all the handlers it runs")
+    parser.add_argument(
+        '--time-window',
+        metavar='<num_timesteps>',
+        type=int,
+        help="optional: read and write the atm and lnd input files in windows of this many time steps, to limit memory use for large 3D variables. By default whole files are read at once")
+    parser.add_argument(
+        '--dask-backend',
+        choices=['threads', 'distributed', 'synchronous'],
+        default='threads',
+        help="optional: the dask scheduler shared by the MPAS handlers, default is threads")
+    parser.add_argument(
+        '--dask-workers',
+        metavar='<num_workers>',
+        type=int,
+        help="optional: number of dask threads per handler, or the number of LocalCluster workers for the distributed backend. By default the cores are divided between the handler processes")
+    parser.add_argument(
+        '--dask-memory-limit',
+        metavar='<bytes>',
+        help="optional: memory limit per worker of the distributed backend, i.e. 4GB")
+    parser.add_argument(
+        '--dask-chunk-size',
+        metavar='<bytes>',
+        help="optional: target size of the dask chunks of the MPAS variables, default is 128MiB")
+    parser.add_argument(
+        '--mpi',
+        action='store_true',
+        help="optional: run with mpi4py across the ranks of an MPI job, i.e. srun or mpirun -n 4 e3sm_to_cmip --mpi ... Rank 0 finds the inputs and hands out the handlers, split by input file for atm and lnd, to the other ranks")
+    parser.add_argument(
+        '--incremental',
+        choices=['new-files', 'append'],
+        help="optional: only convert the input months after the last month of each variable's existing CMIP output. With new-files the new months are written to new date-ranged files, with append they're appended to the last output file where the handler supports it, the other handlers write new files")
+    parser.add_argument(
+        '--zarr-store',
+        metavar='<zarr_path>',
+        help="optional: stage the variables of the MPAS monthly files that the handlers read in Zarr stores in this directory, chunked for time series access. Later handlers and runs over the same files read from the stores. Requires the zarr package")
+    parser.add_argument(
+        '--result-cache',
+        metavar='<cache_path>',
+        help="optional: keep the remapped MPAS fields and the MOC streamfunction in this directory, keyed by the input files, the mapping file and the code that made them. Later runs with the same inputs, i.e. with new tables or metadata, only redo the CMOR write")
+    parser.add_argument(
+        '--result-cache-size',
+        metavar='<size>',
+        default='50GB',
+        help="optional: size of the result cache before the least recently used results are removed, default is 50GB")
+    parser.add_argument(
+        '--batch-remap',
+        metavar='<num_handlers>',
+        type=int,
+        help="optional: run the MPAS handlers in groups of this many, remapping the datasets of a group that share a map file and dimensions with a single ncremap call")
+    parser.add_argument(
+        '--scratch-dir',
+        metavar='<scratch_path>',
+        help="optional: where to write temporary files, i.e. node-local disk. By default TMPDIR, /dev/shm and /tmp are tried in turn for one with enough free space, then the output directory")
+    parser.add_argument(
+        '--scratch-min-free',
+        metavar='<GiB>',
+        type=float,
+        default=SCRATCH_MIN_FREE,
+        help="optional: free space in GiB a scratch location needs before it's chosen, default is {}".format(SCRATCH_MIN_FREE))
+    parser.add_argument(
+        '--output-policy',
+        metavar='<policy_json>',
+        help="optional: json file with the shuffle and deflate_level of the output, by default, per table or per variable. The default is shuffle with deflate level 1. Chunk shapes can't be set, CMOR writes one time record per chunk. scripts/benchmark_output_policy.py measures the write time and size of each setting")
     parser.add_argument(
         '--timeout',
         help='Exit with code -1 if execution time exceeds given time in seconds')
+    parser.add_argument(
+        '--handler-timeout',
+        metavar='<seconds>',
+        type=float,
+        help="optional: stop a handler that runs longer than this many seconds and count it as failed, while the other handlers keep running. Only used when the handlers run in parallel")
+    parser.add_argument(
+        '--retries',
+        metavar='<count>',
+        type=int,
+        default=2,
+        help="optional: times a handler that failed from a lack of memory or an I/O error is run again with smaller chunks and time windows and fewer dask threads, in parallel runs the last time alone. Default is 2")
+    parser.add_argument(
+        '--handler-soft-timeout',
+        metavar='<seconds>',
+        type=float,
+        help="optional: report a handler that runs longer than this many seconds as a straggler")
+    parser.add_argument(
+        '--status-file',
+        metavar='<status_json>',
+        help="optional: keep a json file up to date with the handlers done, running and failed, the throughput in time steps and MB per second and the ETA, for workflow monitors")
+    parser.add_argument(
+        '--plan',
+        metavar='<plan_json>',
+        nargs='?',
+        const='',
+        help="optional: dont convert anything, print the handlers to run with their input files, CMOR files, input size and predicted memory and runtime, and the suggested --num-proc. Optionally also write the plan to this json file")
+    parser.add_argument(
+        '--plan-cost',
+        metavar='<cost_json>',
+        help="optional: json file with the cost model of --plan, the seconds_per_gb, memory_factor and overhead by mode or by handler. The cost_model of a plan json can be used")
+    parser.add_argument(
+        '--plan-calibrate',
+        metavar=('<plan_json>', '<status_json>'),
+        nargs=2,
+        help="optional: fit the cost model of --plan to the plan and the --status-file of a previous run, i.e. of a few years of the same simulation")
     parser.add_argument(
         '--precheck',
         help="Check for each variable if its already in the output CMIP6 directory, only run variables that dont have CMIP6 output",
@@ -174,7 +440,46 @@ def parse_argsuments():
 # ------------------------------------------------------------------
 
 
-def load_handlers(handlers_path, var_list, debug=None):
+def read_handler_info(module_path):
+    """
+    Read the module level constants of a handler module, i.e. RAW_VARIABLES
+    and TABLE, without importing it
+
+    Params:
+    -------
+        module_path (str): path to the handler module
+    Returns:
+    --------
+        a dict of the name to the value of each constant
+    """
+    def literal(node):
+        # the handlers wrap their constants in str() for python 2
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+                and node.func.id == 'str' and len(node.args) == 1:
+            return str(literal(node.args[0]))
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return [literal(x) for x in node.elts]
+        return ast.literal_eval(node)
+
+    with open(module_path, 'r') as infile:
+        tree = ast.parse(infile.read(), filename=module_path)
+
+    info = dict()
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        for target in node.targets:
+            if not isinstance(target, ast.Name):
+                continue
+            try:
+                info[target.id] = literal(node.value)
+            except (ValueError, TypeError, SyntaxError):
+                pass
+    return info
+# ------------------------------------------------------------------
+
+
+def load_handlers(handlers_path, var_list, debug=None, info_only=False):
     """
     load the cmor handler modules
 
@@ -182,13 +487,18 @@ def load_handlers(handlers_path, var_list, debug=None):
     -------
         handlers_path (str): the path to the python module to load handlers from
         var_list (list(str)): A list of strings with the names of cmip6 variables to convert to, optionally "all" to run all handlers found
+        info_only (bool): read the raw variables and tables of the handlers
+            without importing them, or CMOR, the handlers have no method
     Returns:
     --------
         handlers (list(dict()): A list of dictionaries mapping module names
         (which are the cmip6 output variable name), to a tuple of (function pointer,
         list of required input variables)
     """
-    from e3sm_to_cmip.default import default_handler
+    if info_only:
+        default_handler = None
+    else:
+        from e3sm_to_cmip.default import default_handler
 
     handlers = list()
 
@@ -217,13 +527,21 @@ def load_handlers(handlers_path, var_list, debug=None):
             table = default.get('table').split('.')[0].split('_')[-1]
             if default.get('cmip_name') in var_list or 'all' in var_list or table in load_tables:
 
+                # handlers with a formula can list several raw variables
+                raw_variables = default.get('e3sm_name')
+                if not isinstance(raw_variables, list):
+                    raw_variables = [raw_variables]
+
                 handlers.append({
                     'name': default.get('cmip_name'),
                     'method': default_handler,
-                    'raw_variables': [default.get('e3sm_name')],
+                    'raw_variables': raw_variables,
                     'units': default.get('units'),
                     'table': default.get('table'),
-                    'positive': default.get('positive')
+                    'positive': default.get('positive'),
+                    'formula': default.get('formula'),
+                    'levels': default.get('levels'),
+                    'append': True
                 })
             elif debug:
                 print_message("{} not loaded".format(default.get('cmip_name')))
@@ -249,20 +567,26 @@ def load_handlers(handlers_path, var_list, debug=None):
         module_path = os.path.join(handlers_path, handler)
 
         # load the module, and extract the "handle" method and required variables
-        module = imp.load_source(module_name, module_path)
+        if info_only:
+            info = read_handler_info(module_path)
+        else:
+            module = imp.load_source(module_name, module_path)
+            info = vars(module)
 
         # pull the table name out from the format CMIP6_Amon.json
-        table = module.TABLE.split('.')[0].split('_')[-1]
+        table = info['TABLE'].split('.')[0].split('_')[-1]
 
         if module_name in var_list or 'all' in var_list or table in load_tables:
 
             handlers.append({
                 'name': module_name,
-                'method': module.handle,
-                'raw_variables': module.RAW_VARIABLES,
-                'units': module.VAR_UNITS,
-                'table': module.TABLE,
-                'positive': module.POSITIVE if hasattr(module, 'POSITIVE') else None
+                'method': info.get('handle'),
+                'raw_variables': info['RAW_VARIABLES'],
+                'units': info['VAR_UNITS'],
+                'table': info['TABLE'],
+                'positive': info.get('POSITIVE'),
+                'integrals': info.get('INTEGRALS'),
+                'append': info.get('APPEND', False)
             })
         elif debug:
             print_message("{} not loaded".format(module_name))
@@ -322,6 +646,8 @@ def add_metadata(file_path, var_list):
         file_path (str): the root directory to search for files under
         var_list (list(str)): a list of cmip6 variable names
     """
+    import cdms2
+
     filepaths = list()
 
     print_message('Adding additional metadata to output files', 'ok')
@@ -491,86 +817,411 @@ def terminate(pool, debug=False):
 # ------------------------------------------------------------------
 
 
+# candidate node-local scratch locations, in order of preference. TMPDIR is
+# checked first since batch systems often point it at node-local disk
+SCRATCH_CANDIDATES = ['/dev/shm', '/tmp']
+
+# the default free space a scratch location needs before it is used, in GiB
+SCRATCH_MIN_FREE = 20
+
+# the bytes this process wrote to scratch files
+_scratch_usage = {'bytes': 0}
+
+
+def setup_scratch(output_path, scratch_path=None, min_free=SCRATCH_MIN_FREE):
+    """
+    Choose where the temporary files of the run are written, and create a
+    directory for the run there. The location given by the user is always
+    used, otherwise TMPDIR, /dev/shm and /tmp are tried in turn and the
+    first writable one with min_free GiB available is chosen, falling back
+    to output_path/tmp
+
+    Params:
+    -------
+        output_path (str): the output directory of the run
+        scratch_path (str): a scratch location chosen by the user
+        min_free (float): free space in GiB a location needs to be chosen
+    Returns:
+    --------
+        the path to the new scratch directory of the run
+    """
+    if scratch_path:
+        candidates = [scratch_path]
+    else:
+        candidates = list()
+        if os.environ.get('TMPDIR'):
+            candidates.append(os.environ['TMPDIR'])
+        candidates.extend(SCRATCH_CANDIDATES)
+
+        candidates.append(os.path.join(output_path, 'tmp'))
+
+    base = candidates[-1]
+    for path in candidates[:-1]:
+        if not os.path.isdir(path) or not os.access(path, os.W_OK):
+            continue
+        free = shutil.disk_usage(path).free
+        if free >= min_free * 1024 ** 3:
+            base = path
+            break
+
+    # with MPI every rank may create the same directory at once
+    os.makedirs(base, exist_ok=True)
+    return tempfile.mkdtemp(prefix='e3sm_to_cmip_', dir=base)
+# ------------------------------------------------------------------
+
+
+def get_scratch_file(suffix='.nc'):
+    """
+    Create an empty temporary file in the scratch directory of the run and
+    return its name, the file must be removed with release_scratch_file
+    """
+    handle, name = tempfile.mkstemp(suffix=suffix)
+    os.close(handle)
+    return name
+# ------------------------------------------------------------------
+
+
+# Progress events of the handlers in this process go on this queue. The
+# parent sets it in each worker before a handler runs, and reads the events
+# from the other end, see lib.ProgressMonitor
+_progress = {
+    'queue': None,
+    'handler': None
+}
+
+
+def set_progress_queue(queue, handler=None):
+    """
+    Publish the progress events of this process on the given queue
+
+    Params:
+    -------
+        queue: a queue shared with the parent process, or None to stop publishing
+        handler (str): the name of the handler the events are for
+    """
+    _progress['queue'] = queue
+    _progress['handler'] = handler
+# ------------------------------------------------------------------
+
+
+def publish_progress(event, **kwargs):
+    """
+    Put a progress event on the queue of this process, if there is one. An
+    event that can't be sent is dropped, progress reporting never fails a
+    handler
+
+    Params:
+    -------
+        event (str): start, chunk, file or done
+        kwargs: the event data, i.e. timesteps and bytes for a chunk
+    """
+    queue = _progress['queue']
+    if queue is None:
+        return
+    kwargs['event'] = event
+    kwargs.setdefault('handler', _progress['handler'])
+    kwargs['pid'] = os.getpid()
+    kwargs['time'] = time.time()
+    try:
+        queue.put_nowait(kwargs)
+    except Exception:
+        pass
+# ------------------------------------------------------------------
+
+
+def release_scratch_file(name):
+    """
+    Remove a temporary file from get_scratch_file if it exists, adding its
+    size to the bytes written to scratch by this process
+    """
+    if not os.path.exists(name):
+        return
+    _scratch_usage['bytes'] += os.path.getsize(name)
+    os.remove(name)
+
+    # each process keeps its total in the scratch directory so the main
+    # process can report the total of the run
+    usage_path = os.path.join(os.path.dirname(name), '.usage')
+    if not os.path.exists(usage_path):
+        os.makedirs(usage_path, exist_ok=True)
+    with open(os.path.join(usage_path, str(os.getpid())), 'w') as usage:
+        usage.write(str(_scratch_usage['bytes']))
+# ------------------------------------------------------------------
+
+
+def cleanup_scratch(scratch_path):
+    """
+    Remove the scratch directory of the run along with any temporary files
+    left in it
+
+    Params:
+    -------
+        scratch_path (str): the scratch directory from setup_scratch
+    Returns:
+    --------
+        the total bytes written to scratch files by all the processes
+    """
+    total = 0
+    usage_path = os.path.join(scratch_path, '.usage')
+    if os.path.exists(usage_path):
+        for name in os.listdir(usage_path):
+            with open(os.path.join(usage_path, name), 'r') as usage:
+                total += int(usage.read() or 0)
+
+    shutil.rmtree(scratch_path, ignore_errors=True)
+    return total
+# ------------------------------------------------------------------
+
+
 def get_levgrnd_bnds():
     return [0, 0.01751106046140194, 0.045087261125445366, 0.09055273048579693, 0.16551261954009533, 0.28910057805478573, 0.4928626772016287, 0.8288095649331808, 1.3826923426240683, 2.2958906944841146, 3.801500206813216, 6.28383076749742, 10.376501685008407, 17.124175196513534, 28.249208575114608, 42.098968505859375]
 # ------------------------------------------------------------------
 
 
-def get_years_from_raw(path, mode, var):
+def get_years_from_raw(path, mode, var=None):
     """
     given a file path, return the start and end years for the data
     Parameters:
     -----------
         path (str): the directory to look in for data
         mode (str): the type of data to look for, i.e atm, lnd, mpaso, mpassi
+        var (str): only use the time series files of this raw variable, if
+            there are any
     """
-    start = 0
-    end = 0
-    if mode in ['atm', 'lnd']:
-        contents = sorted([f for f in os.listdir(path)
-                           if f.endswith("nc") and 
-                           var in f])
-        p = var + r'\d{6}_\d{6}.nc'
-        s = re.match(pattern=p, string=contents[0])
-        start = int(contents[0][ s.start(): s.start()+4 ])
-        s = re.search(pattern=p, string=contents[-1])
-        end = int(contents[-1][ s.start(): s.start()+4 ])
-    elif mode in ['mpassi', 'mpaso']:
-        
-        files = sorted(find_mpas_files(mode, path))
-        p = r'\d{4}-\d{2}-\d{2}.nc'
-        s = re.search(pattern=p, string=files[0])
-        start = int(files[0][s.start(): s.start() + 4])
-        s = re.search(pattern=p, string=files[1])
-        end = int(files[-1][s.start(): s.start() + 4])
-        
+    spans = get_raw_years(path, mode)
+    return spans.get(var, spans[None])
+
+
+def get_raw_years(path, mode):
+    """
+    given a file path, return the start and end years of the data of each
+    raw variable with VAR_YYYYMM_YYYYMM.nc time series files, and of all the
+    files under None, listing the directory once
+    Parameters:
+    -----------
+        path (str): the directory to look in for data
+        mode (str): the type of data to look for, i.e atm, lnd, mpaso, mpassi
+    """
+    if mode in ['mpassi', 'mpaso']:
+        files = [os.path.basename(x) for x in find_mpas_files(mode, path)]
     else:
-        raise ValueError("Invalid mode")
-    return start, end
+        files = [x for x in os.listdir(path) if x.endswith('.nc')]
 
+    spans = dict()
+    for name in files:
+        years = get_input_years(name)
+        if years is None:
+            continue
+        keys = [None]
+        s = re.search(r'_\d{6}_\d{6}\.nc$', name)
+        if s and mode not in ['mpassi', 'mpaso']:
+            keys.append(name[:s.start()])
+        for key in keys:
+            if key in spans:
+                spans[key] = (min(spans[key][0], years[0]),
+                              max(spans[key][1], years[1]))
+            else:
+                spans[key] = years
+    if None not in spans:
+        raise ValueError(
+            "Unable to find the years of the input files in {}".format(path))
+    return spans
 
-def get_year_from_cmip(filename):
+
+def parse_monthly_filename(filename):
     """
-    Given a file name, assuming its a cmip file, return the start and end year
+    Given the name of a monthly history file, return its (prefix, year, month),
+    or None if it isnt one. The prefix identifies the case and component, i.e.
+    CASE.cam.h0 for CASE.cam.h0.YYYY-MM.nc and
+    mpaso.hist.am.timeSeriesStatsMonthly for
+    mpaso.hist.am.timeSeriesStatsMonthly.YYYY-MM-DD.nc
     """
-    p = r'\d{6}-\d{6}\.nc'
-    s = re.search(pattern=p, string=filename)
+    s = re.match(r'(.+)\.(\d{4})-(\d{2})(?:-\d{2})?\.nc$', filename)
     if not s:
-        raise ValueError("unable to match file years for {}".format(filename))
+        return None
+    return s.group(1), int(s.group(2)), int(s.group(3))
+# ------------------------------------------------------------------
+
+
+def get_input_dates(filename):
+    """
+    Given the name of an input file, return its start and end months as
+    YYYYMM integers, or None if the name has no dates. E3SM time series files
+    end with VAR_YYYYMM_YYYYMM.nc and monthly history files with YYYY-MM.nc or
+    YYYY-MM-DD.nc
+    """
+    s = re.search(r'_(\d{6})_(\d{6})\.nc$', filename)
+    if s:
+        return int(s.group(1)), int(s.group(2))
+    parsed = parse_monthly_filename(filename)
+    if parsed:
+        date = parsed[1] * 100 + parsed[2]
+        return date, date
+    return None
+# ------------------------------------------------------------------
+
+
+def get_input_years(filename):
+    """
+    Given the name of an input file, return its start and end years, or None
+    if the name has no dates
+    """
+    dates = get_input_dates(filename)
+    if dates is None:
+        return None
+    return dates[0] // 100, dates[1] // 100
+# ------------------------------------------------------------------
+
 
-    start, end = [int(x[:-2]) if not x.endswith('.nc') else int(x[:-5])
-                  for x in filename[s.span()[0]: s.span()[1]].split('-')]
+def parse_cmip_filename(filename):
+    """
+    Given the name of a CMIP file, VAR_TABLE_SOURCE_EXPERIMENT_MEMBER_GRID.nc
+    with _START-END dates for all but the fixed fields, return its
+    (var, table_id, start_year, end_year), or None if it isnt one. The years
+    are None for a file without dates
+    """
+    if not filename.endswith('.nc'):
+        return None
+    parts = filename.split('_')
+    if len(parts) < 6:
+        return None
+    s = re.search(r'_(\d{4})\d*-(\d{4})\d*(?:-clim)?\.nc$', filename)
+    if s:
+        return parts[0], parts[1], int(s.group(1)), int(s.group(2))
+    return parts[0], parts[1], None, None
+# ------------------------------------------------------------------
+
+
+def get_cmip_dates(filename):
+    """
+    Given the name of a CMIP file, return its start and end months as YYYYMM
+    integers, or None for a file without dates. The yearly tables date their
+    files YYYY-YYYY, which cover January of the first year to December of the
+    last
+    """
+    s = re.search(r'_(\d{4})(\d{2})?\d*-(\d{4})(\d{2})?\d*(?:-clim)?\.nc$',
+                  filename)
+    if not s:
+        return None
+    start = int(s.group(1)) * 100 + int(s.group(2) or 1)
+    end = int(s.group(3)) * 100 + int(s.group(4) or 12)
     return start, end
+# ------------------------------------------------------------------
 
 
-def precheck(inpath, outpath, variables, mode):
+def index_cmip_output(outpath):
+    """
+    Index the CMIP output tree with a single walk
+
+    Params:
+    -------
+        outpath (str): the root of the CMIP output tree
+    Returns:
+    --------
+        a dict of (var, table_id) to a list of (start_year, end_year, path)
+        sorted by start year, the years are None for fixed fields
+    """
+    index = dict()
+    if not os.path.exists(outpath):
+        return index
+    for root, _, files in os.walk(outpath):
+        for name in files:
+            parsed = parse_cmip_filename(name)
+            if parsed is None:
+                continue
+            var, table_id, start, end = parsed
+            index.setdefault((var, table_id), list()).append(
+                (start, end, os.path.join(root, name)))
+    for entries in index.values():
+        entries.sort(key=lambda x: (x[0] is not None, x[0], x[2]))
+    return index
+# ------------------------------------------------------------------
+
+
+def find_cmip_output(outpath, var_name, table, index=None):
+    """
+    Find the existing CMIP output files for a variable
+
+    Params:
+    -------
+        outpath (str): the root of the CMIP output tree
+        var_name (str): the CMIP variable name
+        table (str): the table of the variable, i.e. CMIP6_Amon.json
+        index (dict): the output tree from index_cmip_output, so many
+            variables can be looked up with a single walk of the tree
+    Returns:
+    --------
+        a list of (start_year, end_year, path) sorted by start year
+    """
+    if index is None:
+        index = index_cmip_output(outpath)
+    # CMOR names its files VAR_TABLE_SOURCE_EXPERIMENT_MEMBER_GRID_DATES.nc
+    table_id = os.path.basename(table).replace('CMIP6_', '').replace('.json', '')
+    return [x for x in index.get((var_name, table_id), list())
+            if x[0] is not None]
+# ------------------------------------------------------------------
+
+
+def precheck(inpath, outpath, variables, mode, handlers_path=None):
     """
     Check if the data has already been produced and skip
 
+    The input directory is listed once, and the output tree is indexed with a
+    single walk, however many variables are checked. A variable is found if
+    its output files together cover the years its raw variables all have
+    input for, or for fixed fields if it has any output
+
     returns a list of variable names that were not found in the output directory with matching years
     """
+    # the raw variables of each handler, so a variable whose time series
+    # cover fewer years than the others is checked against its own years
+    raw_variables = dict()
+    if handlers_path:
+        for handler in load_handlers(handlers_path, variables, info_only=True):
+            raw_variables[handler['name']] = handler['raw_variables']
+
+    spans = None
+    if mode != 'fx':
+        # First check the inpath for the start and end years
+        spans = get_raw_years(inpath, mode)
+
+    # then check the output tree for files with the correct variables for
+    # those years
+    years = dict()
+    for (var, _), entries in index_cmip_output(outpath).items():
+        years.setdefault(var, list()).extend(entries)
+
+    missing = list()
+    for var in variables:
+        entries = years.get(var, list())
+        start, end = None, None
+        if spans is not None:
+            # the years all the raw variables of the handler have input for
+            raw_spans = [spans.get(x, spans[None])
+                         for x in raw_variables.get(var, [None])]
+            start = max(x[0] for x in raw_spans)
+            end = min(x[1] for x in raw_spans)
+        if start is None or any(x[0] is None for x in entries):
+            found = bool(entries)
+        else:
+            found = covers_years(
+                [(x[0], x[1]) for x in entries], start, end)
+        if not found:
+            missing.append(var)
+    return missing
+# ------------------------------------------------------------------
 
-    # First check the inpath for the start and end years
-    start, end = get_years_from_raw(inpath, mode, variables[0])
-    var_map = [{'found': False, 'name': var} for var in variables]
-
-    # then check the output tree for files with the correct variables for those years
-    if mode in ['mpaso', 'mpassi']:
-        for val in var_map:
-            for _, _, files in os.walk(outpath, topdown=False):
-                if files:
-                    prefix = val['name'] + "_"
-                    if files[0][:len(prefix)] != prefix:
-                        continue
-                    files = [x for x in sorted(files) if x.endswith('.nc')]
-                    for f in files:
-                        cmip_start, cmip_end = get_year_from_cmip(f)
-                        if cmip_start == start and cmip_end == end:
-                            val['found'] = True
-                            break
-                    if val['found'] == True:
-                        break
-        
-        return [x['name'] for x in var_map if not x['found']]
-    else:
-        raise ValueError("still working on it")
+
+def covers_years(ranges, start, end):
+    """
+    Return True if the (start, end) year ranges together cover every year
+    from start to end
+    """
+    year = start
+    for range_start, range_end in sorted(ranges):
+        if range_start > year:
+            break
+        year = max(year, range_end + 1)
+        if year > end:
+            return True
+    return year > end
@@ -0,0 +1,178 @@
+"""
+Benchmark the output compression policy of e3sm_to_cmip
+
+Writes a 2D (Amon tas) and a 3D (Amon ta on plev19) variable on the
+180x360 CMIP grid with CMOR, once for each shuffle and deflate level
+setting, and reports the time spent in cmor.write and cmor.close and the
+size of the output file. The results help choose the --output-policy of a
+run, i.e. a deflate level per table.
+
+The data is a smooth synthetic field with a little noise, real model output
+usually compresses a little better. CMOR chooses the chunk shapes of its
+output itself, one time record per chunk, so they aren't part of the
+benchmark.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import os
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import cmor
+
+from e3sm_to_cmip.util import setup_cmor
+from e3sm_to_cmip.util import apply_output_policy
+from e3sm_to_cmip.util import copy_user_metadata
+from e3sm_to_cmip.util import set_output_policy
+
+# the pressure levels of the plev19 axis, in Pa
+PLEV19 = [100000., 92500., 85000., 70000., 60000., 50000., 40000., 30000.,
+          25000., 20000., 15000., 10000., 7000., 5000., 3000., 2000., 1000.,
+          500., 100.]
+
+VARIABLES = {
+    '2d': {'name': 'tas', 'units': 'K', 'levels': None},
+    '3d': {'name': 'ta', 'units': 'K', 'levels': PLEV19}
+}
+
+
+def make_field(num_times, levels=None, seed=0):
+    """
+    A smooth temperature like field of num_times months on the 180x360 grid,
+    with a level dimension if levels are given
+    """
+    rng = np.random.RandomState(seed)
+    lat = np.deg2rad(np.arange(-89.5, 90., 1.))
+    lon = np.deg2rad(np.arange(0.5, 360., 1.))
+    base = 250. + 40. * np.cos(lat)[:, None] + 2. * np.sin(3. * lon)[None, :]
+    shape = [num_times, 180, 360]
+    if levels:
+        shape.insert(1, len(levels))
+        base = base[None, :, :] - \
+            60. * (1. - np.array(levels)[:, None, None] / 100000.)
+    season = 5. * np.sin(2. * np.pi * np.arange(num_times) / 12.)
+    season = season.reshape([num_times] + [1] * (len(shape) - 1))
+    noise = rng.normal(scale=0.5, size=shape)
+    return (base + season + noise).astype(np.float32)
+
+
+def get_axes(num_times, levels=None):
+    """
+    The CMOR axis ids of the field
+    """
+    time_bnds = np.arange(num_times + 1) * 30.
+    axes = [cmor.axis(table_entry=str('time'),
+                      units=str('days since 1850-01-01'),
+                      coord_vals=(time_bnds[:-1] + time_bnds[1:]) / 2.,
+                      cell_bounds=time_bnds)]
+    if levels:
+        axes.append(cmor.axis(table_entry=str('plev19'),
+                              units=str('Pa'),
+                              coord_vals=np.array(levels)))
+    lat_bnds = np.arange(-90., 91., 1.)
+    lon_bnds = np.arange(0., 361., 1.)
+    axes.append(cmor.axis(table_entry=str('latitude'),
+                          units=str('degrees_north'),
+                          coord_vals=(lat_bnds[:-1] + lat_bnds[1:]) / 2.,
+                          cell_bounds=lat_bnds))
+    axes.append(cmor.axis(table_entry=str('longitude'),
+                          units=str('degrees_east'),
+                          coord_vals=(lon_bnds[:-1] + lon_bnds[1:]) / 2.,
+                          cell_bounds=lon_bnds))
+    return axes
+
+
+def write_variable(field, variable, table, shuffle, deflate_level):
+    """
+    Write the field with the given compression, returns the seconds spent
+    writing and closing it and the size of the file written
+    """
+    set_output_policy({'default': {
+        'shuffle': shuffle,
+        'deflate_level': deflate_level
+    }})
+    axes = get_axes(field.shape[0], variable['levels'])
+    varid = cmor.variable(str(variable['name']), str(variable['units']), axes)
+    apply_output_policy(varid, variable['name'], table)
+
+    start = time.time()
+    cmor.write(varid, field)
+    file_name = cmor.close(varid, file_name=True)
+    elapsed = time.time() - start
+
+    size = os.path.getsize(file_name)
+    os.remove(file_name)
+    return elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the CMOR writes and measure the output size for each compression setting")
+    parser.add_argument('-t', '--tables-path', required=True,
+                        help="path to the CMIP6 CMOR tables")
+    parser.add_argument('-u', '--user-metadata', required=True,
+                        help="the user metadata json file of e3sm_to_cmip")
+    parser.add_argument('-n', '--num-times', type=int, default=120,
+                        help="months of data to write, default is 120")
+    parser.add_argument('-d', '--deflate-levels', default='0,1,2,4,6,9',
+                        help="comma separated deflate levels to try, default is 0,1,2,4,6,9")
+    parser.add_argument('--variables', default='2d,3d',
+                        help="comma separated 2d and/or 3d, default is both")
+    parser.add_argument('--output',
+                        help="write the results to this json file")
+    parser.add_argument('--work-dir',
+                        help="where to write the output files, they are removed after each write. Default is a new temporary directory")
+    args = parser.parse_args(sys.argv[1:])
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='output_policy_')
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    copy_user_metadata(args.user_metadata, work_dir)
+    setup_cmor(
+        'benchmark', args.tables_path, 'CMIP6_Amon.json',
+        os.path.join(work_dir, 'user_metadata.json'),
+        logdir=os.path.join(work_dir, 'logs'))
+
+    levels = [int(x) for x in args.deflate_levels.split(',')]
+    results = list()
+    print('{:<4} {:>8} {:>8} {:>10} {:>12} {:>8}'.format(
+        'var', 'shuffle', 'deflate', 'seconds', 'MB', 'ratio'))
+    for kind in args.variables.split(','):
+        variable = VARIABLES[kind]
+        field = make_field(args.num_times, variable['levels'])
+        for shuffle in [False, True]:
+            for deflate_level in levels:
+                if not deflate_level and shuffle:
+                    # shuffle only applies to compressed variables
+                    continue
+                elapsed, size = write_variable(
+                    field, variable, 'CMIP6_Amon.json', shuffle, deflate_level)
+                result = {
+                    'variable': variable['name'],
+                    'kind': kind,
+                    'shuffle': shuffle,
+                    'deflate_level': deflate_level,
+                    'seconds': elapsed,
+                    'bytes': size,
+                    'ratio': float(field.nbytes) / size
+                }
+                results.append(result)
+                print('{:<4} {:>8} {:>8} {:>10.2f} {:>12.1f} {:>8.2f}'.format(
+                    kind, str(shuffle), deflate_level, elapsed,
+                    size / 1024. ** 2, result['ratio']))
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
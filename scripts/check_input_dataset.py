@@ -1,91 +1,176 @@
+"""
+Inventory the monthly history files under a directory tree and report the
+months missing for each case and component.
+
+The file names are parsed with the same function e3sm_to_cmip uses to find
+the years of its inputs, so the check agrees with the conversion.
+"""
 import argparse
 import sys
 import os
-import re
-from tqdm import tqdm
-
-
-def get_year(filename):
-    pattern = r'\d{4}-\d{2}'
-    s = re.search(pattern, filename)
-    if not s:
-        return 0, 0
-    else:
-        return int(filename[s.start(): s.end() - 3]), int(filename[s.end()-2: s.end()])
-
-
-def get_casename(filename):
-    pattern = r'\d{4}-\d{2}'
-    s = re.search(pattern, filename)
-    if s is not None:
-        return filename[:s.start()-1]
-    else:
-        return None
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from e3sm_to_cmip.util import parse_monthly_filename
+
+
+def scan_directory(path):
+    """
+    List one directory
+
+    Parameters
+    ----------
+    path (str): the directory to list
+
+    Returns
+    -------
+    the path, a list of file names and a list of sub-directory paths
+    """
+    files = list()
+    subdirs = list()
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.name)
+    except OSError as error:
+        print('Unable to read {}: {}'.format(path, error))
+    return path, files, subdirs
+
+
+def walk(data_path, max_workers=8):
+    """
+    Walk the directory tree listing directories in parallel, on parallel
+    filesystems the listing latency rather than the CPU bounds the walk
+
+    Parameters
+    ----------
+    data_path (str): the root of the tree
+    max_workers (int): the number of directories to list at once
+
+    Yields
+    ------
+    the path and the list of file names of each directory
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {pool.submit(scan_directory, data_path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, files, subdirs = future.result()
+                for subdir in subdirs:
+                    pending.add(pool.submit(scan_directory, subdir))
+                yield path, files
+
+
+def get_inventory(files):
+    """
+    Group the monthly files of a directory by case and component
+
+    Parameters
+    ----------
+    files (list): the file names in the directory
+
+    Returns
+    -------
+    a dict of filename prefix to the set of months present, each month as
+    year * 12 + month - 1
+    """
+    inventory = defaultdict(set)
+    for name in files:
+        parsed = parse_monthly_filename(name)
+        if parsed is None:
+            continue
+        prefix, year, month = parsed
+        inventory[prefix].add(year * 12 + month - 1)
+    return inventory
+
+
+def get_gaps(months, start_year=None, end_year=None):
+    """
+    Find the months missing from January of the start year to December of
+    the end year, by default the first and last years present
+
+    Parameters
+    ----------
+    months (set): the months present, as year * 12 + month - 1
+    start_year (int): the first year expected
+    end_year (int): the last year expected
+
+    Returns
+    -------
+    a list of (first, last) runs of missing months
+    """
+    if start_year is None:
+        start_year = min(months) // 12
+    if end_year is None:
+        end_year = max(months) // 12
+    gaps = list()
+    start = None
+    for month in range(start_year * 12, (end_year + 1) * 12):
+        if month in months:
+            if start is not None:
+                gaps.append((start, month - 1))
+                start = None
+        elif start is None:
+            start = month
+    if start is not None:
+        gaps.append((start, (end_year + 1) * 12 - 1))
+    return gaps
+
+
+def format_gap(first, last):
+    """
+    Format a run of missing months, as whole years when it covers them
+    """
+    first_year, first_month = divmod(first, 12)
+    last_year, last_month = divmod(last, 12)
+    if first_month == 0 and last_month == 11:
+        if first_year == last_year:
+            return '{:04d}'.format(first_year)
+        return '{:04d}-{:04d}'.format(first_year, last_year)
+    if first == last:
+        return '{:04d}-{:02d}'.format(first_year, first_month + 1)
+    return '{:04d}-{:02d} to {:04d}-{:02d}'.format(
+        first_year, first_month + 1, last_year, last_month + 1)
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--data-path')
+    parser.add_argument('--data-path', required=True)
+    parser.add_argument(
+        '--max-workers',
+        type=int,
+        default=8,
+        help="number of directories to list at once, default is 8")
+    parser.add_argument(
+        '--start',
+        type=int,
+        help="the first year expected, default is the first year present")
+    parser.add_argument(
+        '--end',
+        type=int,
+        help="the last year expected, default is the last year present")
     _args = parser.parse_args(sys.argv[1:])
 
-    for root, _, files in tqdm(os.walk(_args.data_path)):
-        if not files:
-            continue
-    
-        case = get_casename(files[0])
-        if not case:
-            continue
-
-        missing = list()
-        start, _ = get_year(files[0])
-        end, _ = get_year(files[-1])
-        if start == 0 or end == 0:
-            raise Exception('Unable to find start or end year')
-        files = sorted(files)
-
-        if 'cam.h0' in files[0]:
-
-            for year in range(start, end + 1):
-                for month in range(1, 13):
-                    name = '{casename}.{year:04d}-{month:02d}.nc'.format(
-                        casename=case, year=year, month=month)
-                    if name not in files:
-                        missing.append(name)
-
-        elif 'clm2.h0' in files[0]:
-
-            for year in range(start, end + 1):
-                for month in range(1, 13):
-                    name = '{casename}.{year:04d}-{month:02d}.nc'.format(
-                        casename=case, year=year, month=month)
-                    if name not in files:
-                        missing.append(name)
-
-        elif 'mpascice' in files[0]:
-
-            for year in range(start, end + 1):
-                for month in range(1, 13):
-                    name = 'mpascice.hist.am.timeSeriesStatsMonthly.{year:04d}-{month:02d}-01.nc'.format(
-                        year=year, month=month)
-                    if name not in files:
-                        missing.append(name)
-        
-        elif 'mpaso' in files[0]:
-
-            for year in range(start, end + 1):
-                for month in range(1, 13):
-                    name = 'mpaso.hist.am.timeSeriesStatsMonthly.{year:04d}-{month:02d}-01.nc'.format(
-                        year=year, month=month)
-                    if name not in files:
-                        missing.append(name)
-
-        if len(missing) == 0:
-            print('\n----- Found all files for {} -----'.format(case))
-        else:
-            print(
-                '\n\n-----------------------------\nThe following were missing from {}\n\n'.format(root))
-            for m in missing:
-                print('\t {}'.format(m))
+    complete = True
+    for root, files in walk(_args.data_path, _args.max_workers):
+        for prefix, months in sorted(get_inventory(files).items()):
+            first_year = min(months) // 12 if _args.start is None else _args.start
+            last_year = max(months) // 12 if _args.end is None else _args.end
+            gaps = get_gaps(months, first_year, last_year)
+            if not gaps:
+                print('----- Found all files for {} {:04d}-{:04d} in {} -----'.format(
+                    prefix, first_year, last_year, root))
+                continue
+            complete = False
+            print('----- {} {:04d}-{:04d} in {} is missing: {}'.format(
+                prefix, first_year, last_year, root,
+                ', '.join(format_gap(*gap) for gap in gaps)))
+
+    return 0 if complete else 1
 
 
 if __name__ == "__main__":
@@ -2,38 +2,62 @@ import os
 import sys
 import argparse
 import hashlib
-import multiprocessing
 import random
 import string
-from subprocess import Popen, PIPE
-from distributed import Client, as_completed, LocalCluster
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
+# bytes read per call, large enough that the hash, which releases the GIL,
+# does most of the work between reads
+BUFFER_SIZE = 8 * 1024 * 1024
 
-def hash_file(filepath, expected_hash):
+
+def compute_hash(filepath, algorithm='md5', buffer_size=BUFFER_SIZE):
+    """
+    Stream the file at the given path through hashlib
+
+    Parameters
+    ----------
+    filepath (str): the path to the file to hash
+    algorithm (str): the name of the hashlib algorithm, i.e. md5 or sha256
+    buffer_size (int): the number of bytes to read at a time
+
+    Returns
+    -------
+    the hex digest of the file
+    """
+    hasher = hashlib.new(algorithm)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(filepath, 'rb', buffering=0) as infile:
+        while True:
+            size = infile.readinto(buffer)
+            if not size:
+                break
+            hasher.update(view[:size])
+    return hasher.hexdigest()
+
+
+def hash_file(filepath, expected_hash, algorithm='md5'):
     """
     Hash a the file at the given path, and compare that to the expected value
 
     Parameters
     ----------
-    data_path (str): the path to the data directory
-    filename (str): the name of the file to check the hashes for
+    filepath (str): the path to the file to check the hash for
     expected_hash (str): the expected hash of that file
+    algorithm (str): the name of the hashlib algorithm
 
     Returns
     -------
     Filename, and True if they match, or False otherwise
     """
-    cmd = ['md5sum', filepath]
-    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    out, err = proc.communicate()
-
-    if err:
-        print('ERROR: {}'.format(err))
-        return filepath, False
-
-    hash, filepath = out.decode('utf-8').split('  ')
     _, filename = os.path.split(filepath)
+    try:
+        hash = compute_hash(filepath, algorithm)
+    except (IOError, OSError) as error:
+        print('ERROR: {}'.format(error))
+        return filename, False
 
     if hash != expected_hash:
         print(
@@ -43,6 +67,30 @@ def hash_file(filepath, expected_hash):
     return filename, True
 
 
+def load_hashes(hash_path):
+    """
+    Read the | delimited file of filenames and hashes
+
+    Parameters
+    ----------
+    hash_path (str): path to the file of filename|hash lines
+
+    Returns
+    -------
+    a dict of filename to expected hash
+    """
+    hashes = dict()
+    with open(hash_path, 'r') as infile:
+        for line in infile:
+            line = line.strip()
+            if not line:
+                continue
+            name, expected_hash = line.rsplit('|', 1)
+            _, name = os.path.split(name.strip())
+            hashes[name] = expected_hash.strip()
+    return hashes
+
+
 def main():
 
     parser = argparse.ArgumentParser()
@@ -54,8 +102,13 @@ def main():
         help="path to | delimited file containing filenames and md5sums")
     parser.add_argument(
         '--max-jobs',
-        help="max number of jobs to run at once, default is the number of CPUs on the machine",
-        default=1)
+        help="max number of files to hash at once, default is 4",
+        default=4)
+    parser.add_argument(
+        '--algorithm',
+        default='md5',
+        choices=sorted(hashlib.algorithms_guaranteed),
+        help="the hash algorithm of the hashes in the md5-path file, default is md5")
     parser.add_argument(
         '--file-list',
         nargs="*",
@@ -75,38 +128,36 @@ def main():
         print("Given md5_hash file does not exist")
         return 1
 
-    print("setting up local cluster")
-    cluster = LocalCluster(
-        n_workers=args.max_jobs,
-        threads_per_worker=4,
-        interface='lo')
-    client = Client(address=cluster.scheduler_address)
-
-    pbar = tqdm(total=len(args.file_list), desc="Checking files")
-    results = []
-    with open(args.md5_path, 'r') as infile:
-        for line in infile.readlines():
-            for target_path in args.file_list:
-                _, target_file_name = os.path.split(target_path)
-                if target_file_name not in line:
-                    continue
-                _, expected_hash = line.split('|')
-                results.append(
-                    client.submit(
-                        hash_file,
-                        target_path,
-                        expected_hash.strip()))
-
-    all_match = True
+    expected = load_hashes(args.md5_path)
+
+    # the hashing is bound by the storage bandwidth, not the CPU, so more
+    # threads than cores can help on parallel filesystems
+    results = list()
     not_match = list()
-    for future, result in as_completed(results):
-        pbar.update(1)
-        name, match = result
-        if not match:
-            all_match = False
-            not_match.append(name)
-            print("ERROR: {}".format(name))
-    pbar.close()
+    with ThreadPoolExecutor(max_workers=int(args.max_jobs)) as pool:
+        for target_path in args.file_list:
+            _, target_file_name = os.path.split(target_path)
+            expected_hash = expected.get(target_file_name)
+            if expected_hash is None:
+                print("WARNING: no hash for {}".format(target_file_name))
+                continue
+            results.append(
+                pool.submit(
+                    hash_file,
+                    target_path,
+                    expected_hash,
+                    args.algorithm))
+
+        pbar = tqdm(total=len(results), desc="Checking files")
+        for future in as_completed(results):
+            pbar.update(1)
+            name, match = future.result()
+            if not match:
+                not_match.append(name)
+                print("ERROR: {}".format(name))
+        pbar.close()
+
+    all_match = not not_match
 
     if all_match:
         if args.label:
@@ -132,12 +183,12 @@ def main():
         print(msg)
         if args.write_to_file:
             op.write(msg + '\n')
-        try:
-            for i in not_match:
-                msg = "\t{}".format(i)
-                print(msg)
+        for i in not_match:
+            msg = "\t{}".format(i)
+            print(msg)
+            if args.write_to_file:
                 op.write(msg + '\n')
-        finally:
+        if args.write_to_file:
             op.close()
         return 0
 
@@ -7,11 +7,16 @@ import tempfile
 import sqlite3
 import json
 import socket
+import threading
+import time
 import webbrowser
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from fnmatch import fnmatch
 import globus_sdk
 from fair_research_login.client import NativeClient
 from zstash.hpss import hpss_get
-from zstash.extract import multiprocess_extract, extractFiles
+from zstash.extract import extractFiles
 from zstash.settings import config, DB_FILENAME, logger
 
 
@@ -38,12 +43,251 @@ patterns = {
     "namelist": ["*mpas-o_in", "*mpaso_in"]
 }
 
+# the components that need the restart (mesh) and namelist files as well as
+# their own, so they are ready only once the restart group is
+restart_components = ["ocean", "ice"]
+
 
 client_id = "41808cb4-f058-48ed-8974-841d1350bd98"
 scopes = ("openid email profile "
           "urn:globus:auth:scope:transfer.api.globus.org:all")
 
 
+def get_pattern_list(p):
+    """
+    Return the patterns of a component, which may be a string or a list
+    """
+    if isinstance(p, str):
+        return [p]
+    elif isinstance(p, list):
+        return p
+    return []
+
+
+def get_variable_patterns(variable):
+    """
+    Return the patterns of the time series files of a raw variable,
+    VAR_YYYYMM_YYYYMM.nc, at the top of the archive or in any directory
+    """
+    name = "{}_[0-9][0-9][0-9][0-9][0-9][0-9]_[0-9][0-9][0-9][0-9][0-9][0-9].nc".format(variable)
+    return [name, "*/" + name]
+
+
+def group_files(matches, groups):
+    """
+    Assign the matched files to the groups whose patterns they match, a
+    group is ready once all of its files are extracted. A pattern matches
+    the path of the file in the archive, its name or its tar
+
+    Parameters:
+        matches (list): rows of the zstash files table
+        groups (dict): group name to a list of name patterns
+    Returns:
+        an OrderedDict of group name to the set of its file names
+    """
+    members = OrderedDict()
+    for name, group_patterns in groups.items():
+        names = set(m[1] for m in matches
+                    if any(fnmatch(m[1], p) or fnmatch(os.path.basename(m[1]), p)
+                           or fnmatch(m[5], p)
+                           for p in group_patterns))
+        if names:
+            members[name] = names
+    return members
+
+
+def group_by_tar(matches):
+    """
+    Group the matched files by tar archive, in tar and offset order, so
+    each archive is read once from start to end
+
+    Parameters:
+        matches (list): rows of the zstash files table
+    Returns:
+        an OrderedDict of tar name to its rows
+    """
+    tars = OrderedDict()
+    for m in sorted(matches, key=lambda x: (x[5], x[6])):
+        tars.setdefault(m[5], []).append(m)
+    return tars
+
+
+def is_extracted(match):
+    """
+    True if the file of the row was already extracted by an earlier run
+    """
+    return os.path.exists(match[1]) and os.path.getsize(match[1]) == match[2]
+
+
+def extract_tar(rows):
+    """
+    Extract the files of one tar archive, returns the rows that failed
+    """
+    return extractFiles(rows, True)
+
+
+def stage(matches, groups, workers=1, extract=extract_tar, on_ready=None):
+    """
+    Extract the matched files, up to workers tar archives at a time, and
+    report each group of files as soon as all of its files are extracted.
+    Files left by an earlier run are not extracted again.
+
+    Parameters:
+        matches (list): rows of the zstash files table
+        groups (dict): group name to the set of its file names, see group_files
+        workers (int): the number of tar archives to extract at once
+        extract (function): extracts the rows of a tar, returns the failed rows
+        on_ready (function): called with the group name and its file names
+    Returns:
+        the list of rows that failed to extract
+    """
+    pending = OrderedDict((name, set(names)) for name, names in groups.items())
+
+    def mark_extracted(names):
+        for name, remaining in list(pending.items()):
+            remaining.difference_update(names)
+            if not remaining:
+                del pending[name]
+                logger.info("All files of {} are extracted".format(name))
+                if on_ready:
+                    on_ready(name, sorted(groups[name]))
+
+    todo = OrderedDict()
+    done = list()
+    for tar, rows in group_by_tar(matches).items():
+        missing = [m for m in rows if not is_extracted(m)]
+        done.extend(m[1] for m in rows if m not in missing)
+        if missing:
+            todo[tar] = missing
+    if done:
+        logger.info("{} files were already extracted".format(len(done)))
+    mark_extracted(done)
+
+    failures = list()
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = dict()
+        for tar, rows in todo.items():
+            futures[pool.submit(extract, rows)] = rows
+        for future in as_completed(futures):
+            rows = futures[future]
+            try:
+                failed = future.result() or list()
+            except Exception as e:
+                logger.error("Extraction failed due to error: {}".format(e))
+                failed = rows
+            failures.extend(failed)
+            failed_names = set(m[1] for m in failed)
+            mark_extracted([m[1] for m in rows if m[1] not in failed_names])
+
+    return failures
+
+
+class ReadyGroups(object):
+    """
+    Report each group ready once its files, and those of the groups it
+    depends on, are transferred to the destination
+
+    Parameters:
+        groups (dict): group name to the set of its file names
+        depends (dict): group name to the names of the groups it needs
+        on_ready (function): called with the group name and all the file
+            names it needs, its own and those of its dependencies
+    """
+
+    def __init__(self, groups, depends=None, on_ready=None):
+        self.groups = groups
+        self.depends = depends or dict()
+        self.on_ready = on_ready
+        self.transferred = set()
+        self.reported = set()
+        self.lock = threading.Lock()
+
+    def transfer_done(self, name):
+        """
+        Record that the transfer of a group succeeded, and report the groups
+        that are now ready
+        """
+        with self.lock:
+            self.transferred.add(name)
+            for group in self.groups:
+                if group in self.reported or group not in self.transferred:
+                    continue
+                needed = [d for d in self.depends.get(group, []) if d in self.groups]
+                if not all(d in self.transferred for d in needed):
+                    continue
+                self.reported.add(group)
+                names = set(self.groups[group])
+                for d in needed:
+                    names.update(self.groups[d])
+                if self.on_ready:
+                    self.on_ready(group, sorted(names))
+
+
+def write_event(path, event, **kwargs):
+    """
+    Append a json event line to the events file, if there is one
+    """
+    if not path:
+        return
+    kwargs['event'] = event
+    kwargs['time'] = time.time()
+    with open(path, "a") as f:
+        f.write(json.dumps(kwargs) + "\n")
+
+
+def submit_transfer(tc, source_endpoint, destination_endpoint, destination_dir, names, label):
+    """
+    Submit a Globus transfer of the files in the current directory,
+    returns the task id
+    """
+    td = globus_sdk.TransferData(tc, source_endpoint, destination_endpoint, label=label)
+    cwd = os.getcwd()
+    for name in names:
+        td.add_item(os.path.join(cwd, name), os.path.join(destination_dir, name))
+    task = tc.submit_transfer(td)
+    return task.get("task_id")
+
+
+def wait_for_transfer(tc, task_id):
+    """
+    Wait for a Globus transfer, returns True if it succeeded
+
+    A Globus transfer job (task) can be in one of the three states: ACTIVE, SUCCEEDED, FAILED.
+    The Data Stager polls a status of the transfer job (task) from the Globus Transfer service
+    every 15 seconds with 60 second timeout limit. If the task is ACTIVE after time runs out,
+    'tc.task_wait()' returns False, and True otherwise.
+    """
+    last_event_time = None
+    while not tc.task_wait(task_id, 60, 15):
+        task = tc.get_task(task_id)
+        # Get the last error Globus event
+        events = tc.task_event_list(task_id, num_results=1, filter="is_error:1")
+        try:
+            event = next(events)
+        except StopIteration:
+            continue
+        # Log the error event if it was not yet logged
+        if event["time"] != last_event_time:
+            last_event_time = event["time"]
+            logger.warn("Non-critical Globus Transfer error event: {} at {}".format(event["description"], event["time"]))
+            logger.warn("Globus Transfer error details: {}".format(event["details"]))
+
+    """
+    The Globus transfer job (task) has been terminated (is not ACTIVE). Check if the transfer
+    SUCCEEDED or FAILED.
+    """
+    task = tc.get_task(task_id)
+    if task["status"] == "SUCCEEDED":
+        logger.info("Globus transfer {} succeeded".format(task_id))
+        return True
+    logger.error("Globus Transfer task: {}".format(task_id))
+    events = tc.task_event_list(task_id, num_results=1, filter="is_error:1")
+    event = next(events)
+    logger.error("Globus transfer {} failed due to error: {}".format(task_id, event["details"]))
+    return False
+
+
+
 def main(args):
 
     # Obtain Globus tokens
@@ -102,38 +346,44 @@ def main(args):
     if args.component:
         components = args.component.split(",")
 
-    # Data file patterns
-    file_patterns = []
+    # Data file patterns, grouped by component so each component can be
+    # reported ready on its own. The time series files of the given raw
+    # variables are grouped by variable instead, since a variable can be
+    # converted once its own files are there
+    groups = OrderedDict()
     for c in components:
-        p = patterns.get(c)
-        if isinstance(p, str):
-            file_patterns.append(p)
-        elif isinstance(p, list):
-            file_patterns = file_patterns + p
-    file_patterns = file_patterns + args.files
+        groups[c] = get_pattern_list(patterns.get(c))
+    group_kinds = dict((c, "component") for c in components)
+    if args.variables:
+        for v in args.variables.split(","):
+            groups[v] = get_variable_patterns(v)
+            group_kinds[v] = "variable"
+    if args.files:
+        groups["files"] = args.files
+    file_patterns = [p for g in groups.values() for p in g]
     if not file_patterns:
         file_patterns = ["*"]
+        groups["files"] = file_patterns
     logger.debug("File patterns: {}".format(file_patterns))
 
     # Restart file patterns
-    p = patterns.get("restart")
-    if isinstance(p, str):
-        restart_patterns = [p]
-    elif isinstance(p, list):
-        restart_patterns = p
+    restart_patterns = get_pattern_list(patterns.get("restart"))
     logger.debug("Restart file patterns: {}".format(restart_patterns))
 
     # Namelist file patterns
-    p = patterns.get("namelist")
-    if isinstance(p, str):
-        namelist_patterns = [p]
-    elif isinstance(p, list):
-        namelist_patterns = p
+    namelist_patterns = get_pattern_list(patterns.get("namelist"))
     logger.debug("Namelist file patterns: {}".format(namelist_patterns))
 
-    # Create temporary directory for all zstash files, etc.
-    tmp_directory = tempfile.mkdtemp(prefix="stager-", dir=".")
+    # Create temporary directory for all zstash files, etc. A given work
+    # directory is reused, so a restarted run skips the files already extracted
+    if args.work_dir:
+        tmp_directory = os.path.abspath(args.work_dir)
+        if not os.path.exists(tmp_directory):
+            os.makedirs(tmp_directory)
+    else:
+        tmp_directory = tempfile.mkdtemp(prefix="stager-", dir=".")
     os.chdir(tmp_directory)
+    events_path = os.path.abspath(args.events) if args.events else None
 
     # Download and open database
     logger.info('Opening index database')
@@ -206,15 +456,67 @@ def main(args):
     matches = matches[:insert_idx+1]
     logger.info("{} matching files including restart and namelist files".format(len(matches)))
 
-    # Sort by tape and offset, so that we make sure that extract the files by tape order.
-    matches.sort(key=lambda x: (x[5], x[6]))
+    # The restart and namelist files are needed by every ocean and sea-ice
+    # variable, they are a group of their own so they are transferred once
+    members = group_files(matches, groups)
+    extra_names = set(m[1] for m in restart_matches + namelist_matches)
+    for names in members.values():
+        names.difference_update(extra_names)
+    for name in [n for n, names in members.items() if not names]:
+        del members[name]
+    depends = dict()
+    if extra_names:
+        members["restart"] = extra_names
+        group_kinds["restart"] = "restart"
+        for c in restart_components:
+            depends[c] = ["restart"]
 
-    # Retrieve from tapes
-    if args.workers > 1:
-        logger.debug("Running zstash with multiprocessing")
-        failures = multiprocess_extract(args.workers, matches, True)
+    if args.t:
+        label = args.t
     else:
-        failures = extractFiles(matches, True)
+        label = "E3SM Data Stager on {}".format(hostname)
+
+    # Transfer each group as soon as all of its files are extracted, while
+    # the tar archives of the other groups are still being extracted. With
+    # --events each transfer is waited on, and the group is reported ready
+    # once its files, and the restart files it needs, are at the destination
+    task_ids = []
+    waits = []
+    waiter = ThreadPoolExecutor(max_workers=4) if events_path else None
+
+    def on_ready(name, names):
+        write_event(events_path, "ready", group=name,
+                    kind=group_kinds.get(name, "files"), files=names)
+
+    ready = ReadyGroups(members, depends, on_ready)
+
+    def wait_for_group(name, task_id):
+        if wait_for_transfer(tc, task_id):
+            write_event(events_path, "transferred", group=name, task_id=task_id)
+            ready.transfer_done(name)
+            return True
+        write_event(events_path, "transfer_failed", group=name, task_id=task_id)
+        return False
+
+    def on_extracted(name, names):
+        write_event(events_path, "extracted", group=name, files=names)
+        try:
+            task_id = submit_transfer(
+                tc, source_endpoint, destination_endpoint, destination_dir,
+                names, "{} {}".format(label, name))
+        except Exception as e:
+            logger.error("Globus transfer of {} failed due to error: {}".format(name, e))
+            write_event(events_path, "transfer_failed", group=name)
+            return
+        logger.info("Submitted Globus transfer of {}: {}".format(name, task_id))
+        write_event(events_path, "transfer_submitted", group=name, task_id=task_id)
+        if waiter is not None:
+            waits.append(waiter.submit(wait_for_group, name, task_id))
+        else:
+            task_ids.append(task_id)
+
+    # Retrieve from tapes
+    failures = stage(matches, members, workers=args.workers, on_ready=on_extracted)
 
     # Close database
     logger.debug('Closing index database')
@@ -228,6 +530,7 @@ def main(args):
         logger.error("The following tar archives had errors:")
         for tar in broken_tars:
             logger.error(tar)
+        write_event(events_path, "failed", tars=broken_tars)
         sys.exit(1)
 
     # Create a manifest file
@@ -238,73 +541,46 @@ def main(args):
                 "length": m[2],
                 "md5": m[4]
         })
+    manifest_name = ""
     if args.m:
         manifest_name = args.m + "-"
     manifest_name += "manifest.json"
     with open(manifest_name, "w+") as f:
         f.write(json.dumps(manifest))
 
-    # Transfer the files downloaded from the zstash archive
-    if args.t:
-        label = args.t
-    else:
-        label = "E3SM Data Stager on {}".format(hostname)
-    td = globus_sdk.TransferData(tc, source_endpoint, destination_endpoint, label=label)
-
-    cwd = os.getcwd()
-    source_path = os.path.join(cwd, manifest_name)
-    destination_path = os.path.join(destination_dir, manifest_name)
-    td.add_item(source_path, destination_path)
-    for m in matches:
-        source_path = os.path.join(cwd, m[1])
-        destination_path = os.path.join(destination_dir, m[1])
-        td.add_item(source_path, destination_path)
-
+    # Transfer the manifest and any files that were in no group
+    grouped = set(n for names in members.values() for n in names)
+    names = [manifest_name] + [m[1] for m in matches if m[1] not in grouped]
     try:
-        task = tc.submit_transfer(td)
-        task_id = task.get("task_id")
+        task_id = submit_transfer(
+            tc, source_endpoint, destination_endpoint, destination_dir,
+            names, label)
         logger.info("Submitted Globus transfer: {}".format(task_id))
+        task_ids.append(task_id)
     except Exception as e:
         logger.error("Globus transfer failed due to error: {}".format(e))
         sys.exit(1)
 
-    if not args.block:
-        logger.info("You can monitor the status of the transfer at https://app.globus.org/activity/{}".format(task_id))
+    if not args.block and waiter is None:
+        for task_id in task_ids:
+            logger.info("You can monitor the status of the transfer at https://app.globus.org/activity/{}".format(task_id))
         sys.exit(0)
 
-    """
-    A Globus transfer job (task) can be in one of the three states: ACTIVE, SUCCEEDED, FAILED.
-    The Data Stager polls a status of the transfer job (task) from the Globus Transfer service
-    every 15 seconds with 60 second timeout limit. If the task is ACTIVE after time runs out,
-    'tc.task_wait()' returns False, and True otherwise.
-    """
-    last_event_time = None
-    while not tc.task_wait(task_id, 60, 15):
-        task = tc.get_task(task_id)
-        # Get the last error Globus event
-        events = tc.task_event_list(task_id, num_results=1, filter="is_error:1")
+    succeeded = True
+    for task_id in task_ids:
+        if not wait_for_transfer(tc, task_id):
+            succeeded = False
+    for future in as_completed(waits):
         try:
-            event = next(events)
-        except StopIteration:
-            continue
-        # Log the error event if it was not yet logged
-        if event["time"] != last_event_time:
-            last_event_time = event["time"]
-            logger.warn("Non-critical Globus Transfer error event: {} at {}".format(event["description"], event["time"]))
-            logger.warn("Globus Transfer error details: {}".format(event["details"]))
-
-    """
-    The Globus transfer job (task) has been terminated (is not ACTIVE). Check if the transfer
-    SUCCEEDED or FAILED.
-    """
-    task = tc.get_task(task_id)
-    if task["status"] == "SUCCEEDED":
-        logger.info("Globus transfer {} succeeded".format(task_id))
-    else:
-        logger.error("Globus Transfer task: {}".format(task_id))
-        events = tc.task_event_list(task_id, num_results=1, filter="is_error:1")
-        event = next(events)
-        logger.error("Globus transfer {} failed due to error: {}".format(task_id, event["details"]))
+            if not future.result():
+                succeeded = False
+        except Exception as e:
+            logger.error("Waiting for a Globus transfer failed due to error: {}".format(e))
+            succeeded = False
+    if waiter is not None:
+        waiter.shutdown()
+    write_event(events_path, "done" if succeeded else "transfer_failed")
+    if not succeeded:
         sys.exit(1)
 
     if args.e:
@@ -336,12 +612,21 @@ if __name__ == "__main__":
                         help="zstash archive path")
     parser.add_argument("-c", "--component",
                         help="comma separated components to download (atm, lnd, ice, river, ocean)")
+    parser.add_argument("-v", "--variables",
+                        help="comma separated raw variables whose VAR_YYYYMM_YYYYMM.nc time series files are staged, each reported ready on its own")
     parser.add_argument("-f", "--pattern-file",
                         help="Pattern file. By default, the patterns are: " + json.dumps(patterns))
     parser.add_argument("-e", action="store_true",
                         help="Remove all files downloaded from HPSS and extracted, after a Globus transfer succeeded. The option requires -b.")
     parser.add_argument("-w", "--workers", type=int, default=1,
-                        help="Number of workers untarring zstash files")
+                        help="Number of zstash tar archives extracted at once")
+    parser.add_argument("--work-dir",
+                        help="Directory for the downloaded and extracted files. A restarted run with the same directory skips the files that were already extracted."
+                        " By default a new temporary directory is created.")
+    parser.add_argument("--events",
+                        help="Append json lines to this file as each component, variable and the restart files are extracted and transferred."
+                        " A ready event is written once a group's files, and for ocean and ice the restart files, are at the destination, so a conversion can start on it before the whole stage-in is done."
+                        " The script waits for the transfers, as with -b")
     parser.add_argument("files", nargs="*",
                         help="List of files to be staged in (standards wildcards supported)")
     args = parser.parse_args()
@@ -1,15 +1,20 @@
 import sys
 import os
+import time
+import sqlite3
 import yaml
 import argparse
 from tqdm import tqdm
-from multiprocessing.pool import ThreadPool
-from pyesgf.search import SearchConnection
 
 from requests.exceptions import HTTPError
 
 debug = False
 
+ESGF_NODE = 'https://esgf-node.llnl.gov/esg-search'
+
+# seconds an index of the published files is used before it's fetched again
+INDEX_TTL = 24 * 60 * 60
+
 
 def get_cmip_start_end(filename):
     if 'clim' in filename:
@@ -18,105 +23,168 @@ def get_cmip_start_end(filename):
         return int(filename[-16:-12]), int(filename[-9: -5])
 
 
-def check_esgf_for_variable(variable, spec, case, ens):
-
+def get_expected_spans(spec, case, freq):
+    """
+    Return the (start, end) years of the files expected for a case, given
+    the number of years per file
+    """
+    case_start = spec['cases'][case]['start']
+    case_end = spec['cases'][case]['end']
+    spans = list()
+    for s_start in range(case_start, case_end, freq):
+        spans.append((s_start, min(s_start + freq - 1, case_end)))
+    return spans
+
+
+def find_missing_spans(variable, filenames, spec, case):
+    """
+    Compare the files of a variable against the spans expected for the case,
+    the number of years per file is taken from the first file
+
+    Returns a list of the missing spans
+    """
+    if any('_fx_' in f for f in filenames):
+        return list()
+    found = set(get_cmip_start_end(f) for f in filenames)
+    start, end = get_cmip_start_end(min(filenames))
     missing = list()
+    for s_start, s_end in get_expected_spans(spec, case, end - start + 1):
+        if (s_start, s_end) not in found:
+            missing.append("{var}-{start:04d}-{end:04d}".format(
+                var=variable, start=s_start, end=s_end))
+    return missing
 
-    connection = SearchConnection(
-        'https://esgf-node.llnl.gov/esg-search', distrib=False)
 
-    if debug:
-        print("Checking ESGF for {}".format(variable))
+def esgf_search_files(case, ens, retries=5):
+    """
+    Query the ESGF node once for the names of every file published for a
+    case and ensemble member, retrying with exponential backoff
 
-    error = False
-    for i in range(5):
+    Returns a list of file names
+    """
+    from pyesgf.search import SearchConnection
+
+    connection = SearchConnection(ESGF_NODE, distrib=False)
+    for attempt in range(retries):
         try:
-            res = connection.new_context(project="CMIP6", source_id="E3SM-1-0", experiment_id=case,
-                                         variant_label="r{}i1p1f1".format(ens), variable_id=variable).search()
+            context = connection.new_context(
+                search_type='File',
+                project="CMIP6",
+                source_id="E3SM-1-0",
+                experiment_id=case,
+                variant_label="r{}i1p1f1".format(ens))
+            return [f.filename for f in context.search(batch_size=1000)]
         except HTTPError as httperror:
-            error = True
-            print("HTTPerror on {}-{}-{}".format(case, ens, variable))
+            print("HTTPerror on {}-{}".format(case, ens))
             print(httperror)
-        else:
-            error = False
-            break
-
-    if error:
-        print("Too many HTTPerrors for {}-{}-{}".format(case, ens, variable))
-        return missing
-
-    if not res:
-        missing.append(
-            "{}-{}-{} missing all files".format(case, ens, variable))
-        return missing
-    else:
-        filenames = list()
-        for x in res:
-            filenames.extend([f.filename for f in x.file_context().search()])
-
-        if not filenames:
-            missing.append(
-                "{}-{}-{} missing all files".format(case, ens, variable))
-            return missing
-
-        start, end = get_cmip_start_end(filenames[0])
-        freq = end - start + 1
-        spans = list(range(spec['cases'][case]['start'],
-                           spec['cases'][case]['end'], freq))
-
-        for span in spans:
-            found_span = False
-            s_start = span
-            s_end = span + freq - 1
-            if s_end > spec['cases'][case]['end']:
-                s_end = spec['cases'][case]['end']
-            for f in filenames:
-                f_start, f_end = get_cmip_start_end(f)
-                if f_start == s_start and f_end == s_end:
-                    found_span = True
-                    break
-            if not found_span:
-                missing.append("{var}-{start:04d}-{end:04d}".format(
-                    var=variable, start=s_start, end=s_end))
-
-    return missing
-
-
-def check_esgf(variables, spec, case, ens, max_connections):
-
+            if attempt < retries - 1:
+                time.sleep(2 ** attempt)
+    raise IOError("Too many HTTPerrors for {}-{}".format(case, ens))
+
+
+class PublishedIndex(object):
+    """
+    A local SQLite cache of the files published to ESGF
+
+    The files of a case and ensemble member are fetched with a single query
+    through the search function, and used until they are older than the ttl.
+    Any function that takes (case, ens) and returns the published file names
+    can stand in for the ESGF search, i.e. in tests.
+    """
+
+    def __init__(self, path, ttl=INDEX_TTL, search=esgf_search_files):
+        self.ttl = ttl
+        self.search = search
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS queries '
+                '(case_name TEXT, ens INTEGER, fetched REAL, '
+                'PRIMARY KEY (case_name, ens))')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS files '
+                '(case_name TEXT, ens INTEGER, variable TEXT, filename TEXT)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS files_case '
+                'ON files (case_name, ens)')
+
+    def close(self):
+        self.connection.close()
+
+    def refresh(self, case, ens):
+        """
+        Fetch the published files of a case and ensemble member
+        """
+        filenames = self.search(case, ens)
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM files WHERE case_name = ? AND ens = ?',
+                (case, ens))
+            self.connection.executemany(
+                'INSERT INTO files VALUES (?, ?, ?, ?)',
+                [(case, ens, f.split('_')[0], f) for f in filenames])
+            self.connection.execute(
+                'INSERT OR REPLACE INTO queries VALUES (?, ?, ?)',
+                (case, ens, time.time()))
+
+    def get_files(self, case, ens):
+        """
+        Return a dict of variable name to the list of its published files,
+        fetching them first if the index has none or they are out of date
+        """
+        ens = int(ens)
+        row = self.connection.execute(
+            'SELECT fetched FROM queries WHERE case_name = ? AND ens = ?',
+            (case, ens)).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            if debug:
+                print("Fetching the ESGF index for {}-{}".format(case, ens))
+            self.refresh(case, ens)
+
+        files = dict()
+        for variable, filename in self.connection.execute(
+                'SELECT variable, filename FROM files '
+                'WHERE case_name = ? AND ens = ?', (case, ens)):
+            files.setdefault(variable, list()).append(filename)
+        return files
+
+
+def check_esgf(variables, spec, case, ens, index):
+    """
+    Returns the variables and spans of the case missing from ESGF, or None
+    if the published files couldn't be fetched
+    """
     all_tables = [x for x in spec['tables']]
     all_vars = list()
     for table in all_tables:
         all_vars.extend(spec['tables'][table])
 
-    num_vars = 0
     vars_expected = list()
 
     if 'all' in variables:
-        num_vars = len(all_vars)
+        vars_expected = all_vars[:]
     else:
         for v in variables:
             if v in all_tables:
-                num_vars += len(spec['tables'][v])
                 vars_expected.extend(spec['tables'][v])
             else:
-                num_vars += 1
                 vars_expected.append(v)
 
-    results = list()
-    pool = ThreadPool(max_connections)
-
-    for v in vars_expected:
-        results.append(pool.apply_async(
-            check_esgf_for_variable, (
-                v,
-                spec,
-                case,
-                ens)))
+    try:
+        published = index.get_files(case, ens)
+    except IOError as error:
+        print(error)
+        return None
 
     esgf_missing = list()
-    for m in tqdm(results, leave=True):
-        esgf_missing.extend(m.get(999999))
+    for variable in vars_expected:
+        filenames = published.get(variable)
+        if not filenames:
+            esgf_missing.append(
+                "{}-{}-{} missing all files".format(case, ens, variable))
+            continue
+        esgf_missing.extend(
+            find_missing_spans(variable, filenames, spec, case))
 
     return esgf_missing
 
@@ -174,27 +242,7 @@ def check_case(path, variables, spec, case, ens, published):
                 if debug:
                     print("{} not in expected list, skipping".format(var))
 
-            if "_fx_" in files[0]:
-                continue
-            start, end = get_cmip_start_end(files[0])
-            freq = end - start + 1
-            spans = list(range(spec['cases'][case]['start'],
-                               spec['cases'][case]['end'], freq))
-
-            for span in spans:
-                found_span = False
-                s_start = span
-                s_end = span + freq - 1
-                if s_end > spec['cases'][case]['end']:
-                    s_end = spec['cases'][case]['end']
-                for f in files:
-                    f_start, f_end = get_cmip_start_end(f)
-                    if f_start == s_start and f_end == s_end:
-                        found_span = True
-                        break
-                if not found_span:
-                    missing.append("{var}-{start:04d}-{end:04d}".format(
-                        var=var, start=s_start, end=s_end))
+            missing.extend(find_missing_spans(var, files, spec, case))
 
             pbar.update(1)
 
@@ -220,7 +268,11 @@ def main():
     parser.add_argument('--published', action="store_true",
                         help="Check the LLNL ESGF node to see if the variables have been published, this can take a while")
     parser.add_argument('-m', '--max-connections', type=int, default=5,
-                        help="Maximum number of simultanious connections to ESGF node, more connections makes the ESGF search go faster but may also cause time-outs")
+                        help="Unused, the ESGF index is fetched with a single query per case and ensemble member")
+    parser.add_argument('--index-path', default='esgf_index.sqlite',
+                        help="path to the local cache of the files published to ESGF, default is esgf_index.sqlite")
+    parser.add_argument('--index-ttl', type=float, default=INDEX_TTL / 3600.0,
+                        help="hours before the cached ESGF index of a case is fetched again, default is {:g}".format(INDEX_TTL / 3600.0))
     parser.add_argument('--debug', action="store_true")
     args = parser.parse_args(sys.argv[1:])
 
@@ -230,7 +282,9 @@ def main():
     cases = args.cases
     ens = args.ens
     published = args.published
-    max_connections = args.max_connections
+    index = None
+    if published:
+        index = PublishedIndex(args.index_path, ttl=args.index_ttl * 3600)
 
     if args.debug:
         print("Running in debug mode")
@@ -244,6 +298,9 @@ def main():
     with open(spec_path, 'r') as ip:
         case_spec = yaml.load(ip, Loader=yaml.SafeLoader)
 
+    # the cases whose published files couldnt be fetched from ESGF
+    unchecked = list()
+
     for casedir in os.listdir(data_path):
         _, case = os.path.split(casedir)
         if casedir in cases or cases == ['all']:
@@ -279,17 +336,26 @@ def main():
                         spec=case_spec,
                         case=case,
                         ens=ensemble,
-                        max_connections=max_connections)
+                        index=index)
 
-                    if esgf_missing:
+                    if esgf_missing is None:
+                        print(
+                            "{case}-ens{ens} could not be checked on ESGF".format(case=case, ens=ensemble))
+                        unchecked.append('{}-ens{}'.format(case, ensemble))
+                    elif esgf_missing:
                         print(
                             "{case}-ens{ens} is missing the following variables from ESGF:".format(case=case, ens=ensemble))
                         for m in esgf_missing:
                             print("\t {}".format(m))
 
-                if not missing and not esgf_missing:
+                if not missing and esgf_missing == list():
                     print("Found all data for {}-ens{}".format(case, ensemble))
 
+    if index is not None:
+        index.close()
+    if unchecked:
+        print("Unable to check ESGF for: {}".format(', '.join(unchecked)))
+        return 1
     return 0
 
 